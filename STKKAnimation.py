@@ -0,0 +1,203 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Light Guide animations, precomputed once per keyboard
+#                   model and played by a scheduler alongside live MIDI
+
+import time
+import threading
+
+SWEEP_INTERVAL = 0.01      # Time (s) between frames of the connect sweep
+ATTRACT_INTERVAL = 0.05    # Time (s) between frames of the idle attract pattern
+FLASH_INTERVAL = 0.15      # Time (s) between frames of the error flash
+IDLE_POLL = 0.1            # Time (s) between checks for idleness when nothing is playing
+
+def blankFrame(model):
+    """Returns a bytearray frame for a KKModel with every light off"""
+    frame = bytearray(model.num_keys * model.buffer_scale + 1)
+    frame[0] = model.header_value
+    return frame
+
+def paintKey(frame, model, key, color):
+    """Writes a color (bytes) to a key of a frame, if the key exists"""
+    if 0 <= key < model.num_keys:
+        start = 1 + key * model.buffer_scale
+        frame[start:start + model.buffer_scale] = color
+
+def sweepFrames(model, loops=1):
+    """Returns the frames of the red light sweep shown when connecting -
+       a bright light with dimmer tails runs up and down the keyboard"""
+    if model.buffer_scale == 3:
+        colors = (bytes((0x7F, 0x00, 0x00)), bytes((0x3F, 0x00, 0x00)), bytes((0x0F, 0x00, 0x00)))
+    else:
+        colors = (bytes((0x07,)), bytes((0x05,)), bytes((0x04,)))
+    positions = list(range(model.num_keys)) + list(range(model.num_keys - 1, -1, -1))
+    frames = []
+    for x in positions:
+        frame = blankFrame(model)
+        for offset in (-2, -1, 1, 2, 0):
+            paintKey(frame, model, x + offset, colors[abs(offset)])
+        frames.append(bytes(frame))
+    return frames * loops
+
+def attractFrames(model):
+    """Returns one loop of the idle attract pattern - a slow wave of
+       color travelling along the keyboard"""
+    if model.buffer_scale == 3:
+        levels = [bytes((0x00, (0x7F * i) // 8, (0x7F * (8 - i)) // 8)) for i in range(9)]
+    else:
+        # Blue to cyan palette entries, dimmest first
+        levels = [bytes((index,)) for index in (0x00, 0x2C, 0x2D, 0x2E, 0x2F, 0x28, 0x29, 0x2A, 0x2B)]
+    wave = levels + levels[-2:0:-1]
+    frames = []
+    for step in range(len(wave)):
+        frame = blankFrame(model)
+        for key in range(model.num_keys):
+            paintKey(frame, model, key, wave[(key + step) % len(wave)])
+        frames.append(bytes(frame))
+    return frames
+
+def flashFrames(model, count=3):
+    """Returns the frames of the error flash - every key flashes red"""
+    red = bytes((0x7F, 0x00, 0x00)) if model.buffer_scale == 3 else bytes((0x07,))
+    on_frame = blankFrame(model)
+    for key in range(model.num_keys):
+        paintKey(on_frame, model, key, red)
+    return [bytes(on_frame), bytes(blankFrame(model))] * count
+
+class Animation:
+    """Precomputed frames played at a fixed interval"""
+
+    frames = []       # Frames as bytes, ready to write
+    interval = 0.01   # Time (s) between frames
+    loop = False      # Boolean to indicate the frames repeat until stopped
+
+    def __init__(self, frames, interval, loop=False):
+        self.frames = frames
+        self.interval = interval
+        self.loop = loop
+
+class Animator:
+    """Plays animations on its own thread. Live notes take priority -
+       while live_active() returns True any animation is cancelled, and
+       on_yield() is called so the live lights can be shown again. An
+       optional idle animation starts after idle_delay seconds without
+       live activity"""
+
+    output = None          # Function called with each animation frame
+    live_active = None     # Function returning True while live notes have the keyboard
+    on_yield = None        # Function called when an animation ends or is cancelled
+    idle_animation = None  # Animation played when idle, or None
+    idle_delay = 0.0       # Seconds without live activity before the idle animation
+    current = None         # Animation playing, or None
+    position = 0           # Index of the next frame of the current animation
+    lock = None            # Guards current and position
+    wake = None            # Event set to wake the animator thread
+    running = False        # Boolean to control the animator thread
+    thread_handle = None   # Handle for the animator thread
+    showing = False        # Boolean to indicate an animation frame is on the keyboard
+    idle_since = 0.0       # perf_counter() time live activity was last seen
+    next_due = 0.0         # perf_counter() time the next frame is due
+
+    def __init__(self, output, live_active, on_yield=None, idle_animation=None, idle_delay=0.0):
+        self.output = output
+        self.live_active = live_active
+        self.on_yield = on_yield if on_yield else lambda: None
+        self.idle_animation = idle_animation
+        self.idle_delay = idle_delay
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def start(self):
+        self.running = True
+        self.thread_handle = threading.Thread(target=self.animatorThread, args=())
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+
+    def stop(self):
+        """Stops the animator thread, without calling on_yield"""
+        self.running = False
+        self.wake.set()
+        if self.thread_handle:
+            self.thread_handle.join()
+            self.thread_handle = None
+
+    def play(self, animation):
+        """Starts an animation, replacing any that is playing"""
+        with self.lock:
+            self.current = animation
+            self.position = 0
+        self.wake.set()
+
+    def playing(self):
+        """Returns True while an animation is playing"""
+        return self.current is not None
+
+    def nextFrame(self):
+        """Returns the current animation's next frame and interval, or
+           (None, None) if nothing is playing. Ends the animation after
+           its last frame unless it loops"""
+        with self.lock:
+            animation = self.current
+            if animation is None:
+                return None, None
+            frame = animation.frames[self.position]
+            self.position += 1
+            if self.position >= len(animation.frames):
+                if animation.loop:
+                    self.position = 0
+                else:
+                    self.current = None
+            return frame, animation.interval
+
+    def step(self):
+        """Runs the animator for one step, showing the next frame if an
+           animation is playing, and returns the time (s) to wait before
+           the next step. Called by the animator thread"""
+        now = time.perf_counter()
+        if self.live_active():
+            self.idle_since = now
+            # Live notes take the keyboard from any animation
+            if self.current is not None:
+                with self.lock:
+                    self.current = None
+            if self.showing:
+                self.showing = False
+                self.on_yield()
+            return IDLE_POLL
+
+        if self.current is None:
+            if self.showing:
+                # Animation finished, give the keyboard back
+                self.showing = False
+                self.on_yield()
+            if self.idle_animation and now - self.idle_since >= self.idle_delay:
+                self.play(self.idle_animation)
+                self.next_due = now
+            else:
+                return IDLE_POLL
+
+        if not self.showing:
+            self.next_due = now
+        frame, interval = self.nextFrame()
+        if frame is None:
+            return 0.0
+        self.output(frame)
+        self.showing = True
+        self.next_due = max(self.next_due + interval, time.perf_counter())
+        return self.next_due - time.perf_counter()
+
+    def resetSchedule(self):
+        """Starts the idle timer and frame schedule from now"""
+        self.idle_since = self.next_due = time.perf_counter()
+        self.showing = False
+
+    def animatorThread(self):
+        """Threaded method that plays animations on schedule"""
+        self.resetSchedule()
+        while self.running:
+            # Wait for the next step, waking early if play() or stop() is called
+            if self.wake.wait(self.step()):
+                self.wake.clear()
+                self.next_due = time.perf_counter()
@@ -0,0 +1,468 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: asyncio runtime for the Light Guide engine - MIDI input,
+#                   frame scheduling, animations, stats and HID writes all
+#                   run as tasks on one event loop instead of a thread each
+
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from STKKEngine import LightGuideEngine, STKKError
+from STKKMidi import MIDIReceiver, NOTE_TYPES
+from STKKAnimation import Animator, FLASH_INTERVAL
+from STKKEffects import EffectTicker
+from STKKStats import StatsDumper
+from STKKHid import closeTransport, WRITE_RETRY_INTERVAL
+
+FLUSH_TIMEOUT = 1.0  # Longest time (s) to wait for a frame writer's last frame
+
+class AsyncFrameWriter:
+    """asyncio counterpart of FrameWriter - a task writes the most recent
+       frame submitted, running each USB write in the keyboard's own
+       single thread executor so the loop never waits on USB. Only one
+       write per keyboard is in flight, newer frames replace waiting ones.
+       A frame that fails to write is kept and written again after
+       WRITE_RETRY_INTERVAL, unless a newer one replaces it first"""
+
+    transport = None     # Transport the frames are written to
+    on_written = None    # Function called with (stamp, completion time) after each write
+    on_error = None      # Function called after each write that failed
+    retry_at = None      # perf_counter() time to write a failed frame again, or None
+    loop = None          # Event loop the writer task runs on
+    loop_thread = 0      # Thread identifier of the loop's thread
+    executor = None      # ThreadPoolExecutor running the blocking writes
+    pending = None       # Newest frame not yet written, or None
+    pending_stamp = None # Stamp submitted with the pending frame
+    ready = None         # asyncio.Event set when a frame is pending
+    idle = None          # asyncio.Event set when nothing is pending or being written
+    task = None          # Writer task
+    frames_written = 0   # Number of frames written
+    frames_dropped = 0   # Number of frames replaced before they were written
+    write_errors = 0     # Number of writes that failed
+
+    def __init__(self, transport, on_written=None, loop=None, on_error=None):
+        self.transport = transport
+        self.on_written = on_written
+        self.on_error = on_error
+        self.loop = loop
+
+    def start(self):
+        """Starts the writer task. Can be called from any thread if the
+           writer was given its loop, otherwise only on the loop's thread"""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        if self.onLoop():
+            self.startTask()
+        else:
+            self.loop.call_soon_threadsafe(self.startTask)
+
+    def startTask(self):
+        """Creates the writer task, on the loop's thread"""
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task = self.loop.create_task(self.writerTask())
+
+    def onLoop(self):
+        """Returns True if called on the loop's thread"""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def stop(self):
+        """Cancels the writer task and waits for any write in flight. On
+           the loop's thread call flush() first to write the waiting frame,
+           from other threads the waiting frame is written before stopping"""
+        if self.onLoop():
+            if self.task:
+                self.task.cancel()
+        elif not self.loop.is_closed():
+            try:
+                asyncio.run_coroutine_threadsafe(self.flush(), self.loop).result(FLUSH_TIMEOUT)
+            except Exception:
+                pass # Keyboard offline, or the loop stopped
+            try:
+                self.loop.call_soon_threadsafe(self.task.cancel)
+            except RuntimeError:
+                pass # Loop closed, the task went with it
+        self.task = None
+        self.executor.shutdown(wait=True)
+
+    def submit(self, frame, stamp=None):
+        """Hands a frame to the writer task, replacing any frame still
+           waiting. Can be called from any thread"""
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.submit, frame, stamp)
+            return
+        if self.pending is not None:
+            self.frames_dropped += 1
+            if stamp and self.pending_stamp and self.pending_stamp[0] is not None:
+                if stamp[0] is None or self.pending_stamp[0] < stamp[0]:
+                    stamp = (self.pending_stamp[0], stamp[1])
+        self.pending = frame
+        self.pending_stamp = stamp
+        self.idle.clear()
+        self.ready.set()
+
+    def replaceTransport(self, transport):
+        """Switches the writer to another transport and closes the old
+           one, see FrameWriter.replaceTransport. The close runs on the
+           keyboard's executor, after any write in flight. Can be called
+           from any thread"""
+        old = self.transport
+        self.transport = transport
+        if old is not None:
+            try:
+                self.executor.submit(closeTransport, old)
+            except (AttributeError, RuntimeError):
+                closeTransport(old) # Writer not started or already stopped
+        if transport is not None:
+            # Write the waiting frame to the new transport at once
+            self.retry_at = None
+            if self.onLoop():
+                self.ready.set()
+            else:
+                self.loop.call_soon_threadsafe(self.ready.set)
+        return old
+
+    async def flush(self):
+        """Returns once the waiting frame, if any, has been written"""
+        await self.idle.wait()
+
+    async def writerTask(self):
+        """Task that writes frames as they are submitted"""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            if self.retry_at is not None:
+                remaining = self.retry_at - time.perf_counter()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                    if self.retry_at is not None:
+                        self.retry_at = None
+                        self.ready.set()
+                    continue
+                self.retry_at = None
+            transport = self.transport
+            if self.pending is None or transport is None:
+                continue
+            frame = self.pending
+            stamp = self.pending_stamp
+            self.pending = None
+            self.pending_stamp = None
+            try:
+                result = await self.loop.run_in_executor(self.executor, transport.write, frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                result = -1
+            if result is not None and result < 0:
+                self.write_errors += 1
+                self.retry_at = time.perf_counter() + WRITE_RETRY_INTERVAL
+                retrying = self.pending is None
+                if retrying:
+                    # Keep the frame to write again, a newer one replaces it
+                    self.pending = frame
+                    self.pending_stamp = stamp
+                self.ready.set()
+                if self.on_error:
+                    self.on_error()
+                if retrying:
+                    # A retry doesn't hold up flush(), so stopping doesn't wait on a lost keyboard
+                    self.idle.set()
+                continue
+            self.frames_written += 1
+            if self.on_written:
+                self.on_written(stamp, time.perf_counter())
+            if self.pending is None:
+                self.idle.set()
+
+class AsyncMIDIReceiver(MIDIReceiver):
+    """MIDIReceiver that runs as a task, coalescing bursts with loop
+       timers. Messages from the MIDI backend's thread are put in a deque,
+       and the loop is only woken for the first message of a burst rather
+       than for each one. Runs until cancelled"""
+
+    loop = None           # Event loop the receiver runs on
+    items = None          # deque of (message, receipt time) not yet applied
+    ready = None          # asyncio.Event set when items may be waiting
+    wake_pending = False  # Boolean to indicate the loop has been asked to set ready
+
+    def __init__(self, *args, **kwargs):
+        MIDIReceiver.__init__(self, *args, **kwargs)
+        # Made up front so callSoon can queue work before run() starts
+        self.items = deque()
+
+    async def run(self):
+        # ready is made before loop is set, as callSoon uses both once loop is
+        self.ready = asyncio.Event()
+        self.wake_pending = False
+        self.loop = asyncio.get_running_loop()
+        port = self.open_input(self.port_name, callback=self.enqueue)
+        self.port = port
+        try:
+            while True:
+                self.applyMessage(await self.nextItem())
+                await self.coalesce()
+        finally:
+            port.close()
+
+    def enqueue(self, message):
+        """Called on the MIDI backend's thread with each message"""
+        if message.type in NOTE_TYPES:
+            self.items.append((message, time.perf_counter()))
+            if not self.wake_pending:
+                self.wake_pending = True
+                self.loop.call_soon_threadsafe(self.ready.set)
+
+    def callSoon(self, func):
+        """Runs func() on the loop between two messages, see MIDIReceiver.callSoon"""
+        self.items.append((func, None))
+        if self.loop is not None and not self.wake_pending:
+            self.wake_pending = True
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def nextItem(self):
+        """Returns the next (message, receipt time) item, waiting for one"""
+        while not self.items:
+            # Any message queued after this asks for a new wake up
+            self.ready.clear()
+            self.wake_pending = False
+            if not self.items:
+                await self.ready.wait()
+        return self.items.popleft()
+
+    async def coalesce(self):
+        """Applies the rest of a burst of messages and sends one frame.
+           Waiting messages are applied for up to max_coalesce seconds,
+           then if the frame rate holds the frame back the loop sleeps
+           until it is due and applies everything that arrived meanwhile"""
+        now = time.perf_counter()
+        window_end = now + self.max_coalesce
+        frame_due = self.last_frame_time + self.min_frame_interval
+        while self.items and now < window_end:
+            self.applyMessage(self.items.popleft())
+            now = time.perf_counter()
+        if now < frame_due:
+            await asyncio.sleep(frame_due - now)
+            for i in range(len(self.items)):
+                self.applyMessage(self.items.popleft())
+        self.sendFrame()
+
+class AsyncAnimator(Animator):
+    """Animator that runs as a task instead of a thread"""
+
+    task = None  # Animator task
+
+    def start(self):
+        """Starts the animator task, must be called on the loop's thread"""
+        self.wake = asyncio.Event()
+        self.running = True
+        self.task = asyncio.get_running_loop().create_task(self.animatorTask())
+
+    def stop(self):
+        """Cancels the animator task, without calling on_yield"""
+        self.running = False
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def animatorTask(self):
+        """Task that plays animations on schedule"""
+        self.resetSchedule()
+        while self.running:
+            # Wait for the next step, waking early if play() is called
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(self.step(), 0.0))
+            except asyncio.TimeoutError:
+                continue
+            self.wake.clear()
+            self.next_due = time.perf_counter()
+
+class AsyncEffectTicker(EffectTicker):
+    """EffectTicker that runs as a task instead of a thread"""
+
+    task = None  # Ticker task
+
+    def start(self):
+        """Starts the ticker task, must be called on the loop's thread"""
+        self.wake = asyncio.Event()
+        self.running = True
+        self.task = asyncio.get_running_loop().create_task(self.tickerTask())
+
+    def stop(self):
+        self.running = False
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def tickerTask(self):
+        """Task that ticks on schedule"""
+        next_due = time.perf_counter()
+        while self.running:
+            self.wake.clear()
+            if not self.tick():
+                # Nothing fading, the first tick is one interval after the poke
+                await self.wake.wait()
+                next_due = time.perf_counter()
+            next_due = max(next_due + self.interval, time.perf_counter())
+            await asyncio.sleep(next_due - time.perf_counter())
+
+class AsyncLightGuideEngine(LightGuideEngine):
+    """LightGuideEngine with an asyncio runtime. start() and stop() work
+       as before, but the engine runs on a single event loop thread -
+       MIDI input, frame scheduling, animations, the stats dumper and the
+       device session are tasks, and USB writes run in one executor
+       thread per keyboard"""
+
+    loop = None           # Event loop the engine runs on while connected
+    stop_event = None     # asyncio.Event set to stop the engine
+    start_error = None    # STKKError raised while connecting on the loop
+    started = None        # threading.Event set once connected, or connecting failed
+
+    def frame_writer_factory(self, transport, on_written, on_error=None):
+        """Returns an AsyncFrameWriter on the engine's loop"""
+        return AsyncFrameWriter(transport, on_written, self.loop, on_error)
+
+    def startAnimator(self, output):
+        """Creates and starts the animator task of an output, on the loop's thread"""
+        output.animator = AsyncAnimator(output.writeAnimationFrame, self.liveActive,
+                                        output.restoreLiveFrame, output.attract_animation,
+                                        self.attract_delay)
+        output.animator.start()
+
+    def startEffects(self):
+        """Starts the effect ticker task if effects are on, on the loop's thread"""
+        if self.effectsOn():
+            self.effect_ticker = AsyncEffectTicker(self.tickEffects)
+            self.effect_ticker.start()
+
+    def startKeyboards(self, keyboards, colors, port_name=None, skip_failed=False):
+        """Connects to a list of (model index, hidapi path) keyboards and
+           the MIDI port, and starts the event loop thread"""
+        if self.connected:
+            return
+        if not self.setKeyboards(keyboards, colors):
+            raise STKKError("Unknown keyboard", "Unknown keyboard model: " +
+                            ', '.join(str(keyboard[0]) for keyboard in keyboards))
+        self.findMIDIPort(port_name)
+        self.start_error = None
+        self.started = threading.Event()
+        self.listen = True
+        self.thread_handle = threading.Thread(target=self.loopThread, args=(skip_failed,))
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+        self.started.wait()
+        if self.start_error:
+            self.thread_handle.join()
+            self.thread_handle = None
+            raise self.start_error
+        self.connected = True
+
+    def stop(self):
+        """Stops the event loop, which disconnects from the keyboards"""
+        if self.loop and self.stop_event:
+            try:
+                self.loop.call_soon_threadsafe(self.stop_event.set)
+            except RuntimeError:
+                pass # Loop already closed
+        LightGuideEngine.stop(self)
+
+    def loopThread(self, skip_failed):
+        """Threaded method that runs the engine's event loop"""
+        asyncio.run(self.run(skip_failed))
+
+    async def run(self, skip_failed=False):
+        """Connects to the keyboards and runs the engine's tasks until
+           stop() is called or MIDI input fails"""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        try:
+            self.connectToKeyboard(skip_failed)
+        except STKKError as e:
+            self.start_error = e
+            self.started.set()
+            return
+        self.frames_written = 0
+        self.frames_skipped = 0
+        self.lightsOut()
+        self.started.set()
+
+        tasks = []
+        dumper = None
+        if self.stats_file:
+            dumper = StatsDumper(self.statsSnapshot, self.stats_file, self.stats_interval)
+            tasks.append(self.loop.create_task(self.statsTask(dumper)))
+        session = self.makeSession()
+        if session:
+            tasks.append(self.loop.create_task(self.sessionTask(session)))
+
+        # Animations play alongside MIDI handling, so no notes are
+        # lost while the connect sweep is showing
+        self.last_event_time = 0.0
+        for output in self.outputs:
+            self.startAnimator(output)
+            if self.sweep_loops > 0:
+                output.animator.play(output.sweep_animation)
+        self.startEffects()
+        self.receiver = AsyncMIDIReceiver(self.port_name, self.MIDIMessageHandler, self.writeLightsBuffer,
+                                          max_frame_rate=self.max_frame_rate, max_coalesce=self.max_coalesce,
+                                          open_input=self.open_input, stats=self.stats)
+        receive_task = self.loop.create_task(self.receiver.run())
+        stop_task = self.loop.create_task(self.stop_event.wait())
+        try:
+            await asyncio.wait([receive_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+            if receive_task.done():
+                # MIDI input failed, flash the keyboards red before disconnecting
+                await self.flashErrorAsync()
+                receive_task.result()
+        finally:
+            self.receiver = None
+            for task in [receive_task, stop_task] + tasks:
+                task.cancel()
+            await asyncio.gather(receive_task, stop_task, *tasks, return_exceptions=True)
+            for output in self.outputs:
+                output.animator.stop()
+            self.stopEffects()
+            self.lightsOut()
+            for output in self.outputs:
+                try:
+                    await asyncio.wait_for(output.frame_writer.flush(), FLUSH_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass # Keyboard is offline
+            self.disconnectFromKeyboard()
+
+    async def statsTask(self, dumper):
+        """Task that appends a stats snapshot to the stats file every
+           interval, and a final one when cancelled"""
+        previous = None
+        try:
+            while True:
+                await asyncio.sleep(self.stats_interval)
+                previous = await self.loop.run_in_executor(None, dumper.writeSnapshot, previous)
+        except asyncio.CancelledError:
+            dumper.writeSnapshot(previous)
+            raise
+
+    async def sessionTask(self, session):
+        """Task that looks for unplugged keyboards every interval, see
+           DeviceSession.poll - USB is polled in an executor thread"""
+        while True:
+            await asyncio.sleep(session.interval)
+            await self.loop.run_in_executor(None, session.poll)
+
+    async def flashErrorAsync(self):
+        """Flashes every key red, returning when the flash is done"""
+        for output in self.outputs:
+            output.animator.play(output.flash_animation)
+        timeout = time.perf_counter() + len(self.outputs[0].flash_animation.frames) * FLASH_INTERVAL + 1.0
+        while (any(output.animator.playing() for output in self.outputs) and
+               time.perf_counter() < timeout):
+            await asyncio.sleep(FLASH_INTERVAL)
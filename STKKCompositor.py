@@ -0,0 +1,71 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Frame compositor - merges the live lights with the
+#                   palette calibration and animation layers, so each
+#                   layer updates on its own without overwriting another
+
+import threading
+
+LAYER_LIVE = 0         # Lights set by MIDI notes, with any effects - the base layer
+LAYER_CALIBRATION = 1  # Palette indices shown while mapping the MK2 palette
+LAYER_ANIMATION = 2    # Animation and timeline frames, covering every key
+LAYERS = (LAYER_LIVE, LAYER_CALIBRATION, LAYER_ANIMATION)
+
+class Compositor:
+    """Merges prioritized layers into the frames sent to one keyboard,
+       higher layers showing over lower ones. The live layer is the base,
+       a function returning the live frame. Key layers cover some keys
+       with their own colors, and frame layers cover every key. Only the
+       keys a key layer covers are merged, and while nothing covers the
+       live layer its frame is sent unchanged. Layers can be changed from
+       any thread - hold lock while changing a layer and composing, so
+       every frame shows the latest state of every layer"""
+
+    scale = 3          # Bytes per key, 3 on MK1 (RGB) and 1 on MK2 (palette index)
+    live_frame = None  # Function returning the live layer's frame (bytes)
+    key_layers = {}    # Dictionary from layer to a dictionary of key index to color (bytes)
+    frame_layers = {}  # Dictionary from layer to a frame (bytes) covering every key
+    lock = None        # Guards the layers, re-entrant so changes can compose while holding it
+
+    def __init__(self, model, live_frame):
+        self.scale = model.buffer_scale
+        self.live_frame = live_frame
+        self.key_layers = {}
+        self.frame_layers = {}
+        self.lock = threading.RLock()
+
+    def setKeys(self, layer, colors):
+        """Covers keys with a layer - colors is a dictionary from key
+           index to color (bytes), replacing the keys it covered before"""
+        self.key_layers[layer] = dict(colors)
+
+    def setFrame(self, layer, frame):
+        """Covers every key with a frame (bytes) on a layer"""
+        self.frame_layers[layer] = frame
+
+    def clear(self, layer):
+        """Uncovers the keys of a layer, showing the layers below"""
+        self.key_layers.pop(layer, None)
+        self.frame_layers.pop(layer, None)
+
+    def showing(self, layer):
+        """Returns True while a layer covers any keys"""
+        return layer in self.frame_layers or layer in self.key_layers
+
+    def compose(self):
+        """Returns the frame (bytes) to send - the top frame layer, or the
+           live frame if none, with the key layers above it merged in"""
+        top = max(self.frame_layers) if self.frame_layers else LAYER_LIVE
+        frame = self.frame_layers[top] if top != LAYER_LIVE else self.live_frame()
+        above = [layer for layer in sorted(self.key_layers) if layer > top]
+        if not above:
+            return frame
+        frame = bytearray(frame)
+        scale = self.scale
+        for layer in above:
+            for key, color in self.key_layers[layer].items():
+                start = 1 + key * scale
+                frame[start:start + scale] = color
+        return bytes(frame)
@@ -0,0 +1,155 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Light Guide effects - released keys fade out and lit
+#                   keys glow onto their neighbours, computed at a fixed
+#                   tick as whole-array operations over every key
+
+import time
+import threading
+import importlib.util
+from STKKPalette import PALETTE_GROUP_SIZE, PALETTE_FIRST, PALETTE_LAST
+
+# NumPy takes a while to import, so it is only looked for here, and
+# imported by the first EffectStage
+numpy = None
+EFFECTS_AVAILABLE = importlib.util.find_spec('numpy') is not None  # Effects need NumPy, keys snap dark without it
+EFFECT_TICK = 0.02                     # Time (s) between effect frames while keys are fading
+
+class EffectStage:
+    """Fade and glow effects for one keyboard. The live lights buffer
+       is left as the notes set it - each frame is composed from it by
+       render(), with released keys fading from their last color over
+       fade_ticks ticks, and keys next to lit or fading ones glowing at
+       glow times their brightness. Every step works on arrays of all
+       the keys at once, so a tick costs the same on an S25 as an S88.
+       Brightness is squared before dimming, as the eye is more
+       sensitive to changes in dim light. Not thread safe, the output's
+       compositor lock guards it"""
+
+    num_keys = 0       # Number of keys on the keyboard
+    scale = 3          # Bytes per key, 3 on MK1 (RGB) and 1 on MK2 (palette index)
+    fades = False      # Boolean to indicate released keys fade, rather than going dark at once
+    decay = 1.0        # Intensity lost per tick by a fading key
+    glow = 0.0         # Brightness of the glow around lit keys, 0 for none
+    previous = None    # Live colors at the last render, one row per key
+    tail = None        # Color each fading key fades from
+    intensity = None   # Intensity (0 to 1) of each fading key, 0 once dark
+
+    def __init__(self, model, fade_ticks, glow=0.0):
+        global numpy
+        if numpy is None:
+            import numpy
+        self.num_keys = model.num_keys
+        self.scale = model.buffer_scale
+        self.fades = fade_ticks > 0
+        self.decay = 1.0 / fade_ticks if self.fades else 1.0
+        self.glow = glow
+        self.reset()
+
+    def reset(self):
+        """Darkens every key at once, without fading"""
+        self.previous = numpy.zeros((self.num_keys, self.scale), numpy.uint8)
+        self.tail = numpy.zeros((self.num_keys, self.scale), numpy.uint8)
+        self.intensity = numpy.zeros(self.num_keys, numpy.float32)
+
+    def active(self):
+        """Returns True while any key is fading"""
+        return bool(self.intensity.any())
+
+    def advance(self):
+        """Moves every fading key one tick closer to dark"""
+        numpy.subtract(self.intensity, self.decay, out=self.intensity)
+        numpy.maximum(self.intensity, 0.0, out=self.intensity)
+
+    def render(self, lights_buffer):
+        """Returns the frame (bytes) to show for a lights buffer. Keys
+           lit in the buffer show its colors, keys released since the
+           last render start fading"""
+        live = numpy.frombuffer(lights_buffer, numpy.uint8, offset=1).reshape(self.num_keys, self.scale)
+        lit = live.any(axis=1)
+        released = self.previous.any(axis=1) & ~lit
+        if self.fades:
+            self.tail[released] = self.previous[released]
+            self.intensity[released] = 1.0
+        self.intensity[lit] = 0.0
+        self.previous[:] = live
+
+        brightness = self.intensity * self.intensity
+        frame = numpy.where(lit[:, None], live, self.dim(self.tail, brightness))
+
+        if self.glow > 0:
+            # Each key glows with the brighter of its neighbours
+            source = numpy.where(lit[:, None], live, self.tail)
+            source_brightness = numpy.where(lit, 1.0, brightness) * self.glow
+            glow = numpy.zeros(self.num_keys, numpy.float32)
+            glow_color = numpy.zeros_like(source)
+            glow[1:] = source_brightness[:-1]
+            glow_color[1:] = source[:-1]
+            right_brighter = source_brightness[1:] > glow[:-1]
+            glow[:-1] = numpy.where(right_brighter, source_brightness[1:], glow[:-1])
+            glow_color[:-1] = numpy.where(right_brighter[:, None], source[1:], glow_color[:-1])
+            shows_glow = ~lit & (glow > brightness)
+            frame = numpy.where(shows_glow[:, None], self.dim(glow_color, glow), frame)
+
+        return bytes(lights_buffer[:1]) + frame.astype(numpy.uint8).tobytes()
+
+    def dim(self, colors, brightness):
+        """Returns colors dimmed to per-key brightnesses (0 to 1) - MK1
+           RGB values are scaled, MK2 palette indices step down their
+           group of brightnesses and are dark at brightness 0"""
+        if self.scale == 3:
+            return (colors * brightness[:, None] + 0.5).astype(numpy.uint8)
+        index = colors[:, 0].astype(numpy.int16)
+        steps = numpy.rint((1.0 - brightness) * (PALETTE_GROUP_SIZE - 1)).astype(numpy.int16)
+        in_group = (index >= PALETTE_FIRST) & (index <= PALETTE_LAST)
+        dimmed = numpy.where(in_group, index - numpy.minimum(steps, (index - PALETTE_FIRST) % PALETTE_GROUP_SIZE),
+                             index)
+        dimmed[brightness <= 0.0] = 0
+        return dimmed.astype(numpy.uint8)[:, None]
+
+class EffectTicker:
+    """Calls tick() every interval on its own thread while it returns
+       True, then sleeps until poke() is called. Ticks run at a fixed
+       rate, so fades take the same time however busy the MIDI input is"""
+
+    tick = None            # Function that advances effects one tick, returning True while any are running
+    interval = EFFECT_TICK # Time (s) between ticks
+    wake = None            # Event set by poke() to start ticking
+    running = False        # Boolean to control the ticker thread
+    thread_handle = None   # Handle for the ticker thread
+
+    def __init__(self, tick, interval=EFFECT_TICK):
+        self.tick = tick
+        self.interval = interval
+        self.wake = threading.Event()
+
+    def start(self):
+        self.running = True
+        self.thread_handle = threading.Thread(target=self.tickerThread, args=())
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread_handle:
+            self.thread_handle.join()
+            self.thread_handle = None
+
+    def poke(self):
+        """Starts ticking, call when a key starts fading"""
+        self.wake.set()
+
+    def tickerThread(self):
+        """Threaded method that ticks on schedule"""
+        next_due = time.perf_counter()
+        while self.running:
+            self.wake.clear()
+            if not self.tick():
+                # Nothing fading, the first tick is one interval after the poke
+                self.wake.wait()
+                next_due = time.perf_counter()
+            next_due = max(next_due + self.interval, time.perf_counter())
+            time.sleep(max(0.0, next_due - time.perf_counter()))
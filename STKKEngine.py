@@ -0,0 +1,1238 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Light Guide engine - drives NI Komplete Kontrol
+#                   keyboards' Light Guide using MIDI events from Synthesia,
+#                   without a GUI.  Run this file to use it as a service.
+
+import time
+import sys
+import argparse
+import threading
+import configparser as cfg
+from collections import namedtuple
+from STKKPalette import (RGBStringToTuple, readPaletteMap, mapColorsToPalette, scaleRGB, dimPaletteIndex, METRIC_WEIGHTED,
+                         PALETTE_METRICS, PALETTE_GROUP_SIZE)
+from STKKHid import HIDTransport, FrameWriter, enumerateDevices
+from STKKStats import EngineStats, StatsDumper, LatencyHistogram
+from STKKSession import DeviceSession, DEFAULT_RECONNECT_INTERVAL
+from STKKAnimation import (Animator, Animation, blankFrame, sweepFrames, attractFrames,
+                           flashFrames, SWEEP_INTERVAL, ATTRACT_INTERVAL, FLASH_INTERVAL)
+from STKKEffects import EffectStage, EffectTicker, EFFECTS_AVAILABLE, EFFECT_TICK
+from STKKCompositor import Compositor, LAYER_CALIBRATION, LAYER_ANIMATION
+from STKKMidi import MIDIReceiver, WAIT_BLOCKING, WAIT_STRATEGIES, DEFAULT_MAX_FRAME_RATE, DEFAULT_MAX_COALESCE
+from STKKMidi import splitPorts, isPortPattern, resolvePorts, findLoopbackPort
+from STKKTrace import TraceRecorder, TracingTransport, TRACE_FILE, DEFAULT_TRACE_SIZE
+
+NI_HID_ID = 0x17CC
+S61_MK2_ID = 0x1620
+S88_MK2_ID = 0x1630
+S49_MK2_ID = 0x1610
+S61_MK1_ID = 0x1360
+S88_MK1_ID = 0x1410
+S49_MK1_ID = 0x1350
+S25_MK1_ID = 0x1340
+MK2_HEADER_VAL = 0x81
+MK1_HEADER_VAL = 0x82
+LIGHT_GUIDE_CMD = 0xa0
+CONFIG_FILE = 'STKKConfig.ini'
+RUNTIME_THREADS = 'threads'  # Engine runs a thread per task
+RUNTIME_ASYNCIO = 'asyncio'  # Engine runs its tasks on one asyncio event loop, see STKKAsync
+RUNTIMES = (RUNTIME_THREADS, RUNTIME_ASYNCIO)
+VELOCITY_LEVELS = 8          # Brightness levels used when brightness follows velocity
+VELOCITY_FLOOR = 0.15        # Brightness of the softest notes when brightness follows velocity
+SWAP_TIMEOUT = 1.0           # Longest time (s) to wait for the listener to swap in new keyboards
+PALETTE_FILE = 'PaletteMap.ini'
+
+# Keyboard model attributes -
+#   note_offset converts a MIDI note value to a key index, and is
+#   calculated as 60 - number of keys below Middle C
+#   buffer_scale is the number of bytes per key in the lights buffer
+KKModel = namedtuple('KKModel', ['name', 'short_name', 'hid_id', 'num_keys',
+                                 'note_offset', 'header_value', 'buffer_scale'])
+
+# Supported models, in the order shown in the GUI
+KK_MODELS = [
+    KKModel("Komplete Kontrol S61 MK2", 'S61MK2', S61_MK2_ID, 61, -36, MK2_HEADER_VAL, 1),
+    KKModel("Komplete Kontrol S88 MK2", 'S88MK2', S88_MK2_ID, 88, -21, MK2_HEADER_VAL, 1),
+    KKModel("Komplete Kontrol S49 MK2", 'S49MK2', S49_MK2_ID, 49, -36, MK2_HEADER_VAL, 1),
+    KKModel("Komplete Kontrol S61 MK1", 'S61MK1', S61_MK1_ID, 61, -36, MK1_HEADER_VAL, 3),
+    KKModel("Komplete Kontrol S88 MK1", 'S88MK1', S88_MK1_ID, 88, -21, MK1_HEADER_VAL, 3),
+    KKModel("Komplete Kontrol S49 MK1", 'S49MK1', S49_MK1_ID, 49, -36, MK1_HEADER_VAL, 3),
+    KKModel("Komplete Kontrol S25 MK1", 'S25MK1', S25_MK1_ID, 25, -48, MK1_HEADER_VAL, 3)]
+
+# User prefs keys of the finger colors, in MIDI channel order
+COLOR_KEYS = ['defaultcolor', 'leftthumb', 'leftindex', 'leftmiddle', 'leftring',
+              'leftpinky', 'rightthumb', 'rightindex', 'rightmiddle', 'rightring',
+              'rightpinky', 'lefthand', 'righthand']
+
+class STKKError(Exception):
+    """Error raised when the engine cannot connect, with a short
+       title suitable for an error dialog"""
+
+    def __init__(self, title, message):
+        Exception.__init__(self, message)
+        self.title = title
+
+class KeyboardOutput:
+    """One keyboard lit by the engine - a lights buffer laid out for its
+       model, the compositor that layers calibration and animations over
+       it, and the transport and frame writer that carry frames to it.
+       The frame writer is the keyboard's only writer, and every frame
+       reaches it through the compositor. Each output writes on its own
+       thread, so a slow or unplugged keyboard never holds up the others"""
+
+    model = KK_MODELS[3]           # KKModel of the keyboard
+    path = None                    # hidapi path of the keyboard, None to open the first of its model
+    lights_buffer = bytearray()    # Bytes containing color values + 1 byte header
+    lights_view = None             # memoryview of the lights buffer
+    key_views = []                 # memoryview of each key's color values in the buffer
+    blank_frame = b''              # Bytes for turning off every light
+    color_list = []                # List of bytes containing the currently selected colors
+    off_color = bytes((0x00,))     # Bytes for turning off a light
+    lights_dirty = False           # Boolean to indicate the buffer changed since the last write
+    kb_device = None               # Transport to the keyboard, HIDTransport unless replaced
+    frame_writer = None            # FrameWriter that owns kb_device while connected
+    online = False                 # Boolean to indicate the keyboard is plugged in and taking frames
+    errors_seen = 0                # Frame writer write errors when last checked by writeFailed
+    stats = None                   # EngineStats of the frames written to this keyboard
+    animator = None                # Animator playing animations on this keyboard
+    sweep_animation = None         # Connect sweep Animation for the model
+    attract_animation = None       # Idle attract Animation for the model, or None
+    flash_animation = None         # Error flash Animation for the model
+    effects = None                 # EffectStage composing frames from the lights buffer, or None
+    compositor = None              # Compositor merging the live lights with the other layers
+
+    def __init__(self, model, color_list, path=None, sweep_loops=2, attract_delay=0.0, effects=None):
+        self.model = model
+        self.effects = effects
+        self.compositor = Compositor(model, self.liveFrame)
+        self.path = path
+        self.color_list = color_list
+        self.off_color = bytes(model.buffer_scale)
+
+        # Create the buffer for the color values, the header byte never changes
+        self.lights_buffer = blankFrame(model)
+        self.lights_view = memoryview(self.lights_buffer)
+        self.blank_frame = bytes(len(self.lights_buffer) - 1)
+
+        # Precompute a view of each key's color values, 3 bytes per key
+        # on MK1 (RGB) and 1 byte per key on MK2 (palette index)
+        self.key_views = []
+        for key in range(model.num_keys):
+            start = 1 + key * model.buffer_scale
+            self.key_views.append(self.lights_view[start:start + model.buffer_scale])
+
+        # Precompute the animations' frames for the model
+        self.sweep_animation = Animation(sweepFrames(model, sweep_loops), SWEEP_INTERVAL)
+        self.flash_animation = Animation(flashFrames(model), FLASH_INTERVAL)
+        if attract_delay > 0:
+            self.attract_animation = Animation(attractFrames(model), ATTRACT_INTERVAL, loop=True)
+
+    def keyPatches(self):
+        """Returns the key view each MIDI note lights, indexed by note,
+           or None for notes outside the keyboard's range"""
+        patches = []
+        for note in range(128):
+            key = note + self.model.note_offset
+            patches.append(self.key_views[key] if 0 <= key < self.model.num_keys else None)
+        return patches
+
+    def connect(self, transport, frame_writer_factory=FrameWriter):
+        """Opens the transport, switches the keyboard to Light Guide mode
+           and starts a frame writer made by frame_writer_factory"""
+        self.openTransport(transport)
+        self.kb_device = transport
+
+        # From here on frames are written on the frame writer's thread
+        self.stats = EngineStats()
+        self.frame_writer = frame_writer_factory(self.kb_device, self.stats.frameWritten, self.writeError)
+        self.frame_writer.start()
+        self.errors_seen = 0
+        self.online = True
+
+    def openTransport(self, transport):
+        """Opens a transport and switches the keyboard to Light Guide mode"""
+        try:
+            transport.open()
+            # Set the keyboard to receive Light Guide data
+            transport.write([LIGHT_GUIDE_CMD])
+        except Exception as e:
+            raise STKKError("Could not connect to KK", 'Connection error: ' + str(e))
+
+    def goOffline(self):
+        """Stops writing to the keyboard after it has gone away - the
+           latest frame is held for when it is reconnected"""
+        self.online = False
+        self.frame_writer.replaceTransport(None)
+
+    def reconnect(self, transport):
+        """Switches the frame writer to a newly opened transport for the
+           keyboard, restoring Light Guide mode and the current frame.
+           Raises STKKError if the transport can't be opened"""
+        self.openTransport(transport)
+        self.frame_writer.replaceTransport(transport)
+        self.kb_device = transport
+        self.errors_seen = self.frame_writer.write_errors
+        self.online = True
+        self.submitFrame()
+
+    def writeError(self):
+        """Called by the frame writer after a write fails. The writer
+           tries the frame again, and the buffer is marked dirty so the
+           next frame is sent even if no key changes"""
+        self.lights_dirty = True
+
+    def writeFailed(self):
+        """Returns True if a write failed since the last call"""
+        errors = self.frame_writer.write_errors
+        failed = errors != self.errors_seen
+        self.errors_seen = errors
+        return failed
+
+    def disconnect(self):
+        """Writes any waiting frame, stops the frame writer and closes the keyboard"""
+        if self.frame_writer:
+            self.frame_writer.stop()
+            self.frame_writer = None
+        if self.kb_device:
+            self.kb_device.close()
+        self.online = False
+
+    def liveFrame(self):
+        """Returns the live layer's frame - a copy of the lights buffer,
+           or the frame composed from it if effects are on"""
+        if self.effects:
+            return self.effects.render(self.lights_buffer)
+        return bytes(self.lights_buffer)
+
+    def present(self, stamp=None):
+        """Sends the compositor's frame to the frame writer, if connected"""
+        with self.compositor.lock:
+            if self.frame_writer:
+                self.frame_writer.submit(self.compositor.compose(), stamp)
+
+    def submitFrame(self, stamp=None):
+        """Sends the frame for the lights buffer's latest changes"""
+        self.lights_dirty = False
+        self.present(stamp)
+
+    def tickEffects(self):
+        """Advances the effects one tick and sends the frame, unless an
+           animation covers it - returns True while keys are fading"""
+        with self.compositor.lock:
+            if not self.effects.active():
+                return False
+            self.effects.advance()
+            if not self.compositor.showing(LAYER_ANIMATION):
+                self.present()
+            return self.effects.active()
+
+    def showLayerKeys(self, layer, colors):
+        """Covers keys with a compositor layer and sends the frame - colors
+           is a dictionary from key index to color (bytes)"""
+        with self.compositor.lock:
+            self.compositor.setKeys(layer, colors)
+            self.present()
+
+    def clearLayer(self, layer):
+        """Uncovers a compositor layer's keys and sends the frame"""
+        with self.compositor.lock:
+            self.compositor.clear(layer)
+            self.present()
+
+    def writeColorToBuffer(self, color, index):
+        """Writes a color to the lights buffer -
+           color should be bytes (or a tuple) with one value per byte of a key -
+           index should be an int between 0 and (number of keys - 1), inclusive"""
+
+        # Check the index is within range of the keyboard
+        if index < 0 or index >= self.model.num_keys:
+            return
+
+        # Write the color value to the key's slice of the lights buffer,
+        # marking it dirty if any value changed
+        if not isinstance(color, bytes):
+            color = bytes(color)
+        key_view = self.key_views[index]
+        if key_view != color:
+            key_view[:] = color
+            self.lights_dirty = True
+
+    def lit(self):
+        """Returns True if any key is lit or fading, or the palette is being calibrated"""
+        return (self.lights_view[1:] != self.blank_frame or bool(self.effects and self.effects.active()) or
+                self.compositor.showing(LAYER_CALIBRATION))
+
+    def blank(self):
+        """Turns off every light of the lights buffer and the layers
+           over it at once, without fading - send the frame afterwards"""
+        with self.compositor.lock:
+            self.lights_view[1:] = self.blank_frame
+            self.compositor.clear(LAYER_CALIBRATION)
+            self.compositor.clear(LAYER_ANIMATION)
+            if self.effects:
+                self.effects.reset()
+
+    def writeAnimationFrame(self, frame):
+        """Shows an animation frame on the keyboard, over the other layers"""
+        with self.compositor.lock:
+            self.compositor.setFrame(LAYER_ANIMATION, frame)
+            self.present()
+
+    def restoreLiveFrame(self):
+        """Shows the live lights again after an animation"""
+        self.clearLayer(LAYER_ANIMATION)
+
+class LightGuideEngine:
+    """Lights the Light Guide of one or more Komplete Kontrol keyboards
+       from MIDI note messages. Each message is decoded and looked up
+       once, and the patches found are applied to every keyboard's buffer"""
+
+    outputs = []                   # KeyboardOutput for each keyboard being lit
+    note_on_table = []             # note_on_table[velocity][channel][note] is a tuple of (key view, color, output) patches
+    note_off_table = []            # note_off_table[note] is a tuple of (key view, off color, output) patches
+    note_channels = bytearray(128) # note_channels[note] is 1 + the channel of the lit note, 0 if off
+    note_velocities = bytearray(128) # note_velocities[note] is the velocity of the lit note
+    velocity_brightness = False    # Boolean to indicate key brightness follows note velocity
+    frames_written = 0             # Number of frames sent to the frame writers
+    frames_skipped = 0             # Number of writes skipped because nothing changed
+    model = KK_MODELS[3]           # KKModel of the first keyboard
+    colors = []                    # RGB strings of the current colors, in MIDI channel order
+    connected = False              # Boolean to indicate if currently connected
+    listen = True                  # Boolean to control threaded listen loop
+    transport_factory = None       # Function taking a KKModel and hidapi path, returning an unopened transport
+    open_input = None              # Function used to open the MIDI port, STKKMidi.openInput if None
+    frame_writer_factory = FrameWriter  # Class of the frame writers, taking a transport, on_written and on_error
+    enumerate_devices = None       # Function returning a (product ID, hidapi path) tuple per NI device, or None
+    reconnect_interval = DEFAULT_RECONNECT_INTERVAL  # Seconds between looks for unplugged keyboards, 0 for never
+    mirror_all = False             # Boolean to indicate every keyboard plugged in is lit
+    session = None                 # DeviceSession reconnecting keyboards while connected
+    session_lock = None            # Serializes changes to the list of keyboards
+    palette_lock = None            # Serializes loading the palette map and its palette cube
+    skipped_keyboards = []         # Errors of keyboards that were found but could not be opened
+    sweep_loops = 2                # Number of red light sweeps shown when connecting
+    attract_delay = 0.0            # Idle seconds before the attract pattern plays, 0 for never
+    live_hold = 1.0                # Seconds after a MIDI event that animations stay off
+    fade_time = 0.0                # Seconds released keys take to fade out, 0 to go dark at once
+    glow = 0.0                     # Brightness (0 to 1) of the glow next to lit keys, 0 for none
+    effect_ticker = None           # EffectTicker advancing fades while connected, None if effects are off
+    profile = None                 # Compiled Profile (see STKKProfiles) whose mapped colors are used, or None
+    last_event_time = 0.0          # perf_counter() time of the last MIDI event
+    port_name = ""                 # MIDI input port list, e.g. the LoopBe1 MIDI loopback port
+    midi_port = ""                 # MIDI port list from the prefs, e.g. "*LoopBe*, udp:", a loopback port if empty
+    thread_handle = None           # Handle for thread
+    wait_strategy = WAIT_BLOCKING  # How the listener thread waits for MIDI messages
+    max_frame_rate = DEFAULT_MAX_FRAME_RATE  # Most Light Guide frames sent per second
+    max_coalesce = DEFAULT_MAX_COALESCE      # Longest time (s) to gather MIDI messages into one frame
+    palette_metric = METRIC_WEIGHTED  # Color distance used to map colors to the MK2 palette
+    receiver = None                # MIDIReceiver of the listener thread while listening
+    stats = None                   # EngineStats of the MIDI events for the current connection
+    stats_file = ""                # File stats snapshots are appended to, none if empty
+    stats_interval = 10.0          # Seconds between stats snapshots written to stats_file
+    stats_dumper = None            # StatsDumper writing to stats_file
+    trace_file = ""                # File MIDI events and frames are traced to, none if empty
+    trace_size = DEFAULT_TRACE_SIZE  # Size (MB) of the trace's ring buffer
+    trace = None                   # TraceRecorder while connected, or None if not tracing
+
+    def __init__(self, prefs=None, transport_factory=None, open_input=None, enumerate_devices=None):
+        self.transport_factory = transport_factory if transport_factory else self.HIDTransportFactory
+        self.open_input = open_input
+        # Keyboards are only looked for on the USB bus when they are opened through hidapi
+        if enumerate_devices:
+            self.enumerate_devices = enumerate_devices
+        elif not transport_factory:
+            self.enumerate_devices = lambda: enumerateDevices(NI_HID_ID)
+        self.session_lock = threading.RLock()
+        self.palette_lock = threading.Lock()
+        if prefs:
+            self.wait_strategy = prefs['waitstrategy']
+            self.max_frame_rate = prefs['maxframerate']
+            self.max_coalesce = prefs['maxcoalescems'] / 1000.0
+            self.palette_metric = prefs['palettemetric']
+            self.stats_file = prefs['statsfile']
+            self.stats_interval = prefs['statsinterval']
+            self.attract_delay = prefs['attractdelay']
+            self.reconnect_interval = prefs['reconnectinterval']
+            self.velocity_brightness = prefs['velocitybrightness']
+            self.fade_time = prefs['fadetime']
+            self.glow = prefs['glow']
+            self.midi_port = prefs['midiport']
+            self.trace_file = prefs['tracefile']
+            self.trace_size = prefs['tracesize']
+
+    def start(self, model_index, colors, port_name=None):
+        """Connects to the keyboard and MIDI port and starts the listener
+           thread - colors is a list of RGB strings in MIDI channel order.
+           Raises STKKError if the keyboard or MIDI port can't be opened"""
+        self.mirror_all = False
+        self.startKeyboards([(model_index, None)], colors, port_name)
+
+    def startDetected(self, model_index, colors, port_name=None):
+        """Like start, but the model is detected from the keyboard that is
+           plugged in - model_index is preferred if several are, and used
+           if none are found"""
+        keyboards = self.findKeyboards()
+        selected = [keyboard for keyboard in keyboards if keyboard[0] == model_index]
+        self.mirror_all = False
+        self.startKeyboards((selected + keyboards + [(model_index, None)])[:1], colors, port_name)
+
+    def startAll(self, colors, port_name=None):
+        """Like start, but lights every Komplete Kontrol keyboard that is
+           connected, and any plugged in later. Keyboards that can't be
+           opened are listed in skipped_keyboards, STKKError is raised
+           only if none can be"""
+        keyboards = self.findKeyboards()
+        if not keyboards:
+            raise STKKError("Could not connect to KK", "No Komplete Kontrol keyboards found")
+        self.mirror_all = True
+        self.startKeyboards(keyboards, colors, port_name, skip_failed=True)
+
+    def findKeyboards(self):
+        """Returns a (model index, hidapi path) tuple for each supported
+           keyboard plugged in, empty if they can't be looked for"""
+        if not self.enumerate_devices:
+            return []
+        try:
+            return findKeyboards(self.enumerate_devices())
+        except Exception:
+            return []
+
+    def startKeyboards(self, keyboards, colors, port_name=None, skip_failed=False):
+        """Connects to a list of (model index, hidapi path) keyboards and
+           the MIDI port, and starts the listener thread"""
+        if self.connected:
+            return
+        if not self.setKeyboards(keyboards, colors):
+            raise STKKError("Unknown keyboard", "Unknown keyboard model: " +
+                            ', '.join(str(keyboard[0]) for keyboard in keyboards))
+        self.connectToKeyboard(skip_failed)
+        try:
+            self.findMIDIPort(port_name)
+        except STKKError:
+            self.disconnectFromKeyboard()
+            raise
+        self.connected = True
+        self.listen = True
+        self.frames_written = 0
+        self.frames_skipped = 0
+        self.lightsOut()
+        if self.stats_file:
+            self.stats_dumper = StatsDumper(self.statsSnapshot, self.stats_file, self.stats_interval)
+            self.stats_dumper.start()
+        self.thread_handle = threading.Thread(target=self.lightKeyboardThread, args=())
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+        self.session = self.makeSession()
+        if self.session:
+            self.session.start()
+
+    def makeSession(self):
+        """Returns a DeviceSession watching the keyboards, or None if
+           they can't be looked for or reconnecting is turned off"""
+        if not self.enumerate_devices or self.reconnect_interval <= 0:
+            return None
+        return DeviceSession(self, self.enumerate_devices, self.reconnect_interval, self.mirror_all)
+
+    def listening(self):
+        """Returns True while the listener is running"""
+        return self.thread_handle is not None and self.thread_handle.is_alive()
+
+    def stop(self):
+        """Stops the listener thread, which disconnects from the keyboard"""
+        if self.session:
+            self.session.stop()
+            self.session = None
+        self.listen = False
+        self.connected = False # Disconnect from keyboard is handled in thread
+        if self.thread_handle:
+            self.thread_handle.join()
+            self.thread_handle = None
+        if self.stats_dumper:
+            self.stats_dumper.stop()
+            self.stats_dumper = None
+
+    def setAttributes(self, model_index, colors):
+        """Sets the object's attributes based on KK model"""
+        return self.setKeyboards([(model_index, None)], colors)
+
+    def setKeyboards(self, keyboards, colors):
+        """Creates an output for each (model index, hidapi path) keyboard
+           and builds the note tables - returns False if a model is unknown"""
+        outputs = self.makeOutputs(keyboards, colors)
+        if not outputs:
+            return False
+        self.colors = list(colors)
+        self.outputs = outputs
+        self.model = self.outputs[0].model
+        self.note_channels = bytearray(128)
+        self.note_velocities = bytearray(128)
+        self.note_on_table, self.note_off_table = self.buildNoteTables(self.outputs)
+        return True
+
+    def makeOutputs(self, keyboards, colors):
+        """Returns a KeyboardOutput for each (model index, hidapi path)
+           keyboard, or None if a model is unknown"""
+        for model_index, path in keyboards:
+            if model_index < 0 or model_index >= len(KK_MODELS):
+                return None
+        models = [KK_MODELS[model_index] for model_index, path in keyboards]
+        color_lists = self.mapColors(colors, models)
+        return [KeyboardOutput(model, color_lists[model.buffer_scale], path, self.sweep_loops,
+                               self.attract_delay, self.makeEffects(model)) for model, (model_index, path) in zip(models, keyboards)]
+
+    def mapColors(self, colors, models):
+        """Maps a list of RGB strings to the colors written into the lights
+           buffer, once for each buffer layout the models use - returns a
+           dictionary from buffer scale to a list of bytes"""
+        color_lists = {}
+        compiled = self.profile and self.profile.matches(colors, self.palette_metric)
+        for model in models:
+            if model.buffer_scale not in color_lists:
+                if compiled:
+                    # Mapped when the profile was compiled
+                    color_lists[model.buffer_scale] = self.profile.color_lists[model.buffer_scale]
+                    continue
+                if model.buffer_scale == 1:
+                    color_list = self.colorsToPaletteList(colors)
+                else:
+                    color_list = self.colorsToRGBList(colors)
+                color_lists[model.buffer_scale] = [bytes(color) for color in color_list]
+        return color_lists
+
+    def buildNoteTables(self, outputs, color_lists=None):
+        """Returns the (note on, note off) lookup tables that map each MIDI
+           velocity, channel and note to the buffer patches that light or
+           darken its key on every output. Notes outside a keyboard's range
+           and channels without a color have no patch for that keyboard.
+           color_lists maps a buffer scale to the colors to use instead of
+           the outputs' own"""
+        key_patches = []
+        for output in outputs:
+            color_list = color_lists[output.model.buffer_scale] if color_lists else output.color_list
+            key_patches.append((output, color_list, output.keyPatches()))
+
+        note_off_table = []
+        for note in range(128):
+            note_off_table.append(tuple((patches[note], output.off_color, output)
+                                        for output, color_list, patches in key_patches if patches[note]))
+
+        # One table per brightness level, dimmed colors are computed here
+        # so a note costs the same lookup at any velocity
+        levels = VELOCITY_LEVELS if self.velocity_brightness else 1
+        level_tables = []
+        for level in range(levels):
+            brightness = velocityBrightness(level, levels)
+            level_table = []
+            for channel in range(16):
+                channel_table = []
+                for note in range(128):
+                    channel_table.append(tuple(
+                        (patches[note], dimColor(color_list[channel], output.model.buffer_scale, brightness), output)
+                        for output, color_list, patches in key_patches
+                        if patches[note] and channel < len(color_list)))
+                level_table.append(channel_table)
+            level_tables.append(level_table)
+
+        # Velocity 0 note on messages end notes, so they share the note off patches
+        note_on_table = [[note_off_table] * 16]
+        for velocity in range(1, 128):
+            note_on_table.append(level_tables[velocity * levels // 128])
+        return note_on_table, note_off_table
+
+    def setColors(self, colors):
+        """Changes the colors, also while connected. The new tables,
+           including MK2 palette mapping, are built on the calling thread
+           and swapped in on the listener thread between two messages,
+           with the keys that are lit repainted in a single frame. The
+           session lock keeps the keyboards from changing until the swap is
+           queued, and keyboards swapped in later are made with the new
+           colors"""
+        with self.session_lock:
+            self.colors = list(colors)
+            outputs = self.outputs
+            color_lists = self.mapColors(colors, [output.model for output in outputs])
+            note_on_table = self.buildNoteTables(outputs, color_lists)[0]
+
+            def swapColors():
+                if self.outputs is not outputs:
+                    return
+                for output in outputs:
+                    output.color_list = color_lists[output.model.buffer_scale]
+                self.note_on_table = note_on_table
+                self.repaintLitKeys()
+            self.runOnListener(swapColors)
+
+    def applyProfile(self, profile):
+        """Switches to a compiled Profile, also while connected. Its colors
+           are already mapped, so nothing is parsed or mapped. While
+           connected the colors and velocity brightness change at once, and
+           the model too unless every keyboard is lit. Fade and glow
+           settings are used from the next connect"""
+        self.profile = profile
+        self.palette_metric = profile.palette_metric
+        self.velocity_brightness = profile.velocity_brightness
+        self.fade_time = profile.fade_time
+        self.glow = profile.glow
+        if not self.connected:
+            self.colors = list(profile.colors)
+            return
+        self.setColors(profile.colors)
+        if not self.mirror_all and self.model != KK_MODELS[profile.model_index]:
+            self.changeKeyboards([(profile.model_index, None)])
+
+    def changeKeyboards(self, keyboards, skip_failed=False):
+        """Switches to another list of (model index, hidapi path) keyboards
+           while connected, without restarting the MIDI listener. The new
+           keyboards are opened and their tables built on the calling
+           thread - if none can be opened STKKError is raised and the old
+           keyboards are kept. Otherwise the new keyboards are swapped in on
+           the listener thread, showing the lit keys, and the old ones are
+           darkened and closed. If the listener doesn't swap them in within
+           SWAP_TIMEOUT the new keyboards are closed, the old ones kept, and
+           STKKError is raised"""
+        if not self.connected:
+            if not self.setKeyboards(keyboards, self.colors):
+                raise STKKError("Unknown keyboard", "Unknown keyboard model: " +
+                                ', '.join(str(keyboard[0]) for keyboard in keyboards))
+            return
+        with self.session_lock:
+            outputs = self.makeOutputs(keyboards, self.colors)
+            if not outputs:
+                raise STKKError("Unknown keyboard", "Unknown keyboard model: " +
+                                ', '.join(str(keyboard[0]) for keyboard in keyboards))
+            outputs, self.skipped_keyboards = self.connectOutputs(outputs, skip_failed)
+            note_on_table, note_off_table = self.buildNoteTables(outputs)
+            old_outputs = self.outputs
+
+            def swapKeyboards():
+                for output in old_outputs:
+                    output.animator.stop()
+                    output.blank()
+                    output.submitFrame()
+                self.outputs = outputs
+                self.model = outputs[0].model
+                self.note_on_table = note_on_table
+                self.note_off_table = note_off_table
+                for output in outputs:
+                    self.startAnimator(output)
+                    output.lights_dirty = True
+                self.repaintLitKeys()
+            if not self.swapOnListener(swapKeyboards):
+                for output in outputs:
+                    output.disconnect()
+                raise STKKError("Could not change keyboard",
+                                "The MIDI listener did not switch to the new keyboard in time")
+            for output in old_outputs:
+                output.disconnect()
+
+    def reconnectOutput(self, output, path):
+        """Reopens an offline or failing keyboard at its (possibly new)
+           hidapi path, see KeyboardOutput.reconnect - returns True if it
+           was reconnected"""
+        with self.session_lock:
+            try:
+                output.reconnect(self.makeTransport(output.model, path))
+            except STKKError:
+                return False
+            output.path = path
+            return True
+
+    def addDevices(self, devices):
+        """Lights newly plugged in (product ID, hidapi path) devices as
+           well as the current keyboards, while connected. If the listener
+           doesn't swap them in within SWAP_TIMEOUT they are closed again,
+           to be found on a later look at the USB bus"""
+        keyboards = findKeyboards(devices)
+        if not keyboards or not self.connected:
+            return
+        with self.session_lock:
+            outputs = self.makeOutputs(keyboards, self.colors)
+            try:
+                outputs, skipped = self.connectOutputs(outputs, skip_failed=True)
+            except STKKError:
+                return
+            all_outputs = self.outputs + outputs
+            note_on_table, note_off_table = self.buildNoteTables(all_outputs)
+
+            def swapKeyboards():
+                self.outputs = all_outputs
+                self.note_on_table = note_on_table
+                self.note_off_table = note_off_table
+                for output in outputs:
+                    self.startAnimator(output)
+                    output.lights_dirty = True
+                self.repaintLitKeys()
+            if not self.swapOnListener(swapKeyboards):
+                for output in outputs:
+                    output.disconnect()
+
+    def swapOnListener(self, func):
+        """Runs func() on the listener thread, see runOnListener, waiting
+           up to SWAP_TIMEOUT for it to run. Returns True once it has run,
+           or False if the listener didn't get to it in time - func then
+           never runs"""
+        claim = threading.Lock()
+        def claimed():
+            if claim.acquire(False):
+                func()
+        done = self.runOnListener(claimed)
+        if done.wait(SWAP_TIMEOUT):
+            return claim.locked()
+        if claim.acquire(False):
+            return False
+        # The listener got to it just now, let it finish
+        done.wait()
+        return True
+
+    def runOnListener(self, func):
+        """Runs func() on the listener thread between two messages, or
+           right away if not listening. Returns a threading.Event that is
+           set once func has run"""
+        done = threading.Event()
+        def call():
+            try:
+                func()
+            finally:
+                done.set()
+        receiver = self.receiver
+        if self.connected and receiver:
+            receiver.callSoon(call)
+        else:
+            call()
+        return done
+
+    def repaintLitKeys(self):
+        """Patches every lit note's key with its current color on every
+           output, for after the colors or keyboards change"""
+        for note, lit in enumerate(self.note_channels):
+            if lit:
+                for view, color, output in self.note_on_table[self.note_velocities[note]][lit - 1][note]:
+                    if view != color:
+                        view[:] = color
+                        output.lights_dirty = True
+
+    def makeTransport(self, model, path=None):
+        """Returns an unopened transport for a keyboard from the transport
+           factory, recording its writes to the trace if tracing"""
+        transport = self.transport_factory(model, path)
+        if self.trace:
+            transport = TracingTransport(transport, self.trace, KK_MODELS.index(model))
+        return transport
+
+    def openTrace(self):
+        """Opens the trace file, if tracing, and marks a new session in
+           it. Lighting the keyboards goes on without a trace if the file
+           can't be opened or written - tracing never stops a connect"""
+        if self.trace_file and not self.trace:
+            try:
+                self.trace = TraceRecorder(self.trace_file, self.trace_size)
+            except Exception:
+                self.trace = None
+        if self.trace:
+            try:
+                self.trace.session([KK_MODELS.index(output.model) for output in self.outputs])
+            except Exception:
+                trace = self.trace
+                self.trace = None
+                try:
+                    trace.close()
+                except Exception:
+                    pass
+
+    def closeTrace(self):
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+
+    def HIDTransportFactory(self, model, path=None):
+        """Returns a transport for a keyboard connected through hidapi"""
+        return HIDTransport(NI_HID_ID, model.hid_id, path)
+
+    def connectToKeyboard(self, skip_failed=False):
+        """Attempts to connect to every keyboard through its transport. If
+           skip_failed is True keyboards that can't be opened are dropped,
+           otherwise the first failure disconnects the rest and is raised"""
+        self.stats = EngineStats()
+        self.openTrace()
+        try:
+            opened, self.skipped_keyboards = self.connectOutputs(self.outputs, skip_failed)
+        except STKKError:
+            self.closeTrace()
+            raise
+        if len(opened) < len(self.outputs):
+            self.outputs = opened
+            self.model = self.outputs[0].model
+            self.note_on_table, self.note_off_table = self.buildNoteTables(self.outputs)
+
+    def connectOutputs(self, outputs, skip_failed=False):
+        """Connects a list of outputs and returns (opened outputs, errors
+           of skipped keyboards). Raises STKKError if none can be opened,
+           or on the first failure if skip_failed is False"""
+        skipped = []
+        opened = []
+        for output in outputs:
+            try:
+                output.connect(self.makeTransport(output.model, output.path), self.frame_writer_factory)
+            except STKKError as e:
+                if not skip_failed:
+                    for opened_output in opened:
+                        opened_output.disconnect()
+                    raise
+                skipped.append(output.model.short_name + ': ' + str(e))
+            else:
+                opened.append(output)
+        if not opened:
+            raise STKKError("Could not connect to KK", '\n'.join(skipped))
+        return opened, skipped
+
+    def disconnectFromKeyboard(self):
+        """Writes any waiting frames, stops the frame writers and closes the keyboards"""
+        for output in self.outputs:
+            output.disconnect()
+        self.closeTrace()
+
+    def findMIDIPort(self, port_name=None):
+        """Looks for the LoopBe1 MIDI port, or another loopback port, unless
+           a port list is given or set in the prefs. A port list is port
+           names or wildcard patterns separated by commas, all of which
+           are listened to. Names of the form udp:[HOST][:PORT] receive
+           MIDI over the network, see STKKNet"""
+        import mido # The MIDI backend is only loaded once it is needed
+        port_name = port_name or self.midi_port
+        if port_name:
+            if not any(isPortPattern(name) for name in splitPorts(port_name)):
+                self.port_name = port_name
+                return
+            try:
+                self.port_name = resolvePorts(port_name, mido.get_input_names())
+            except ValueError as e:
+                raise STKKError("MIDI Port Error", str(e))
+            return
+        self.port_name = findLoopbackPort(mido.get_input_names())
+        if self.port_name == "":
+            raise STKKError("MIDI Port Error",
+                "Please install LoopBe1 from http://www.nerds.de/en/download.html.")
+
+    def lightsOut(self):
+        """Turn off all lights"""
+        self.note_channels[:] = bytes(128)
+        for output in self.outputs:
+            output.blank()
+        self.writeLightsBuffer(True)
+
+    def MIDIMsgToLightGuide(self, note, status, channel, velocity):
+        """Use MIDI messages to update KK's Light Guide"""
+
+        # Turn off light
+        if status == 'note_off':
+            patches = self.note_off_table[note]
+            self.note_channels[note] = 0
+
+        # Turn on light, at the brightness for the velocity if enabled
+        elif status == 'note_on':
+            patches = self.note_on_table[velocity][channel][note]
+            self.note_channels[note] = channel + 1 if velocity else 0
+            self.note_velocities[note] = velocity
+        else:
+            return
+
+        # Patch the key's color into each keyboard's buffer if it changed
+        for view, color, output in patches:
+            if view != color:
+                view[:] = color
+                output.lights_dirty = True
+
+    def writeLightsBuffer(self, force = False):
+        """Sends a copy of each keyboard's lights buffer to its frame
+           writer if it changed since the last frame was sent, or if force
+           is True - returns True if a frame was sent. Never blocks on USB"""
+        stamp = None
+        for output in self.outputs:
+            if output.lights_dirty or force:
+                if stamp is None:
+                    stamp = self.stats.frameSubmitted()
+                output.submitFrame(stamp)
+        if stamp is None:
+            self.frames_skipped += 1
+            return False
+        self.frames_written += 1
+        if self.effect_ticker:
+            # Released keys may have started fading
+            self.effect_ticker.poke()
+        return True
+
+    def lightKeyboardThread(self):
+        """Threaded method to update KK Light Guide"""
+        # Animations play alongside MIDI handling, so no notes are
+        # lost while the connect sweep is showing
+        self.last_event_time = 0.0
+        for output in self.outputs:
+            self.startAnimator(output)
+            if self.sweep_loops > 0:
+                output.animator.play(output.sweep_animation)
+        self.startEffects()
+        self.receiver = MIDIReceiver(self.port_name, self.MIDIMessageHandler, self.writeLightsBuffer,
+                                     self.wait_strategy, max_frame_rate=self.max_frame_rate,
+                                     max_coalesce=self.max_coalesce, open_input=self.open_input,
+                                     stats=self.stats)
+        try:
+            self.receiver.run(lambda: self.listen)
+        except Exception:
+            # MIDI input failed, flash the keyboards red before disconnecting
+            self.flashError()
+            raise
+        finally:
+            self.receiver = None
+            for output in self.outputs:
+                output.animator.stop()
+            self.stopEffects()
+            self.lightsOut()
+            self.disconnectFromKeyboard()
+
+    def startAnimator(self, output):
+        """Creates and starts the animator of an output"""
+        output.animator = Animator(output.writeAnimationFrame, self.liveActive, output.restoreLiveFrame,
+                                   output.attract_animation, self.attract_delay)
+        output.animator.start()
+
+    def effectsOn(self):
+        """Returns True if fade or glow effects are set and NumPy,
+           which they need, is installed"""
+        return EFFECTS_AVAILABLE and (self.fade_time > 0 or self.glow > 0)
+
+    def makeEffects(self, model):
+        """Returns an EffectStage for a keyboard model, or None if effects are off"""
+        if not self.effectsOn():
+            return None
+        return EffectStage(model, int(round(self.fade_time / EFFECT_TICK)), self.glow)
+
+    def startEffects(self):
+        """Starts the effect ticker if effects are on"""
+        if self.effectsOn():
+            self.effect_ticker = EffectTicker(self.tickEffects)
+            self.effect_ticker.start()
+
+    def stopEffects(self):
+        """Stops the effect ticker"""
+        if self.effect_ticker:
+            self.effect_ticker.stop()
+            self.effect_ticker = None
+
+    def tickEffects(self):
+        """Advances every keyboard's effects one tick, returns True while
+           keys are fading. Called by the effect ticker"""
+        fading = False
+        for output in self.outputs:
+            if output.effects and output.tickEffects():
+                fading = True
+        return fading
+
+    def liveActive(self):
+        """Returns True while live notes should have the keyboards - any
+           key is lit or a MIDI event arrived in the last live_hold seconds"""
+        return (time.perf_counter() - self.last_event_time < self.live_hold or
+                any(output.lit() for output in self.outputs))
+
+    def flashError(self):
+        """Flashes every key red, returning when the flash is done"""
+        for output in self.outputs:
+            output.animator.play(output.flash_animation)
+        timeout = time.perf_counter() + len(self.outputs[0].flash_animation.frames) * FLASH_INTERVAL + 1.0
+        while (any(output.animator.playing() for output in self.outputs) and
+               time.perf_counter() < timeout):
+            time.sleep(FLASH_INTERVAL)
+
+    def statsSnapshot(self):
+        """Returns a dictionary of the current connection's counters and
+           latencies, see EngineStats.snapshot. Frame counts and latencies
+           are combined over every keyboard, and listed per keyboard under
+           'keyboards' when more than one is lit"""
+        if not self.stats:
+            return None
+        snapshot = self.stats.snapshot()
+        output_latency = LatencyHistogram()
+        total_latency = LatencyHistogram()
+        snapshot['frames'] = 0
+        snapshot['frames_dropped'] = 0
+        snapshot['write_errors'] = 0
+        keyboards = []
+        for output in self.outputs:
+            if not output.stats:
+                continue
+            output_latency.merge(output.stats.output_latency)
+            total_latency.merge(output.stats.total_latency)
+            snapshot['frames'] += output.stats.frames
+            frame_writer = output.frame_writer
+            if frame_writer:
+                snapshot['frames_dropped'] += frame_writer.frames_dropped
+                snapshot['write_errors'] += frame_writer.write_errors
+                keyboards.append({'model': output.model.short_name,
+                                  'frames': output.stats.frames,
+                                  'frames_dropped': frame_writer.frames_dropped,
+                                  'write_errors': frame_writer.write_errors,
+                                  'total': output.stats.total_latency.summary()})
+        snapshot['output'] = output_latency.summary()
+        snapshot['total'] = total_latency.summary()
+        snapshot['frames_sent'] = self.frames_written
+        snapshot['frames_skipped'] = self.frames_skipped
+        if len(keyboards) > 1:
+            snapshot['keyboards'] = keyboards
+        snapshot['offline'] = [output.model.short_name for output in self.outputs if not output.online]
+        # The listener clears receiver when it stops, so it is read once
+        receiver = self.receiver
+        port = receiver.port if receiver else None
+        if hasattr(port, 'sourceStats'):
+            snapshot['sources'] = port.sourceStats()
+        network = port.networkStats() if hasattr(port, 'networkStats') else None
+        if network:
+            snapshot['network'] = network
+        return snapshot
+
+    def MIDIMessageHandler(self, message):
+        """Passes a received note message on to the Light Guide"""
+        self.last_event_time = time.perf_counter()
+        if self.trace:
+            self.trace.noteEvent(message)
+        self.MIDIMsgToLightGuide(message.note, message.type, message.channel, message.velocity)
+
+    def displayPaletteIndex(self, index):
+        """Displays a palette index on the first 12 keys of every MK2
+           keyboard, on the calibration layer over the live lights"""
+        # Make sure the keyboard is connected
+        if not self.connected:
+            return
+        # If the passed index is not an int, convert it
+        if not isinstance(index, int):
+            index = int(index, 16)
+        # Create the color
+        indexColor = bytes((index,))
+        # Display the palette index in the first 12 keys
+        for output in self.outputs:
+            if output.model.buffer_scale == 1:
+                output.showLayerKeys(LAYER_CALIBRATION, {i: indexColor for i in range(0, 12)})
+
+    def clearPaletteIndex(self):
+        """Removes the palette index shown by displayPaletteIndex"""
+        for output in self.outputs:
+            output.clearLayer(LAYER_CALIBRATION)
+
+    def colorsToRGBList(self, colors):
+        """Takes a list of RGB strings and returns a list of
+            7-bit RGB tuples"""
+        return [RGBStringToTuple(color) for color in colors]
+
+    def colorsToPaletteList(self, colors):
+        """Takes a list of RGB strings and returns a list of
+        one element tuples containing the colors mapped to palette indices"""
+        with self.palette_lock:
+            return mapColorsToPalette(colors, readPaletteMap(PALETTE_FILE), self.palette_metric)
+
+    def preparePalette(self):
+        """Loads the palette map and its palette cube on a background
+           thread, building the cube if it isn't cached yet, so that
+           connecting to an MK2 doesn't wait for them"""
+        thread = threading.Thread(target=self.colorsToPaletteList, args=([],))
+        thread.daemon = True
+        thread.start()
+
+def velocityBrightness(level, levels):
+    """Returns the brightness (0 to 1) of a velocity brightness level -
+       brightness rises with the square of the level, as the eye is more
+       sensitive to changes in dim light"""
+    if levels <= 1:
+        return 1.0
+    return VELOCITY_FLOOR + (1.0 - VELOCITY_FLOOR) * ((level + 1.0) / levels) ** 2
+
+def dimColor(color, buffer_scale, brightness):
+    """Returns a buffer color (bytes) dimmed to a brightness - MK1 RGB
+       values are scaled, MK2 palette indices step down their group of
+       brightnesses"""
+    if brightness >= 1.0:
+        return color
+    if buffer_scale == 1:
+        steps = int(round((1.0 - brightness) * (PALETTE_GROUP_SIZE - 1)))
+        return bytes((dimPaletteIndex(color[0], steps),))
+    return bytes(scaleRGB(color, brightness))
+
+def readUserPrefs(filename=CONFIG_FILE):
+    """Reads user preferences from STKKConfig.ini"""
+    prefs = {}
+
+    prefs_file = cfg.ConfigParser()
+    files = prefs_file.read(filename)
+    if len(files) == 1 and 'UserPrefs' in prefs_file:
+        up = prefs_file['UserPrefs']
+        prefs['selectedkeyboard'] = up.getint('selectedkeyboard', fallback=3)
+        prefs['defaultcolor'] = up.get('defaultcolor', fallback='#ff0000')
+        prefs['leftthumb'] = up.get('leftthumb', fallback='#00ff00')
+        prefs['leftindex'] = up.get('leftindex', fallback='#00ff00')
+        prefs['leftmiddle'] = up.get('leftmiddle', fallback='#00ff00')
+        prefs['leftring'] = up.get('leftring', fallback='#00ff00')
+        prefs['leftpinky'] = up.get('leftpinky', fallback='#00ff00')
+        prefs['lefthand'] = up.get('lefthand', fallback='#00ff00')
+        prefs['rightthumb'] = up.get('rightthumb', fallback='#0000ff')
+        prefs['rightindex'] = up.get('rightindex', fallback='#0000ff')
+        prefs['rightmiddle'] = up.get('rightmiddle', fallback='#0000ff')
+        prefs['rightring'] = up.get('rightring', fallback='#0000ff')
+        prefs['rightpinky'] = up.get('rightpinky', fallback='#0000ff')
+        prefs['righthand'] = up.get('righthand', fallback='#0000ff')
+        prefs['waitstrategy'] = up.get('waitstrategy', fallback=WAIT_BLOCKING)
+        if prefs['waitstrategy'] not in WAIT_STRATEGIES:
+            prefs['waitstrategy'] = WAIT_BLOCKING
+        prefs['maxframerate'] = up.getfloat('maxframerate', fallback=DEFAULT_MAX_FRAME_RATE)
+        prefs['maxcoalescems'] = up.getfloat('maxcoalescems', fallback=DEFAULT_MAX_COALESCE * 1000.0)
+        prefs['palettemetric'] = up.get('palettemetric', fallback=METRIC_WEIGHTED)
+        if prefs['palettemetric'] not in PALETTE_METRICS:
+            prefs['palettemetric'] = METRIC_WEIGHTED
+        prefs['statsfile'] = up.get('statsfile', fallback='')
+        prefs['statsinterval'] = up.getfloat('statsinterval', fallback=10.0)
+        prefs['attractdelay'] = up.getfloat('attractdelay', fallback=0.0)
+        prefs['mirrorall'] = up.getboolean('mirrorall', fallback=False)
+        prefs['runtime'] = up.get('runtime', fallback=RUNTIME_THREADS)
+        if prefs['runtime'] not in RUNTIMES:
+            prefs['runtime'] = RUNTIME_THREADS
+        prefs['reconnectinterval'] = up.getfloat('reconnectinterval', fallback=DEFAULT_RECONNECT_INTERVAL)
+        prefs['velocitybrightness'] = up.getboolean('velocitybrightness', fallback=False)
+        prefs['fadetime'] = up.getfloat('fadetime', fallback=0.0)
+        prefs['glow'] = min(max(up.getfloat('glow', fallback=0.0), 0.0), 1.0)
+        prefs['profile'] = up.get('profile', fallback='')
+        prefs['midiport'] = up.get('midiport', fallback='')
+        prefs['tracefile'] = up.get('tracefile', fallback=TRACE_FILE)
+        prefs['tracesize'] = max(up.getfloat('tracesize', fallback=DEFAULT_TRACE_SIZE), 0.1)
+    else:
+        # STKKConfig.ini not found, set defaults
+        prefs['selectedkeyboard'] = 3
+        prefs['defaultcolor'] = '#ff0000'
+        prefs['leftthumb'] = '#00ffff'
+        prefs['leftindex'] = '#0099ff'
+        prefs['leftmiddle'] = '#0000ff'
+        prefs['leftring'] = '#6600ff'
+        prefs['leftpinky'] = '#ff00ff'
+        prefs['lefthand'] = '#0000ff'
+        prefs['rightthumb'] = '#ff8000'
+        prefs['rightindex'] = '#ffd900'
+        prefs['rightmiddle'] = '#b3ff00'
+        prefs['rightring'] = '#00ff00'
+        prefs['rightpinky'] = '#00ffbf'
+        prefs['righthand'] = '#00ff00'
+        prefs['waitstrategy'] = WAIT_BLOCKING
+        prefs['maxframerate'] = DEFAULT_MAX_FRAME_RATE
+        prefs['maxcoalescems'] = DEFAULT_MAX_COALESCE * 1000.0
+        prefs['palettemetric'] = METRIC_WEIGHTED
+        prefs['statsfile'] = ''
+        prefs['statsinterval'] = 10.0
+        prefs['attractdelay'] = 0.0
+        prefs['mirrorall'] = False
+        prefs['runtime'] = RUNTIME_THREADS
+        prefs['reconnectinterval'] = DEFAULT_RECONNECT_INTERVAL
+        prefs['velocitybrightness'] = False
+        prefs['fadetime'] = 0.0
+        prefs['glow'] = 0.0
+        prefs['profile'] = ''
+        prefs['midiport'] = ''
+        prefs['tracefile'] = TRACE_FILE
+        prefs['tracesize'] = DEFAULT_TRACE_SIZE
+
+    return prefs
+
+def writeUserPrefs(prefs, filename=CONFIG_FILE):
+    """Writes user preferences to STKKConfig.ini"""
+    config = cfg.ConfigParser()
+    config['UserPrefs'] = {}
+    up = config['UserPrefs']
+    for key in prefs:
+        up[key] = str(prefs[key])
+    with open(filename, 'w') as configfile:
+        config.write(configfile)
+
+def findModel(model):
+    """Takes a model index, short name (e.g. S61MK2) or full name
+       and returns its index in KK_MODELS, or -1 if not found"""
+    for index, kk_model in enumerate(KK_MODELS):
+        if model.lower() in (str(index), kk_model.short_name.lower(), kk_model.name.lower()):
+            return index
+    return -1
+
+def findKeyboards(devices=None):
+    """Returns a (model index, hidapi path) tuple for each supported
+       Komplete Kontrol keyboard in a list of (product ID, hidapi path)
+       devices, or plugged in if devices is None"""
+    if devices is None:
+        devices = enumerateDevices(NI_HID_ID)
+    model_indexes = {kk_model.hid_id: index for index, kk_model in enumerate(KK_MODELS)}
+    return [(model_indexes[product_id], path) for product_id, path in devices
+            if product_id in model_indexes]
+
+def main(argv=None):
+    """Runs the Light Guide engine without a GUI until interrupted"""
+    parser = argparse.ArgumentParser(description='Light the Komplete Kontrol Light Guide from Synthesia without a GUI')
+    parser.add_argument('--config', default=CONFIG_FILE, help='user prefs file (default %(default)s)')
+    parser.add_argument('--model', help='keyboard model index or name, e.g. S61MK2 (default detected)')
+    parser.add_argument('--port', help='MIDI input port names or wildcard patterns separated by commas, udp:[HOST][:PORT] '
+                        'to receive over the network (default LoopBe)')
+    parser.add_argument('--all', action='store_true', help='light every connected keyboard (default from prefs)')
+    parser.add_argument('--strategy', choices=WAIT_STRATEGIES, help='MIDI wait strategy (default from prefs)')
+    parser.add_argument('--stats-file', help='file to append latency stats to (default from prefs)')
+    parser.add_argument('--runtime', choices=RUNTIMES, help='threads or an asyncio event loop (default from prefs)')
+    parser.add_argument('--profile', help='name of a profile in STKKProfiles.ini to use (default from prefs)')
+    args = parser.parse_args(argv)
+
+    prefs = readUserPrefs(args.config)
+    profile = None
+    if args.profile or prefs['profile']:
+        from STKKProfiles import ProfileStore
+        try:
+            profile = ProfileStore().get(args.profile or prefs['profile'])
+        except KeyError as e:
+            print('Profile error: ' + e.args[0], file=sys.stderr)
+            return 1
+        prefs.update(profile.prefs())
+    if args.strategy:
+        prefs['waitstrategy'] = args.strategy
+    if args.stats_file:
+        prefs['statsfile'] = args.stats_file
+    if args.runtime:
+        prefs['runtime'] = args.runtime
+    model_index = prefs['selectedkeyboard']
+    if args.model:
+        model_index = findModel(args.model)
+        if model_index < 0:
+            parser.error('unknown model ' + args.model + ', choose from ' +
+                         ', '.join(kk_model.short_name for kk_model in KK_MODELS))
+
+    if prefs['runtime'] == RUNTIME_ASYNCIO:
+        from STKKAsync import AsyncLightGuideEngine
+        engine = AsyncLightGuideEngine(prefs)
+    else:
+        engine = LightGuideEngine(prefs)
+    if profile:
+        engine.applyProfile(profile)
+    colors = [prefs[key] for key in COLOR_KEYS]
+    try:
+        if args.all or prefs['mirrorall']:
+            engine.startAll(colors, args.port)
+        elif args.model:
+            engine.start(model_index, colors, args.port)
+        else:
+            engine.startDetected(model_index, colors, args.port)
+    except STKKError as e:
+        print(e.title + ': ' + str(e), file=sys.stderr)
+        return 1
+    for skipped in engine.skipped_keyboards:
+        print('Skipped ' + skipped, file=sys.stderr)
+    if (prefs['fadetime'] > 0 or prefs['glow'] > 0) and not EFFECTS_AVAILABLE:
+        print('Fade and glow effects need NumPy, keys will go dark at once', file=sys.stderr)
+    print('Lighting ' + ', '.join(output.model.name for output in engine.outputs) + ' from ' +
+          engine.port_name + ', press Ctrl+C to stop')
+    try:
+        while engine.thread_handle.is_alive():
+            engine.thread_handle.join(0.5)
+    except KeyboardInterrupt:
+        pass
+    engine.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
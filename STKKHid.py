@@ -0,0 +1,231 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Transports that carry Light Guide frames to a keyboard
+
+import time
+import threading
+
+WRITE_RETRY_INTERVAL = 0.05  # Time (s) before a frame that failed to write is written again
+
+def enumerateDevices(vendor_id):
+    """Returns a (product ID, hidapi path) tuple for each connected device
+       from a vendor. hidapi can list a device once per interface, so only
+       the first path of each product and serial number is kept - the one
+       hid.device().open() would pick"""
+    import hid
+    devices = []
+    seen = set()
+    for info in hid.enumerate(vendor_id, 0):
+        key = (info['product_id'], info['serial_number'] or info['path'])
+        if key not in seen:
+            seen.add(key)
+            devices.append((info['product_id'], info['path']))
+    return devices
+
+class HIDTransport:
+    """Sends Light Guide frames to a Komplete Kontrol keyboard through hidapi"""
+
+    vendor_id = 0    # USB vendor ID of the keyboard
+    product_id = 0   # USB product ID of the keyboard
+    path = None      # hidapi path of the keyboard, None to open the first with the IDs
+    device = None    # hid.device handle, None until opened
+
+    def __init__(self, vendor_id, product_id, path=None):
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.path = path
+
+    def open(self):
+        """Opens the keyboard, raises an exception if it can't be opened"""
+        import hid
+        self.device = hid.device()
+        if self.path:
+            self.device.open_path(self.path)
+        else:
+            self.device.open(self.vendor_id, self.product_id)
+
+    def write(self, data):
+        """Writes a frame to the keyboard and returns the number of
+           bytes written, or -1 on error"""
+        return self.device.write(data)
+
+    def close(self):
+        """Closes the keyboard"""
+        if self.device:
+            self.device.close()
+            self.device = None
+
+class FakeTransport:
+    """In-memory stand-in for a keyboard. Records every frame written
+       with its start and completion times, and can simulate the time
+       a USB write takes"""
+
+    latency = 0.0    # Simulated time (s) each write takes
+    frames = []      # List of (start time, end time, frame bytes), perf_counter() times
+    is_open = False  # Boolean to indicate if open
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.frames = []
+
+    def open(self):
+        self.is_open = True
+
+    def write(self, data):
+        start = time.perf_counter()
+        frame = bytes(data)
+        if self.latency > 0:
+            # Sleep most of the latency, then spin for accuracy
+            if self.latency > 0.002:
+                time.sleep(self.latency - 0.001)
+            while time.perf_counter() - start < self.latency:
+                pass
+        self.frames.append((start, time.perf_counter(), frame))
+        return len(frame)
+
+    def close(self):
+        self.is_open = False
+
+    def lightFrames(self, header_value):
+        """Returns the recorded frames that start with a lights buffer
+           header, skipping commands such as the Light Guide mode switch"""
+        return [frame for frame in self.frames if frame[2][:1] == bytes((header_value,))]
+
+def closeTransport(transport):
+    """Closes a transport, ignoring errors from a keyboard that has gone away"""
+    try:
+        transport.close()
+    except Exception:
+        pass
+
+class FrameWriter:
+    """Owns a transport on its own thread and writes the most recent
+       frame submitted to it. A frame submitted while another is still
+       waiting replaces it, so a slow or stalled USB write drops stale
+       frames instead of queueing them, and submit() never blocks on USB.
+       A frame that fails to write is kept and written again after
+       WRITE_RETRY_INTERVAL, unless a newer one replaces it first"""
+
+    transport = None     # Transport the frames are written to
+    condition = None     # Guards pending, running, writing and retired, signals new frames
+    pending = None       # Newest frame not yet written, or None
+    pending_stamp = None # Stamp submitted with the pending frame
+    on_written = None    # Function called with (stamp, completion time) after each write
+    on_error = None      # Function called after each write that failed
+    retry_at = None      # perf_counter() time to write a failed frame again, or None
+    running = False      # Boolean to control the writer thread
+    thread_handle = None # Handle for the writer thread
+    writing = None       # Transport a write is in flight on, or None
+    retired = []         # Transports replaced during a write, closed once it finishes
+    frames_written = 0   # Number of frames written
+    frames_dropped = 0   # Number of frames replaced before they were written
+    write_errors = 0     # Number of writes that failed
+
+    def __init__(self, transport, on_written=None, on_error=None):
+        self.transport = transport
+        self.on_written = on_written
+        self.on_error = on_error
+        self.condition = threading.Condition()
+        self.retired = []
+
+    def start(self):
+        """Starts the writer thread"""
+        self.running = True
+        self.thread_handle = threading.Thread(target=self.writerThread, args=())
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+
+    def stop(self):
+        """Writes any waiting frame, then stops the writer thread"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread_handle:
+            self.thread_handle.join()
+            self.thread_handle = None
+
+    def replaceTransport(self, transport):
+        """Switches the writer to another transport and closes the old
+           one - on the writer thread once its write has finished if one
+           is in flight, so it is never closed during a write. While the
+           transport is None frames are held, the latest replacing the
+           rest, until a transport is set again"""
+        with self.condition:
+            old = self.transport
+            self.transport = transport
+            if old is not None and old is self.writing:
+                self.retired.append(old)
+                old = None
+            if transport is not None:
+                # Write the waiting frame to the new transport at once
+                self.retry_at = None
+            self.condition.notify()
+        if old is not None:
+            closeTransport(old)
+
+    def submit(self, frame, stamp=None):
+        """Hands a frame (bytes) to the writer thread, replacing any
+           frame still waiting to be written. stamp is an optional
+           (oldest event time, buffer update time) tuple passed to
+           on_written - a replaced frame's older event time is kept"""
+        with self.condition:
+            if self.pending is not None:
+                self.frames_dropped += 1
+                if stamp and self.pending_stamp and self.pending_stamp[0] is not None:
+                    if stamp[0] is None or self.pending_stamp[0] < stamp[0]:
+                        stamp = (self.pending_stamp[0], stamp[1])
+            self.pending = frame
+            self.pending_stamp = stamp
+            self.condition.notify()
+
+    def writerThread(self):
+        """Threaded method that writes frames as they are submitted"""
+        while True:
+            with self.condition:
+                while (self.pending is None or self.transport is None or self.retry_at is not None) and self.running:
+                    if self.retry_at is None:
+                        self.condition.wait()
+                        continue
+                    remaining = self.retry_at - time.perf_counter()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                    else:
+                        self.retry_at = None
+                if self.pending is None or self.transport is None:
+                    return
+                frame = self.pending
+                stamp = self.pending_stamp
+                transport = self.transport
+                self.pending = None
+                self.pending_stamp = None
+                self.writing = transport
+            try:
+                result = transport.write(frame)
+            except Exception:
+                result = -1
+            failed = result is not None and result < 0
+            with self.condition:
+                self.writing = None
+                retired = self.retired
+                self.retired = []
+                if failed:
+                    self.write_errors += 1
+                    if not self.running:
+                        # Stopping, the frame was given its last try
+                        self.pending = None
+                    elif self.pending is None:
+                        # Keep the frame to write again, a newer one replaces it
+                        self.pending = frame
+                        self.pending_stamp = stamp
+                    self.retry_at = time.perf_counter() + WRITE_RETRY_INTERVAL
+                else:
+                    self.frames_written += 1
+            for old in retired:
+                closeTransport(old)
+            if failed:
+                if self.on_error:
+                    self.on_error()
+            elif self.on_written:
+                self.on_written(stamp, time.perf_counter())
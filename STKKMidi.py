@@ -0,0 +1,394 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: MIDI receive engine used by the Light Guide listener
+
+import time
+import queue
+import fnmatch
+import random
+import threading
+from collections import deque
+from STKKNet import UDPMIDIInput, isNetworkPort
+
+WAIT_BLOCKING = 'blocking'  # Block on the message queue with a timeout
+WAIT_CALLBACK = 'callback'  # Handle messages on the rtmidi callback thread
+WAIT_HYBRID = 'hybrid'      # Spin briefly after each message, then block
+WAIT_STRATEGIES = (WAIT_BLOCKING, WAIT_CALLBACK, WAIT_HYBRID)
+NOTE_TYPES = ('note_on', 'note_off')
+DEFAULT_MAX_FRAME_RATE = 100.0  # Frames per second sent to the keyboard, 0 for no limit
+DEFAULT_MAX_COALESCE = 0.005    # Longest time (s) spent gathering one burst of messages
+STORM_GLISSANDO = 'glissando'   # Runs up and down the whole keyboard
+STORM_CHORDS = 'chords'         # Ten note chords struck and released together
+STORM_RANDOM = 'random'         # Random notes on random finger channels
+STORM_PATTERNS = (STORM_GLISSANDO, STORM_CHORDS, STORM_RANDOM)
+PORT_SEPARATOR = ','            # Separates the ports of a port list, e.g. "LoopBe*, udp:"
+LOOPBACK_PATTERNS = ('*LoopBe*', '*loopMIDI*', '*IAC*', '*Midi Through*')  # Loopback drivers looked for, in order
+
+class MIDIReceiver:
+    """Receives note messages from a MIDI input port without busy-waiting.
+       Each burst of messages is applied with handler(message), then
+       frame_handler() is called once to send the resulting frame.
+       If stats is given, each message's receipt time is recorded
+       with stats.eventApplied() once it has been applied.
+       callSoon() runs a function in order with the messages"""
+
+    port_name = ""             # Name of the MIDI input port, or a list of them (see openInput)
+    handler = None             # Function called with each note message
+    frame_handler = None       # Function called once per coalesced burst
+    strategy = WAIT_BLOCKING   # How the receive loop waits for messages
+    timeout = 0.05             # Longest wait (s) before checking if still running
+    spin_time = 0.002          # Time (s) the hybrid strategy spins after a frame
+    min_frame_interval = 0.0   # Shortest time (s) between two frames
+    max_coalesce = DEFAULT_MAX_COALESCE
+    last_frame_time = 0.0      # perf_counter() time of the last frame
+    open_input = None          # Function used to open the port list, openInput by default
+    port = None                # Input port while receiving
+    lock = None                # Guards the handlers in the callback strategy
+    pending = None             # Event set by the callback when a frame is needed
+    msg_queue = None           # Queue of (message, receipt time) items for the queue strategies
+    stats = None               # EngineStats recording receipt to buffer latency, or None
+
+    def __init__(self, port_name, handler, frame_handler=None, strategy=WAIT_BLOCKING,
+                 timeout=0.05, spin_time=0.002, max_frame_rate=DEFAULT_MAX_FRAME_RATE,
+                 max_coalesce=DEFAULT_MAX_COALESCE, open_input=None, stats=None):
+        if strategy not in WAIT_STRATEGIES:
+            raise ValueError("Unknown wait strategy: " + str(strategy))
+        self.port_name = port_name
+        self.handler = handler
+        self.frame_handler = frame_handler if frame_handler else lambda: None
+        self.strategy = strategy
+        self.timeout = timeout
+        self.spin_time = spin_time
+        self.min_frame_interval = 1.0 / max_frame_rate if max_frame_rate > 0 else 0.0
+        self.max_coalesce = max_coalesce
+        self.open_input = open_input if open_input else openInput
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        # Made up front so callSoon can queue work before run() starts
+        self.msg_queue = queue.Queue()
+        self.stats = stats
+
+    def run(self, keep_running):
+        """Receives messages until keep_running() returns False -
+           returns within one timeout of the flag being cleared"""
+        if self.strategy == WAIT_CALLBACK:
+            port = self.open_input(self.port_name, callback=self.callbackHandler)
+            self.port = port
+            try:
+                self.callbackLoop(keep_running)
+            finally:
+                port.close()
+            return
+
+        # The queue based strategies receive through the callback too,
+        # so the loop can block with a timeout instead of polling.
+        # Messages are queued with the time they were received
+        msg_queue = self.msg_queue
+        def enqueue(message):
+            if message.type in NOTE_TYPES:
+                msg_queue.put((message, time.perf_counter()))
+        port = self.open_input(self.port_name, callback=enqueue)
+        self.port = port
+        try:
+            if self.strategy == WAIT_HYBRID:
+                self.hybridLoop(msg_queue, keep_running)
+            else:
+                self.blockingLoop(msg_queue, keep_running)
+        finally:
+            port.close()
+
+    def callbackHandler(self, message):
+        """Applies messages directly on the MIDI backend's thread and
+           flags the listener thread to send a frame"""
+        if message.type in NOTE_TYPES:
+            receipt_time = time.perf_counter()
+            with self.lock:
+                self.applyMessage((message, receipt_time))
+            self.pending.set()
+
+    def callbackLoop(self, keep_running):
+        """Parks the listener thread until the callback has applied
+           messages, then sends one frame for all of them"""
+        while keep_running():
+            if not self.pending.wait(self.timeout):
+                continue
+            # Hold the frame back until the frame rate allows it,
+            # letting the callback apply the rest of the burst
+            delay = self.last_frame_time + self.min_frame_interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.pending.clear()
+            with self.lock:
+                self.sendFrame()
+
+    def blockingLoop(self, msg_queue, keep_running):
+        """Blocks on the queue until a message arrives or timeout elapses"""
+        while keep_running():
+            try:
+                item = msg_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            self.applyMessage(item)
+            self.coalesce(msg_queue)
+
+    def hybridLoop(self, msg_queue, keep_running):
+        """Spins for spin_time after each frame to catch the rest of a
+           passage with minimal wake-up latency, then parks on the queue"""
+        spin_until = 0.0
+        while keep_running():
+            try:
+                item = msg_queue.get_nowait()
+            except queue.Empty:
+                if time.perf_counter() < spin_until:
+                    continue
+                try:
+                    item = msg_queue.get(timeout=self.timeout)
+                except queue.Empty:
+                    continue
+            self.applyMessage(item)
+            self.coalesce(msg_queue)
+            spin_until = time.perf_counter() + self.spin_time
+
+    def coalesce(self, msg_queue):
+        """Applies the rest of a burst of messages and sends one frame.
+           Waiting messages are drained for up to max_coalesce seconds,
+           and the frame is held back until the frame rate allows it"""
+        now = time.perf_counter()
+        window_end = now + self.max_coalesce
+        frame_due = self.last_frame_time + self.min_frame_interval
+        while now < window_end or now < frame_due:
+            try:
+                item = msg_queue.get_nowait()
+            except queue.Empty:
+                # Queue is drained, only wait if the frame rate requires it
+                if now >= frame_due:
+                    break
+                try:
+                    item = msg_queue.get(timeout=frame_due - now)
+                except queue.Empty:
+                    break
+            self.applyMessage(item)
+            now = time.perf_counter()
+        self.sendFrame()
+
+    def callSoon(self, func):
+        """Runs func() between two messages and sends a frame after it. With
+           WAIT_CALLBACK the handlers run on the MIDI callback thread under
+           self.lock, so func runs right away on the calling thread under
+           the same lock. Otherwise it is queued and runs on the thread that
+           applies messages. Can be called from any thread, also before
+           run() starts - use it to change state the handlers read"""
+        if self.strategy == WAIT_CALLBACK:
+            with self.lock:
+                func()
+            self.pending.set()
+        else:
+            self.msg_queue.put((func, None))
+
+    def applyMessage(self, item):
+        """Passes a (message, receipt time) item to the handler, or
+           calls a function queued by callSoon"""
+        if item[1] is None:
+            item[0]()
+            return
+        self.handler(item[0])
+        if self.stats:
+            self.stats.eventApplied(item[1])
+
+    def sendFrame(self):
+        """Calls the frame handler and records when it was called"""
+        self.frame_handler()
+        self.last_frame_time = time.perf_counter()
+
+def openPort(port_name, callback=None):
+    """Opens one MIDI input port by name - a network input for names of
+       the form udp:[HOST][:PORT] (see STKKNet), otherwise a mido port"""
+    if isNetworkPort(port_name):
+        return UDPMIDIInput(port_name, callback)
+    import mido
+    return mido.open_input(port_name, callback=callback)
+
+def openInput(port_list, callback=None):
+    """Opens a list of MIDI input ports separated by PORT_SEPARATOR as
+       one MultiMIDIInput, see resolvePorts for the names it takes"""
+    return MultiMIDIInput(splitPorts(port_list), callback)
+
+def splitPorts(port_list):
+    """Returns the port names or patterns in a port list"""
+    return [name.strip() for name in port_list.split(PORT_SEPARATOR) if name.strip()]
+
+def isPortPattern(name):
+    """Returns True if a port name is a wildcard pattern, e.g. *LoopBe*"""
+    return not isNetworkPort(name) and any(char in name for char in '*?[')
+
+def resolvePorts(port_list, names):
+    """Returns a port list with each pattern replaced by the names of
+       the MIDI ports (from names) it matches, ignoring case, and
+       without repeats. Other names are kept as they are. Raises
+       ValueError if a pattern matches no port"""
+    resolved = []
+    for name in splitPorts(port_list):
+        if isPortPattern(name):
+            matches = [port for port in names if fnmatch.fnmatchcase(port.lower(), name.lower())]
+            if not matches:
+                raise ValueError("No MIDI port matches " + name)
+        else:
+            matches = [name]
+        resolved += [port for port in matches if port not in resolved]
+    return (PORT_SEPARATOR + ' ').join(resolved)
+
+def findLoopbackPort(names):
+    """Returns the name of a MIDI loopback port from names, trying each
+       of the LOOPBACK_PATTERNS in turn, or "" if there is none"""
+    for pattern in LOOPBACK_PATTERNS:
+        matches = [port for port in names if fnmatch.fnmatchcase(port.lower(), pattern.lower())]
+        if matches:
+            return matches[-1]
+    return ""
+
+class MultiMIDIInput:
+    """mido style input port merging several MIDI input ports into one
+       stream. Each port's backend calls in on its own thread, and the
+       calls are serialized, so the callback sees the messages of every
+       port in the order they arrived and the receiver waits in one
+       place. With no callback the messages are queued for
+       iter_pending(). Counts the note messages from each port"""
+
+    name = ""          # Port list of the ports opened
+    port_names = []    # Names of the ports opened
+    ports = []         # Input ports opened, in port list order
+    counts = []        # counts[i] is the number of note messages from ports[i]
+    callback = None    # Function called with each message, or None to queue them
+    pending = None     # deque of messages waiting for iter_pending()
+    lock = None        # Serializes the calls from the ports' backend threads
+
+    def __init__(self, port_names, callback=None, open_port=openPort):
+        self.name = (PORT_SEPARATOR + ' ').join(port_names)
+        self.port_names = list(port_names)
+        self.callback = callback
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.ports = []
+        self.counts = [0] * len(port_names)
+        try:
+            for index, port_name in enumerate(port_names):
+                self.ports.append(open_port(port_name, callback=self.sourceCallback(index)))
+        except Exception:
+            self.close()
+            raise
+
+    def sourceCallback(self, index):
+        """Returns the callback for the port at index"""
+        counts = self.counts
+        lock = self.lock
+        def receive(message):
+            with lock:
+                if message.type in NOTE_TYPES:
+                    counts[index] += 1
+                if self.callback:
+                    self.callback(message)
+                else:
+                    self.pending.append(message)
+        return receive
+
+    def iter_pending(self):
+        while self.pending:
+            yield self.pending.popleft()
+
+    def sourceStats(self):
+        """Returns a list of {'name', 'events'} dictionaries, one per port"""
+        return [{'name': port_name, 'events': count}
+                for port_name, count in zip(self.port_names, list(self.counts))]
+
+    def networkStats(self):
+        """Returns the datagram counters of the network inputs added
+           together, or None if there are none"""
+        totals = None
+        for port in self.ports:
+            if hasattr(port, 'networkStats'):
+                stats = port.networkStats()
+                totals = dict(stats) if totals is None else {key: totals[key] + stats[key] for key in totals}
+        return totals
+
+    def close(self):
+        """Closes every port"""
+        for port in self.ports:
+            port.close()
+        self.ports = []
+
+def stormMessages(pattern, count, low_note=21, high_note=108, seed=0):
+    """Returns a list of count synthetic note messages following
+       one of the STORM_PATTERNS, using finger channels 1 to 10"""
+    import mido
+    rng = random.Random(seed)
+    messages = []
+    if pattern == STORM_GLISSANDO:
+        notes = list(range(low_note, high_note + 1)) + list(range(high_note - 1, low_note, -1))
+        previous = None
+        step = 0
+        while len(messages) < count:
+            note = notes[step % len(notes)]
+            channel = 1 + step % 10
+            messages.append(mido.Message('note_on', channel=channel, note=note, velocity=100))
+            if previous:
+                messages.append(mido.Message('note_off', channel=previous[0], note=previous[1], velocity=0))
+            previous = (channel, note)
+            step += 1
+    elif pattern == STORM_CHORDS:
+        while len(messages) < count:
+            root = rng.randint(low_note, high_note - 20)
+            chord = [(1 + i, root + 2 * i) for i in range(10)]
+            for channel, note in chord:
+                messages.append(mido.Message('note_on', channel=channel, note=note, velocity=100))
+            for channel, note in chord:
+                messages.append(mido.Message('note_off', channel=channel, note=note, velocity=0))
+    elif pattern == STORM_RANDOM:
+        held = []
+        while len(messages) < count:
+            if held and (len(held) >= 10 or rng.random() < 0.5):
+                channel, note = held.pop(rng.randrange(len(held)))
+                messages.append(mido.Message('note_off', channel=channel, note=note, velocity=0))
+            else:
+                held.append((rng.randint(1, 10), rng.randint(low_note, high_note)))
+                messages.append(mido.Message('note_on', channel=held[-1][0], note=held[-1][1],
+                                             velocity=rng.randint(1, 127)))
+    else:
+        raise ValueError("Unknown storm pattern: " + str(pattern))
+    return messages[:count]
+
+class MIDIStorm:
+    """Synthetic MIDI input port. Pass its open_input in place of
+       mido.open_input, then play() sends note messages to the port's
+       callback at a fixed rate, in 1 ms batches like a USB MIDI driver"""
+
+    callback = None    # Callback passed to open_input
+    opened = None      # Event set once the port has been opened
+    send_times = []    # perf_counter() time each message was sent
+
+    def __init__(self):
+        self.opened = threading.Event()
+        self.send_times = []
+
+    def open_input(self, name=None, callback=None):
+        self.callback = callback
+        self.opened.set()
+        return self
+
+    def close(self):
+        self.callback = None
+
+    def play(self, messages, rate):
+        """Sends messages at rate events per second, returns when done"""
+        self.send_times = []
+        start = time.perf_counter()
+        sent = 0
+        while sent < len(messages) and self.callback:
+            callback = self.callback
+            due = min(len(messages), int((time.perf_counter() - start) * rate) + 1)
+            while sent < due and callback:
+                self.send_times.append(time.perf_counter())
+                callback(messages[sent])
+                sent += 1
+            time.sleep(0.001)
@@ -0,0 +1,239 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Network MIDI input - receives MIDI over UDP, so
+#                   Synthesia can run on another machine than the keyboard
+#
+# Usage: python STKKNet.py send HOST[:PORT] [--port "LoopBe Internal MIDI"]
+#        forwards a local MIDI input to the machine running SynthesiaToKK,
+#        which listens when its MIDI port is set to udp:[HOST][:PORT]
+
+import os
+import sys
+import time
+import select
+import socket
+import struct
+import argparse
+import threading
+from collections import deque
+
+NETWORK_PREFIX = 'udp:'          # MIDI port names starting with this are network inputs
+DEFAULT_NETWORK_PORT = 21928     # UDP port used when a port name doesn't give one
+PACKET_MAGIC = b'SKMI'           # First bytes of every datagram
+PACKET_HEADER = struct.Struct('!4sII')  # Magic, stream id and sequence number, followed by raw MIDI bytes
+MAX_DATAGRAM = 1472              # Largest datagram read, one Ethernet frame of UDP payload
+RECV_BATCH = 64                  # Most datagrams read per wake-up
+SEQUENCE_MASK = 0xFFFFFFFF       # Sequence numbers wrap around at 32 bits
+REORDER_WINDOW = 64              # Datagrams at most this far behind are late, further back starts a new stream
+
+def isNetworkPort(port_name):
+    """Returns True if a MIDI port name is a network input"""
+    return port_name.lower().startswith(NETWORK_PREFIX)
+
+def parseAddress(address, default_host='0.0.0.0'):
+    """Takes an address of the form [udp:][HOST][:PORT] and returns a
+       (host, port) tuple, using default_host and DEFAULT_NETWORK_PORT
+       for the parts left out"""
+    if isNetworkPort(address):
+        address = address[len(NETWORK_PREFIX):]
+    host, separator, port = address.rpartition(':')
+    if not separator:
+        host, port = port, ''
+    return (host or default_host, int(port) if port else DEFAULT_NETWORK_PORT)
+
+def packMessages(sequence, messages, stream=0):
+    """Returns a datagram carrying mido messages with a stream id and
+       sequence number"""
+    data = bytearray(PACKET_HEADER.pack(PACKET_MAGIC, stream & SEQUENCE_MASK, sequence & SEQUENCE_MASK))
+    for message in messages:
+        data += message.bin()
+    return bytes(data)
+
+class UDPMIDIInput:
+    """mido style input port receiving MIDI from UDPMIDISender. Each wake
+       up reads every datagram waiting, up to RECV_BATCH, and passes the
+       messages to the callback in order, or queues them for
+       iter_pending() if there is none. Sequence numbers detect lost
+       datagrams - ones that arrive late or twice are dropped, so notes
+       are never applied out of order. A restarted sender sends a new
+       stream id and starts again at 0, so a new stream id, or a jump
+       back further than REORDER_WINDOW, starts counting afresh"""
+
+    name = ""            # Port name, udp:HOST:PORT
+    sock = None          # Non-blocking UDP socket bound to the port
+    callback = None      # Function called with each message, or None to queue them
+    pending = None       # deque of messages waiting for iter_pending()
+    parser = None        # mido Parser turning MIDI bytes into messages
+    timeout = 0.05       # Longest wait (s) before checking if the port was closed
+    running = False      # Boolean to control the receive thread
+    thread_handle = None # Handle for the receive thread
+    stream = None        # Stream id of the sender, None before the first datagram
+    expected = None      # Next sequence number expected, None before the first datagram
+    datagrams = 0        # Datagrams received and applied
+    lost = 0             # Datagrams missing from the sequence
+    late = 0             # Datagrams dropped for arriving late or twice
+    invalid = 0          # Datagrams dropped for not starting with PACKET_MAGIC
+    batches = 0          # Wake-ups that read at least one datagram
+    streams = 0          # Sender streams received, more than one after a sender restarts
+
+    def __init__(self, port_name, callback=None, timeout=0.05):
+        self.name = port_name
+        self.callback = callback
+        self.pending = deque()
+        import mido
+        self.parser = mido.Parser()
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(parseAddress(port_name))
+        self.sock.setblocking(False)
+        self.running = True
+        self.thread_handle = threading.Thread(target=self.receiveThread, args=())
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+
+    def address(self):
+        """Returns the (host, port) the input is bound to"""
+        return self.sock.getsockname()
+
+    def receiveThread(self):
+        """Threaded method that waits for datagrams and reads them in batches"""
+        buffer = bytearray(MAX_DATAGRAM)
+        view = memoryview(buffer)
+        while self.running:
+            try:
+                readable = select.select([self.sock], [], [], self.timeout)[0]
+            except (OSError, ValueError):
+                break # Socket closed
+            if not readable:
+                continue
+            self.batches += 1
+            for i in range(RECV_BATCH):
+                try:
+                    size = self.sock.recv_into(buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    # Windows reports an earlier send's ICMP error here, carry on
+                    continue
+                self.receiveDatagram(view[:size])
+
+    def receiveDatagram(self, data):
+        """Checks a datagram's sequence number and delivers its messages"""
+        if len(data) < PACKET_HEADER.size:
+            self.invalid += 1
+            return
+        magic, stream, sequence = PACKET_HEADER.unpack_from(data)
+        if magic != PACKET_MAGIC:
+            self.invalid += 1
+            return
+        if stream == self.stream:
+            gap = (sequence - self.expected) & SEQUENCE_MASK
+            if gap > SEQUENCE_MASK // 2:
+                if SEQUENCE_MASK + 1 - gap <= REORDER_WINDOW:
+                    self.late += 1
+                    return
+                # Too far back to be reordered, the sender started again
+                self.streams += 1
+            else:
+                self.lost += gap
+        else:
+            self.stream = stream
+            self.streams += 1
+        self.expected = (sequence + 1) & SEQUENCE_MASK
+        self.datagrams += 1
+
+        self.parser.feed(data[PACKET_HEADER.size:])
+        for message in self.parser:
+            if self.callback:
+                self.callback(message)
+            else:
+                self.pending.append(message)
+
+    def iter_pending(self):
+        while self.pending:
+            yield self.pending.popleft()
+
+    def networkStats(self):
+        """Returns a dictionary of the datagram counters"""
+        return {'datagrams': self.datagrams, 'lost': self.lost, 'late': self.late,
+                'invalid': self.invalid, 'batches': self.batches, 'streams': self.streams}
+
+    def close(self):
+        """Stops the receive thread and closes the socket"""
+        self.running = False
+        if self.thread_handle:
+            self.thread_handle.join()
+            self.thread_handle = None
+        self.sock.close()
+
+class UDPMIDISender:
+    """Sends MIDI messages to a UDPMIDIInput, numbering each datagram.
+       Each sender picks a random stream id, so the input can tell a
+       restarted sender from datagrams arriving late"""
+
+    sock = None      # UDP socket connected to the receiver
+    stream = 0       # Random id of this sender's stream of datagrams
+    sequence = 0     # Sequence number of the next datagram
+
+    def __init__(self, address):
+        self.stream = struct.unpack('!I', os.urandom(4))[0]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(parseAddress(address, '127.0.0.1'))
+
+    def send(self, messages):
+        """Sends a list of mido messages in one datagram"""
+        self.sock.send(packMessages(self.sequence, messages, self.stream))
+        self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+
+    def close(self):
+        self.sock.close()
+
+def forward(port_name, address, keep_running=lambda: True):
+    """Sends each note message from a local MIDI input to a network input
+       as it arrives, until keep_running() returns False"""
+    import mido
+    sender = UDPMIDISender(address)
+    def sendNote(message):
+        if message.type in ('note_on', 'note_off'):
+            sender.send([message])
+    port = mido.open_input(port_name, callback=sendNote)
+    try:
+        while keep_running():
+            time.sleep(0.1)
+    finally:
+        port.close()
+        sender.close()
+
+def main(argv=None):
+    """Forwards a local MIDI input to a network input until interrupted"""
+    parser = argparse.ArgumentParser(description='Send MIDI to SynthesiaToKK on another machine')
+    commands = parser.add_subparsers(dest='command')
+    send_parser = commands.add_parser('send', help='forward a local MIDI input over UDP')
+    send_parser.add_argument('address', help='HOST[:PORT] of the machine with the keyboard')
+    send_parser.add_argument('--port', help='local MIDI input port name (default LoopBe)')
+    args = parser.parse_args(argv)
+
+    if args.command != 'send':
+        parser.print_help()
+        return 0
+    port_name = args.port
+    if not port_name:
+        import mido
+        for name in mido.get_input_names():
+            if "LoopBe" in name:
+                port_name = name
+    if not port_name:
+        print('No LoopBe MIDI port found, pass --port', file=sys.stderr)
+        return 1
+    host, port = parseAddress(args.address, '127.0.0.1')
+    print('Forwarding %s to %s:%d, press Ctrl+C to stop' % (port_name, host, port))
+    try:
+        forward(port_name, args.address)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
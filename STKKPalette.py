@@ -0,0 +1,390 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: RGB color conversion and MK2 palette mapping
+
+import os
+import mmap
+import struct
+import hashlib
+import threading
+import configparser as cfg
+
+CACHE_DIR = 'STKKCache'       # Directory for precomputed palette cubes
+METRIC_WEIGHTED = 'weighted'  # Luminance weighted RGB distance
+METRIC_LAB = 'lab'            # Perceptual CIELAB distance (Delta E 1976)
+PALETTE_METRICS = (METRIC_WEIGHTED, METRIC_LAB)
+CUBE_BITS = 5                 # Bits per RGB component used to index the cube
+CUBE_LEVELS = 1 << CUBE_BITS  # Levels per RGB component
+CUBE_SHIFT = 8 - CUBE_BITS    # Shift converting an 8-bit component to a cube level
+CUBE_VERSION = 3              # Changed whenever the cube file's contents change
+CUBE_MAGIC = b'STKC'
+CUBE_TRAILER = struct.Struct('<4s20s16s')  # magic, paletteMapDigest, metric - after the cube
+MIXED_CELL = 0xFF             # Cube value of a cell whose colors have different nearest palette indices
+DISTANCE_SLACK = 1e-6         # Allowance for rounding when ruling out palette colors for a cell
+DEFAULT_PALETTE_INDEX = 0x07  # Palette index used when the palette map is empty
+PALETTE_GROUP_SIZE = 4        # MK2 palette colors come in groups of brightnesses, dimmest first
+PALETTE_FIRST = 0x04          # First palette index of a color group
+PALETTE_LAST = 0x3F           # Last palette index of a color group
+# Palette indices used, in MIDI channel order, when there is no palette map
+UNMAPPED_PALETTE_LIST = [(0x07,), (0x2D,), (0x2F,), (0x2F,), (0x2F,), (0x2F,), (0x1F,),
+                         (0x1B,), (0x1B,), (0x1B,), (0x1B,), (0x2F,), (0x1B,)]
+
+palette_maps = {}  # Palette maps read by readPaletteMap, by file name, with the file's stamp
+palette_cubes = {} # PaletteCubes used by mapColorsToPalette, by metric, with the palette map they are for
+palette_cubes_lock = threading.Lock()  # Held while using palette_cubes, so a cube isn't closed while in use
+
+def RGBTupleToString(rgb_tuple):
+    """Takes a tuple containing three ints and returns an RGB string code"""
+    rtn_str = "#%02x%02x%02x" % rgb_tuple
+    return rtn_str
+
+def RGBStringToTuple(rgb_str, make7bit = True):
+    """Takes a color string of format #ffffff and returns an RGB tuple.
+    By default the values of the tuple are converted to 7-bits.
+    Pass False as the second parameter for 8-bits."""
+    rgb_tuple = (0, 0, 0)
+    if (len(rgb_str) >= 7) and (rgb_str[0] == "#"):
+        red = int(rgb_str[1:3], 16)
+        green = int(rgb_str[3:5], 16)
+        blue = int(rgb_str[5:7], 16)
+        if make7bit:
+            red = red // 2
+            green = green // 2
+            blue = blue // 2
+        rgb_tuple = (red, green, blue)
+    return rgb_tuple
+
+def scaleRGB(rgb_tuple, scale):
+    """Takes an RGB tuple and returns it with each value scaled, for
+       dimming a color"""
+    return tuple(int(round(value * scale)) for value in rgb_tuple)
+
+def dimPaletteIndex(index, steps):
+    """Returns the MK2 palette index steps dimmer than index within its
+       group of brightnesses (e.g. 0x07 to 0x04 for the reds), stopping at
+       the group's dimmest. Indices outside the groups are not changed"""
+    if index < PALETTE_FIRST or index > PALETTE_LAST:
+        return index
+    return index - min(steps, (index - PALETTE_FIRST) % PALETTE_GROUP_SIZE)
+
+def labTerms(rgb_tuple):
+    """Takes an 8-bit sRGB tuple and returns the (fx, fy, fz) terms its
+       CIELAB coordinates are made from. Each term only grows as any of
+       the RGB components grows"""
+    linear = []
+    for value in rgb_tuple:
+        value = value / 255.0
+        if value > 0.04045:
+            linear.append(((value + 0.055) / 1.055) ** 2.4)
+        else:
+            linear.append(value / 12.92)
+    red, green, blue = linear
+    xyz = ((red * 0.4124 + green * 0.3576 + blue * 0.1805) / 0.95047,
+           (red * 0.2126 + green * 0.7152 + blue * 0.0722),
+           (red * 0.0193 + green * 0.1192 + blue * 0.9505) / 1.08883)
+    return [t ** (1.0 / 3.0) if t > 0.008856 else 7.787 * t + 16.0 / 116.0 for t in xyz]
+
+def RGBTupleToLab(rgb_tuple):
+    """Takes an 8-bit sRGB tuple and returns a CIELAB tuple (D65 white point)"""
+    fx, fy, fz = labTerms(rgb_tuple)
+    return (116.0 * fy - 16.0, 500.0 * (fx - fy), 200.0 * (fy - fz))
+
+def mapRGBStringToPalette(RGBstring, palette_map):
+    """Takes an RGB string of format #ffffff and returns
+    a single element tuple containing the palette index
+    of the nearest matching color. Palette map has palette
+    indices in 0xFF format for keys and RGB strings as values"""
+    rgb_tuple = RGBStringToTuple(RGBstring, False)
+    distance = 1000.0
+    index_tuple = (DEFAULT_PALETTE_INDEX,)
+    for key in palette_map:
+        palette_tuple = RGBStringToTuple(palette_map[key], False)
+        # Calculate the relative distance between the two colors,
+        # weighting the RGB values with typical luminance ratios
+        red_distance = abs(rgb_tuple[0] - palette_tuple[0])
+        green_distance = abs(rgb_tuple[1] - palette_tuple[1])
+        blue_distance = abs(rgb_tuple[2] - palette_tuple[2])
+        cur_dist = red_distance * 0.299 + green_distance * 0.587 + blue_distance * 0.114
+        # If the colors are closer than any previous comparison,
+        # store the distance and create a new tuple
+        if cur_dist < distance:
+            distance = cur_dist
+            index_tuple = (int(key, 16),)
+    return index_tuple
+
+def fileStamp(filename):
+    """Returns a (modification time, size) tuple identifying a version
+       of a file, or None if it doesn't exist"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def readPaletteMap(filename):
+    """Returns the palette map in a PaletteMap.ini file as a dictionary
+       of palette index strings (0xFF format) to RGB strings, empty if
+       there is no map. A file is only parsed again once it changes"""
+    stamp = fileStamp(filename)
+    cached = palette_maps.get(filename)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    palette_map = {}
+    prefs_file = cfg.ConfigParser()
+    files = prefs_file.read(filename)
+    if len(files) == 1 and 'PaletteMap' in prefs_file:
+        palette_map = dict(prefs_file['PaletteMap'])
+    palette_maps[filename] = (stamp, palette_map)
+    return palette_map
+
+def mapColorsToPalette(colors, palette_map, metric = METRIC_WEIGHTED):
+    """Takes a list of RGB strings and returns a list of one element
+       tuples containing the colors mapped to palette indices, using the
+       cached palette cube. Without a palette map the colors are mapped
+       to UNMAPPED_PALETTE_LIST. The cube is kept open for as long as the
+       same palette map (as readPaletteMap returns it) is passed in"""
+    if not palette_map:
+        return list(UNMAPPED_PALETTE_LIST)
+    with palette_cubes_lock:
+        cached = palette_cubes.get(metric)
+        if cached and cached[0] is palette_map:
+            palette_cube = cached[1]
+        else:
+            palette_cube = PaletteCube(palette_map, metric)
+            palette_cubes[metric] = (palette_map, palette_cube)
+            if cached:
+                cached[1].close()
+        return [palette_cube.mapRGBString(color) for color in colors]
+
+def paletteMapDigest(palette_map, metric):
+    """Returns the SHA-1 digest of a palette map's contents and distance
+       metric, which a cached cube must have been built for"""
+    digest = hashlib.sha1()
+    digest.update(("%s:%d:%d\n" % (metric, CUBE_BITS, CUBE_VERSION)).encode('ascii'))
+    for key in palette_map:
+        digest.update(("%s=%s\n" % (key, palette_map[key])).encode('ascii'))
+    return digest.digest()
+
+def paletteColors(palette_map, metric = METRIC_WEIGHTED):
+    """Returns a list of (palette index, color) tuples in palette map
+       order, colors as 8-bit RGB tuples or, for METRIC_LAB, CIELAB tuples"""
+    palette = []
+    for key in palette_map:
+        rgb_tuple = RGBStringToTuple(palette_map[key], False)
+        if metric == METRIC_LAB:
+            rgb_tuple = RGBTupleToLab(rgb_tuple)
+        palette.append((int(key, 16), rgb_tuple))
+    return palette
+
+def nearestPaletteIndex(rgb_tuple, palette, metric = METRIC_WEIGHTED):
+    """Takes an 8-bit RGB tuple and a list of paletteColors and returns
+       the index of the nearest palette color, the first of any equally
+       near, as mapRGBStringToPalette does"""
+    index = DEFAULT_PALETTE_INDEX
+    distance = float('inf')
+    if metric == METRIC_LAB:
+        l, a, b = RGBTupleToLab(rgb_tuple)
+        for key, color in palette:
+            cur_dist = (l - color[0]) ** 2 + (a - color[1]) ** 2 + (b - color[2]) ** 2
+            if cur_dist < distance:
+                distance = cur_dist
+                index = key
+    else:
+        red, green, blue = rgb_tuple
+        for key, color in palette:
+            cur_dist = abs(red - color[0]) * 0.299 + abs(green - color[1]) * 0.587 + abs(blue - color[2]) * 0.114
+            if cur_dist < distance:
+                distance = cur_dist
+                index = key
+    return index
+
+def cellBounds(cell, metric = METRIC_WEIGHTED):
+    """Returns ((low, high) of each axis) bounding the colors of a cube
+       cell - RGB components, or for METRIC_LAB CIELAB coordinates"""
+    levels = ((cell >> (2 * CUBE_BITS)) & (CUBE_LEVELS - 1), (cell >> CUBE_BITS) & (CUBE_LEVELS - 1),
+              cell & (CUBE_LEVELS - 1))
+    low = tuple(level << CUBE_SHIFT for level in levels)
+    high = tuple(value + (1 << CUBE_SHIFT) - 1 for value in low)
+    if metric != METRIC_LAB:
+        return tuple(zip(low, high))
+    # The terms only grow with each component, so the cell's darkest and
+    # brightest corners bound them, and so the CIELAB coordinates
+    fx_low, fy_low, fz_low = labTerms(low)
+    fx_high, fy_high, fz_high = labTerms(high)
+    return ((116.0 * fy_low - 16.0, 116.0 * fy_high - 16.0),
+            (500.0 * (fx_low - fy_high), 500.0 * (fx_high - fy_low)),
+            (200.0 * (fy_low - fz_high), 200.0 * (fy_high - fz_low)))
+
+def cellCandidates(cell, palette, metric = METRIC_WEIGHTED):
+    """Returns the paletteColors, in order, that are the nearest to at
+       least one color in a cube cell. A palette color is left out if it
+       is further from every color in the cell than another one is from
+       any of them"""
+    bounds = cellBounds(cell, metric)
+    if metric == METRIC_LAB:
+        def near(color):
+            return sum(max(low - value, value - high, 0.0) ** 2 for (low, high), value in zip(bounds, color))
+        def far(color):
+            return sum(max(value - low, high - value) ** 2 for (low, high), value in zip(bounds, color))
+    else:
+        def near(color):
+            return sum(max(low - value, value - high, 0) * weight
+                       for (low, high), value, weight in zip(bounds, color, (0.299, 0.587, 0.114)))
+        def far(color):
+            return sum(max(value - low, high - value) * weight
+                       for (low, high), value, weight in zip(bounds, color, (0.299, 0.587, 0.114)))
+    furthest = min(far(color) for key, color in palette) + DISTANCE_SLACK
+    return [(key, color) for key, color in palette if near(color) <= furthest]
+
+def buildPaletteCube(palette_map, metric = METRIC_WEIGHTED):
+    """Returns bytes holding, for every cell of an RGB cube with
+    CUBE_LEVELS levels per component, the palette index nearest to every
+    color in the cell, or MIXED_CELL if that differs across the cell.
+    Works out the same as cellCandidates for every cell, faster"""
+    palette = paletteColors(palette_map, metric)
+    if not palette:
+        return bytes([DEFAULT_PALETTE_INDEX]) * (CUBE_LEVELS ** 3)
+    keys = [key for key, color in palette]
+    cube = bytearray(CUBE_LEVELS ** 3)
+    cell = 0
+    if metric == METRIC_LAB:
+        labs = [color for key, color in palette]
+        for red in range(CUBE_LEVELS):
+            for green in range(CUBE_LEVELS):
+                for blue in range(CUBE_LEVELS):
+                    (l_low, l_high), (a_low, a_high), (b_low, b_high) = cellBounds(cell, metric)
+                    nears = []
+                    furthest = float('inf')
+                    for l, a, b in labs:
+                        near_l = max(l_low - l, l - l_high, 0.0)
+                        near_a = max(a_low - a, a - a_high, 0.0)
+                        near_b = max(b_low - b, b - b_high, 0.0)
+                        nears.append(near_l * near_l + near_a * near_a + near_b * near_b)
+                        far_l = max(l - l_low, l_high - l)
+                        far_a = max(a - a_low, a_high - a)
+                        far_b = max(b - b_low, b_high - b)
+                        furthest = min(furthest, far_l * far_l + far_a * far_a + far_b * far_b)
+                    cube[cell] = uniqueCandidate(keys, nears, furthest)
+                    cell += 1
+        return bytes(cube)
+
+    # Weighted distances add up over the components, so the nearest and
+    # furthest distance of each palette color from each level of each
+    # component are worked out once
+    tables = []
+    for axis, weight in enumerate((0.299, 0.587, 0.114)):
+        near_table = []
+        far_table = []
+        for level in range(CUBE_LEVELS):
+            low = level << CUBE_SHIFT
+            high = low + (1 << CUBE_SHIFT) - 1
+            near_table.append([max(low - color[axis], color[axis] - high, 0) * weight for key, color in palette])
+            far_table.append([max(color[axis] - low, high - color[axis]) * weight for key, color in palette])
+        tables.append((near_table, far_table))
+    (red_near, red_far), (green_near, green_far), (blue_near, blue_far) = tables
+    for red in range(CUBE_LEVELS):
+        for green in range(CUBE_LEVELS):
+            near_rg = [r + g for r, g in zip(red_near[red], green_near[green])]
+            far_rg = [r + g for r, g in zip(red_far[red], green_far[green])]
+            for blue in range(CUBE_LEVELS):
+                nears = [rg + b for rg, b in zip(near_rg, blue_near[blue])]
+                furthest = min([rg + b for rg, b in zip(far_rg, blue_far[blue])])
+                cube[cell] = uniqueCandidate(keys, nears, furthest)
+                cell += 1
+    return bytes(cube)
+
+def uniqueCandidate(keys, nears, furthest):
+    """Takes the palette indices, the nearest distance of each palette
+       color from a cell and the least furthest distance, and returns the
+       index of the only candidate for the cell, or MIXED_CELL"""
+    furthest += DISTANCE_SLACK
+    found = MIXED_CELL
+    for key, near in zip(keys, nears):
+        if near <= furthest:
+            if found != MIXED_CELL:
+                return MIXED_CELL
+            found = key
+    return found
+
+def cubeTrailer(path):
+    """Returns the CUBE_TRAILER of a cached cube file, or None if there
+       is no file or it is the wrong size"""
+    try:
+        with open(path, 'rb') as cube_file:
+            cube_file.seek(0, os.SEEK_END)
+            if cube_file.tell() != CUBE_LEVELS ** 3 + CUBE_TRAILER.size:
+                return None
+            cube_file.seek(CUBE_LEVELS ** 3)
+            return cube_file.read(CUBE_TRAILER.size)
+    except OSError:
+        return None
+
+class PaletteCube:
+    """Memory-mapped lookup cube giving the nearest MK2 palette index
+    for any RGB color, the same as a search of the whole palette. Cells
+    of the cube where every color has the same nearest palette color
+    give its index at once. Elsewhere only the few palette colors that
+    can be nearest in that cell are searched. The cube is built once per
+    palette map and metric and cached in CACHE_DIR, followed by a
+    CUBE_TRAILER that must match the palette map's digest and metric"""
+
+    metric = METRIC_WEIGHTED  # Distance metric used to build the cube
+    map_hash = ""             # Hash of the palette map and metric
+    cube = None               # mmap (or bytes) of palette indices
+    palette = []              # paletteColors of the palette map
+    candidates = {}           # Dictionary from mixed cell to its cellCandidates, filled in as used
+
+    def __init__(self, palette_map, metric = METRIC_WEIGHTED, cache_dir = CACHE_DIR):
+        if metric not in PALETTE_METRICS:
+            raise ValueError("Unknown palette metric: " + str(metric))
+        self.metric = metric
+        digest = paletteMapDigest(palette_map, metric)
+        self.map_hash = digest.hex()
+        self.palette = paletteColors(palette_map, metric)
+        self.candidates = {}
+        trailer = CUBE_TRAILER.pack(CUBE_MAGIC, digest, metric.encode('ascii'))
+        path = os.path.join(cache_dir, 'PaletteCube-%s-%s.bin' % (metric, self.map_hash[:16]))
+
+        # Build and cache the cube if there isn't a valid one already
+        if cubeTrailer(path) != trailer:
+            cube = buildPaletteCube(palette_map, metric)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_path = path + '.tmp'
+                with open(temp_path, 'wb') as cube_file:
+                    cube_file.write(cube)
+                    cube_file.write(trailer)
+                os.replace(temp_path, path)
+            except OSError:
+                # Cache directory isn't writable, keep the cube in memory
+                self.cube = cube
+                return
+
+        with open(path, 'rb') as cube_file:
+            self.cube = mmap.mmap(cube_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def lookup(self, rgb_tuple):
+        """Takes an 8-bit RGB tuple and returns the nearest palette index"""
+        cell = (((rgb_tuple[0] >> CUBE_SHIFT) << (2 * CUBE_BITS)) |
+                ((rgb_tuple[1] >> CUBE_SHIFT) << CUBE_BITS) |
+                (rgb_tuple[2] >> CUBE_SHIFT))
+        index = self.cube[cell]
+        if index != MIXED_CELL:
+            return index
+        candidates = self.candidates.get(cell)
+        if candidates is None:
+            candidates = self.candidates[cell] = cellCandidates(cell, self.palette, self.metric)
+        return nearestPaletteIndex(rgb_tuple, candidates, self.metric)
+
+    def mapRGBString(self, RGBstring):
+        """Takes an RGB string of format #ffffff and returns a single
+        element tuple containing the nearest palette index"""
+        return (self.lookup(RGBStringToTuple(RGBstring, False)),)
+
+    def close(self):
+        """Releases the memory-mapped cube"""
+        if isinstance(self.cube, mmap.mmap):
+            self.cube.close()
+        self.cube = None
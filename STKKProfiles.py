@@ -0,0 +1,261 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Named profiles - a keyboard model, finger colors,
+#                   palette map and effect settings, compiled once into
+#                   the form the engine uses and cached on disk
+
+import io
+import os
+import pickle
+import struct
+import hashlib
+import configparser as cfg
+from STKKEngine import KK_MODELS, COLOR_KEYS, PALETTE_FILE, findModel, readUserPrefs
+from STKKPalette import (CACHE_DIR, METRIC_WEIGHTED, PALETTE_METRICS, RGBStringToTuple, fileStamp,
+                         readPaletteMap, mapColorsToPalette)
+
+PROFILES_FILE = 'STKKProfiles.ini'  # File holding one section per profile
+PROFILE_CACHE_VERSION = 3           # Changed whenever the compiled form changes
+CACHE_MAGIC = b'STKP'               # First bytes of a compiled profiles cache file
+# Magic, version, SHA-1 of the profiles file and SHA-1 of the pickled profiles that follow
+CACHE_HEADER = struct.Struct('<4sI20s20s')
+
+class Profile:
+    """A named profile compiled into the form the engine uses - its
+       settings are validated, and its colors are already mapped for both
+       buffer layouts, so switching to it parses and maps nothing"""
+
+    name = ""                     # Name of the profile, its section in the profiles file
+    model_index = 3               # Index of the keyboard model in KK_MODELS
+    colors = []                   # RGB strings (#rrggbb) in MIDI channel order
+    color_lists = {}              # Dictionary from buffer scale to a list of bytes, one per color
+    palette_file = PALETTE_FILE   # PaletteMap.ini file the MK2 colors were mapped with
+    palette_stamp = None          # fileStamp of the palette file when it was mapped
+    palette_metric = METRIC_WEIGHTED  # Color distance used to map the MK2 colors
+    velocity_brightness = False   # Boolean to indicate key brightness follows note velocity
+    fade_time = 0.0               # Seconds released keys take to fade out
+    glow = 0.0                    # Brightness of the glow next to lit keys
+
+    def matches(self, colors, metric):
+        """Returns True if the compiled colors can be used for a list of
+           RGB strings mapped with a palette metric - they are the
+           profile's colors and metric, and the palette map hasn't changed
+           since they were mapped"""
+        return (list(colors) == self.colors and metric == self.palette_metric and
+                fileStamp(self.palette_file) == self.palette_stamp)
+
+    def prefs(self):
+        """Returns the profile's settings as user prefs"""
+        prefs = {'selectedkeyboard': self.model_index,
+                 'palettemetric': self.palette_metric,
+                 'velocitybrightness': self.velocity_brightness,
+                 'fadetime': self.fade_time,
+                 'glow': self.glow}
+        for key, color in zip(COLOR_KEYS, self.colors):
+            prefs[key] = color
+        return prefs
+
+def checkColor(name, key, value):
+    """Returns an RGB string in #rrggbb form, raising ValueError if it isn't one"""
+    value = value.strip().lower()
+    try:
+        if len(value) != 7 or value[0] != '#':
+            raise ValueError
+        int(value[1:], 16)
+    except ValueError:
+        raise ValueError("Profile %s: %s is not a #rrggbb color: %s" % (name, key, value))
+    return value
+
+def checkNumber(name, key, value, low, high):
+    """Returns a float setting, raising ValueError if it isn't between low and high"""
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError("Profile %s: %s is not a number: %s" % (name, key, value))
+    if not low <= number <= high:
+        raise ValueError("Profile %s: %s must be between %s and %s" % (name, key, low, high))
+    return number
+
+def compileProfile(name, section, base_dir=''):
+    """Takes a profile's section of the profiles file (a dictionary of
+       strings) and returns it compiled to a Profile - raises ValueError
+       if a setting is invalid. Settings that are left out get the
+       defaults of a new STKKConfig.ini"""
+    defaults = readUserPrefs(os.devnull)
+    profile = Profile()
+    profile.name = name
+
+    profile.model_index = findModel(section.get('model', str(defaults['selectedkeyboard'])))
+    if profile.model_index < 0:
+        raise ValueError("Profile %s: unknown model %s" % (name, section.get('model')))
+
+    profile.colors = [checkColor(name, key, section.get(key, defaults[key])) for key in COLOR_KEYS]
+
+    profile.palette_metric = section.get('palettemetric', defaults['palettemetric'])
+    if profile.palette_metric not in PALETTE_METRICS:
+        raise ValueError("Profile %s: unknown palette metric %s" % (name, profile.palette_metric))
+    velocity_brightness = section.get('velocitybrightness', str(defaults['velocitybrightness'])).strip().lower()
+    if velocity_brightness not in cfg.ConfigParser.BOOLEAN_STATES:
+        raise ValueError("Profile %s: velocitybrightness is not true or false: %s" % (name, velocity_brightness))
+    profile.velocity_brightness = cfg.ConfigParser.BOOLEAN_STATES[velocity_brightness]
+    profile.fade_time = checkNumber(name, 'fadetime', section.get('fadetime', str(defaults['fadetime'])), 0.0, 60.0)
+    profile.glow = checkNumber(name, 'glow', section.get('glow', str(defaults['glow'])), 0.0, 1.0)
+
+    # Map the colors for MK1 (7-bit RGB) and MK2 (palette index) buffers
+    profile.palette_file = os.path.join(base_dir, section.get('palettemap', PALETTE_FILE))
+    profile.palette_stamp = fileStamp(profile.palette_file)
+    palette_list = mapColorsToPalette(profile.colors, readPaletteMap(profile.palette_file), profile.palette_metric)
+    profile.color_lists = {1: [bytes(color) for color in palette_list],
+                           3: [bytes(RGBStringToTuple(color)) for color in profile.colors]}
+    return profile
+
+def fileHash(filename):
+    """Returns the SHA-1 digest of a file's contents, or 20 zero bytes if
+       it can't be read"""
+    try:
+        with open(filename, 'rb') as source_file:
+            return hashlib.sha1(source_file.read()).digest()
+    except OSError:
+        return bytes(20)
+
+class ProfileUnpickler(pickle.Unpickler):
+    """Unpickler for the profiles cache that only makes Profiles, so a
+       damaged or replaced cache file can't run other code"""
+
+    def find_class(self, module, name):
+        if (module, name) == (Profile.__module__, 'Profile'):
+            return Profile
+        raise pickle.UnpicklingError("Unexpected %s.%s in profiles cache" % (module, name))
+
+def profileSection(prefs, palette_file=PALETTE_FILE):
+    """Takes user prefs and returns them as a profiles file section"""
+    section = {'model': KK_MODELS[prefs['selectedkeyboard']].short_name,
+               'palettemap': palette_file}
+    for key in COLOR_KEYS + ['palettemetric', 'velocitybrightness', 'fadetime', 'glow']:
+        section[key] = str(prefs[key])
+    return section
+
+class ProfileStore:
+    """The profiles in a profiles file, compiled. Compiled profiles are
+       cached in CACHE_DIR along with the stamps of the files they were
+       compiled from, so while the profiles file and palette maps are
+       unchanged loading them parses nothing"""
+
+    filename = PROFILES_FILE   # Profiles file
+    cache_dir = CACHE_DIR      # Directory for the compiled profiles
+    cache_path = ""            # File the compiled profiles are cached in
+    profiles = {}              # Dictionary from name to compiled Profile
+    errors = {}                # Dictionary from name to the error of each invalid profile
+    stamps = {}                # Dictionary from each source file to its fileStamp when compiled
+
+    def __init__(self, filename=PROFILES_FILE, cache_dir=CACHE_DIR):
+        self.filename = filename
+        self.cache_dir = cache_dir
+        name_hash = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+        self.cache_path = os.path.join(cache_dir, 'Profiles-%s.pickle' % name_hash[:16])
+        self.profiles = {}
+        self.errors = {}
+        self.stamps = {}
+        self.load()
+
+    def load(self):
+        """Loads the compiled profiles, compiling them again if a source
+           file changed since they were cached"""
+        if not self.loadCache():
+            self.compile()
+            self.saveCache()
+
+    def current(self):
+        """Returns True if no source file changed since compiling"""
+        return bool(self.stamps) and all(fileStamp(filename) == stamp for filename, stamp in self.stamps.items())
+
+    def loadCache(self):
+        """Loads the cached profiles, returns False if there are none or they
+           are stale. The header is checked before anything is unpickled -
+           the cache must be of this version, compiled from the profiles
+           file as it is now, and not damaged"""
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                data = cache_file.read()
+            magic, version, source_hash, payload_hash = CACHE_HEADER.unpack_from(data)
+            if (magic != CACHE_MAGIC or version != PROFILE_CACHE_VERSION or
+                    source_hash != fileHash(self.filename)):
+                return False
+            payload = data[CACHE_HEADER.size:]
+            if hashlib.sha1(payload).digest() != payload_hash:
+                return False
+            cached = ProfileUnpickler(io.BytesIO(payload)).load()
+        except Exception:
+            return False
+        if not isinstance(cached, dict) or cached.get('version') != PROFILE_CACHE_VERSION:
+            return False
+        self.stamps = cached['stamps']
+        if not self.current():
+            self.stamps = {}
+            return False
+        self.profiles = cached['profiles']
+        self.errors = cached['errors']
+        return True
+
+    def saveCache(self):
+        """Writes the compiled profiles to the cache, if it is writable"""
+        cached = {'version': PROFILE_CACHE_VERSION, 'stamps': self.stamps,
+                  'profiles': self.profiles, 'errors': self.errors}
+        payload = pickle.dumps(cached)
+        header = CACHE_HEADER.pack(CACHE_MAGIC, PROFILE_CACHE_VERSION, fileHash(self.filename),
+                                   hashlib.sha1(payload).digest())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = self.cache_path + '.tmp'
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(header)
+                cache_file.write(payload)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            pass # Cache directory isn't writable, compile again next time
+
+    def compile(self):
+        """Parses and compiles every profile in the profiles file"""
+        self.profiles = {}
+        self.errors = {}
+        self.stamps = {self.filename: fileStamp(self.filename)}
+        profiles_file = cfg.ConfigParser()
+        profiles_file.read(self.filename)
+        base_dir = os.path.dirname(self.filename)
+        for name in profiles_file.sections():
+            try:
+                profile = compileProfile(name, profiles_file[name], base_dir)
+            except ValueError as e:
+                self.errors[name] = str(e)
+                continue
+            self.profiles[name] = profile
+            self.stamps[profile.palette_file] = profile.palette_stamp
+
+    def names(self):
+        """Returns the names of the valid profiles, sorted"""
+        return sorted(self.profiles)
+
+    def get(self, name):
+        """Returns a compiled Profile, raising KeyError if there is no
+           valid profile of that name. The profiles are reloaded first if
+           a source file changed"""
+        if not self.current():
+            self.load()
+        if name not in self.profiles:
+            raise KeyError(self.errors.get(name, "No profile named " + name))
+        return self.profiles[name]
+
+    def save(self, name, prefs, palette_file=PALETTE_FILE):
+        """Adds or replaces a profile with the given user prefs and
+           returns it compiled - raises ValueError if a setting is invalid"""
+        compileProfile(name, profileSection(prefs, palette_file), os.path.dirname(self.filename))
+        profiles_file = cfg.ConfigParser()
+        profiles_file.read(self.filename)
+        profiles_file[name] = profileSection(prefs, palette_file)
+        with open(self.filename, 'w') as configfile:
+            profiles_file.write(configfile)
+        self.compile()
+        self.saveCache()
+        return self.profiles[name]
@@ -0,0 +1,173 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Renders a MIDI file to a timeline of Light Guide frames
+#                   ahead of time, and plays timelines back to a keyboard
+#                   on a precise schedule
+#
+# Usage: python STKKRender.py render song.mid song.stkl [--model S61MK2]
+#        python STKKRender.py play song.stkl
+
+import sys
+import time
+import struct
+import argparse
+import mido
+from STKKEngine import LightGuideEngine, STKKError, KK_MODELS, COLOR_KEYS, CONFIG_FILE, readUserPrefs, findModel
+
+TIMELINE_MAGIC = b'STKL'
+TIMELINE_VERSION = 2
+TIMELINE_HEADER = struct.Struct('<4sBBHI')  # magic, version, model index, frame size, frame count
+TIMELINE_TIME = struct.Struct('<Q')         # frame time in microseconds
+TIMELINE_TIMES = {1: struct.Struct('<I'),   # Frame time format by version - version 1 times
+                  2: TIMELINE_TIME}         # overflowed after about 71 minutes
+SPIN_TIME = 0.002                           # Time (s) before a frame is due to stop sleeping and spin
+
+class LightTimeline:
+    """A song rendered to Light Guide frames - times[i] is the time in
+       seconds from the start of the song that frames[i] is shown.
+       Frames are complete lights buffers, ready to write"""
+
+    model_index = 0   # Index into KK_MODELS of the keyboard the frames are for
+    times = []        # Frame times in seconds
+    frames = []       # Frames as bytes, including the header byte
+
+    def __init__(self, model_index, times=None, frames=None):
+        self.model_index = model_index
+        self.times = times if times else []
+        self.frames = frames if frames else []
+
+    def save(self, path):
+        """Writes the timeline to a file"""
+        frame_size = len(self.frames[0]) if self.frames else 0
+        with open(path, 'wb') as timeline_file:
+            timeline_file.write(TIMELINE_HEADER.pack(TIMELINE_MAGIC, TIMELINE_VERSION,
+                                                     self.model_index, frame_size, len(self.frames)))
+            for frame_time, frame in zip(self.times, self.frames):
+                timeline_file.write(TIMELINE_TIME.pack(int(round(frame_time * 1e6))))
+                timeline_file.write(frame)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a timeline from a file"""
+        with open(path, 'rb') as timeline_file:
+            data = timeline_file.read()
+        magic, version, model_index, frame_size, count = TIMELINE_HEADER.unpack_from(data)
+        if magic != TIMELINE_MAGIC or version not in TIMELINE_TIMES:
+            raise ValueError(path + " is not a Light Guide timeline")
+        frame_time = TIMELINE_TIMES[version]
+        timeline = cls(model_index)
+        offset = TIMELINE_HEADER.size
+        for i in range(count):
+            timeline.times.append(frame_time.unpack_from(data, offset)[0] / 1e6)
+            offset += frame_time.size
+            timeline.frames.append(data[offset:offset + frame_size])
+            offset += frame_size
+        return timeline
+
+def renderMIDIFile(path, model_index, colors, prefs=None):
+    """Renders a MIDI file to a LightTimeline - colors is a list of RGB
+       strings in MIDI (finger) channel order. Messages with the same
+       time are combined into one frame, and frames that don't change
+       the lights are left out"""
+    engine = LightGuideEngine(prefs)
+    if not engine.setAttributes(model_index, colors):
+        raise STKKError("Unknown keyboard", "Unknown keyboard model: " + str(model_index))
+    output = engine.outputs[0]
+    timeline = LightTimeline(model_index)
+
+    song_time = 0.0
+    for message in mido.MidiFile(path):
+        if message.time > 0:
+            # Time moves on, so everything up to now makes one frame
+            if output.lights_dirty:
+                timeline.times.append(song_time)
+                timeline.frames.append(bytes(output.lights_buffer))
+                output.lights_dirty = False
+            song_time += message.time
+        if message.type == 'note_on' and message.velocity == 0:
+            # MIDI files often end notes with a zero velocity note_on
+            engine.MIDIMsgToLightGuide(message.note, 'note_off', message.channel, 0)
+        elif message.type in ('note_on', 'note_off'):
+            engine.MIDIMsgToLightGuide(message.note, message.type, message.channel, message.velocity)
+    if output.lights_dirty:
+        timeline.times.append(song_time)
+        timeline.frames.append(bytes(output.lights_buffer))
+    return timeline
+
+def playTimeline(timeline, show_frame, keep_running=lambda: True):
+    """Passes a timeline's frames to show_frame, each at its time from
+       now - for example a KeyboardOutput's writeAnimationFrame, so the
+       frames reach the keyboard through its frame writer. If playback
+       falls behind, frames that are already out of date are skipped.
+       Returns the latest a frame was shown (s)"""
+    times = timeline.times
+    frames = timeline.frames
+    start = time.perf_counter()
+    worst_lateness = 0.0
+    index = 0
+    while index < len(frames) and keep_running():
+        due = start + times[index]
+        # Sleep until just before the frame is due, then spin
+        delay = due - time.perf_counter() - SPIN_TIME
+        if delay > 0:
+            time.sleep(delay)
+        while time.perf_counter() < due:
+            pass
+        # Skip to the newest frame that is already due
+        now = time.perf_counter()
+        while index + 1 < len(frames) and start + times[index + 1] <= now:
+            index += 1
+        show_frame(frames[index])
+        worst_lateness = max(worst_lateness, now - (start + times[index]))
+        index += 1
+    return worst_lateness
+
+def main(argv=None):
+    """Renders MIDI files to timelines and plays them back"""
+    parser = argparse.ArgumentParser(description='Render MIDI files to Light Guide timelines and play them')
+    parser.add_argument('--config', default=CONFIG_FILE, help='user prefs file with the colors (default %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    render_parser = commands.add_parser('render', help='render a MIDI file to a timeline')
+    render_parser.add_argument('midi_file')
+    render_parser.add_argument('timeline_file')
+    render_parser.add_argument('--model', help='keyboard model index or name, e.g. S61MK2 (default from prefs)')
+    play_parser = commands.add_parser('play', help='play a timeline on the keyboard')
+    play_parser.add_argument('timeline_file')
+    args = parser.parse_args(argv)
+
+    prefs = readUserPrefs(args.config)
+    colors = [prefs[key] for key in COLOR_KEYS]
+    if args.command == 'render':
+        model_index = prefs['selectedkeyboard']
+        if args.model:
+            model_index = findModel(args.model)
+            if model_index < 0:
+                parser.error('unknown model ' + args.model)
+        timeline = renderMIDIFile(args.midi_file, model_index, colors, prefs)
+        timeline.save(args.timeline_file)
+        print('Rendered %d frames, %.1f s for %s' % (len(timeline.frames),
+              timeline.times[-1] if timeline.times else 0.0, KK_MODELS[model_index].name))
+    elif args.command == 'play':
+        timeline = LightTimeline.load(args.timeline_file)
+        engine = LightGuideEngine(prefs)
+        engine.setAttributes(timeline.model_index, colors)
+        try:
+            engine.connectToKeyboard()
+        except STKKError as e:
+            print(e.title + ': ' + str(e), file=sys.stderr)
+            return 1
+        try:
+            lateness = playTimeline(timeline, engine.outputs[0].writeAnimationFrame)
+            print('Played %d frames, latest frame %.2f ms late' % (len(timeline.frames), lateness * 1e3))
+        except KeyboardInterrupt:
+            pass
+        engine.lightsOut()
+        engine.disconnectFromKeyboard()
+    else:
+        parser.print_help()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
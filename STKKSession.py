@@ -0,0 +1,82 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Device session - watches the USB bus while the engine is
+#                   connected, so unplugged keyboards come back by themselves
+
+import threading
+
+DEFAULT_RECONNECT_INTERVAL = 0.5  # Seconds between looks at the USB bus
+
+class DeviceSession:
+    """Keeps the engine's keyboards connected. Every interval the NI
+       devices on the USB bus are listed - a keyboard that has gone, or
+       whose writes failed, is taken offline, and reconnected as soon as
+       it is back. The MIDI listener keeps running throughout. If
+       add_new is True, newly plugged in keyboards are lit as well"""
+
+    engine = None            # LightGuideEngine whose keyboards are watched
+    enumerate_devices = None # Function returning a (product ID, hidapi path) tuple per device
+    interval = DEFAULT_RECONNECT_INTERVAL
+    add_new = False          # Boolean to indicate new keyboards are added to the engine
+    stop_event = None        # Event set to stop the session thread
+    thread_handle = None     # Handle for the session thread
+
+    def __init__(self, engine, enumerate_devices, interval=DEFAULT_RECONNECT_INTERVAL, add_new=False):
+        self.engine = engine
+        self.enumerate_devices = enumerate_devices
+        self.interval = interval
+        self.add_new = add_new
+        self.stop_event = threading.Event()
+
+    def start(self):
+        self.thread_handle = threading.Thread(target=self.sessionThread, args=())
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread_handle:
+            self.thread_handle.join()
+            self.thread_handle = None
+
+    def sessionThread(self):
+        """Threaded method that polls the USB bus every interval"""
+        while not self.stop_event.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        """Looks at the USB bus once, taking keyboards offline and
+           reconnecting them as needed"""
+        try:
+            devices = list(self.enumerate_devices())
+        except Exception:
+            return
+
+        # Keyboards keep their own device first, so two keyboards of
+        # the same model don't swap places
+        unclaimed = list(devices)
+        found = {}
+        for output in self.engine.outputs:
+            if output.path is not None and (output.model.hid_id, output.path) in unclaimed:
+                found[output] = (output.model.hid_id, output.path)
+                unclaimed.remove(found[output])
+        for output in self.engine.outputs:
+            if output not in found:
+                for device in unclaimed:
+                    if device[0] == output.model.hid_id:
+                        found[output] = device
+                        unclaimed.remove(device)
+                        break
+
+        for output in self.engine.outputs:
+            device = found.get(output)
+            if device and output.path is None:
+                output.path = device[1]
+            if output.online and not device:
+                output.goOffline()
+            elif device and (not output.online or output.writeFailed()):
+                self.engine.reconnectOutput(output, device[1])
+        if self.add_new and unclaimed:
+            self.engine.addDevices(unclaimed)
@@ -0,0 +1,161 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Startup profiler - times each phase of starting the
+#                   GUI and each module imported before its window shows,
+#                   and checks startup stays within a time budget
+#
+# Usage: python SynthesiaToKK.py --startup-profile [--startup-budget SECONDS]
+#        starts the GUI, prints the times once the window has been drawn,
+#        and exits with status 1 if startup took longer than the budget or
+#        a deferred backend was imported
+
+import sys
+import time
+
+STARTUP_FLAG = '--startup-profile'   # Command line flag turning the profiler on
+DEFAULT_STARTUP_BUDGET = 0.5         # Seconds from the first line of the script to the first window
+DEFERRED_MODULES = ('mido', 'rtmidi', 'hid', 'numpy')  # Backends that should only load after Connect
+REPORT_IMPORTS = 15                  # Number of slowest imports listed
+
+active_profile = None                # StartupProfile while profiling, or None
+
+class TimedLoader:
+    """Wraps a module's loader to time loading the module. The module is
+       given back its own loader before it runs, so it never sees this one"""
+
+    loader = None     # Loader of the module
+    timer = None      # ImportTimer the time is added to
+    name = ""         # Name of the module
+
+    def __init__(self, loader, timer, name):
+        self.loader = loader
+        self.timer = timer
+        self.name = name
+
+    def create_module(self, spec):
+        # Extension modules are loaded here
+        self.timer.enter(self.name)
+        try:
+            return self.loader.create_module(spec)
+        finally:
+            self.timer.leave()
+
+    def exec_module(self, module):
+        module.__loader__ = self.loader
+        if getattr(module, '__spec__', None):
+            module.__spec__.loader = self.loader
+        self.timer.enter(self.name)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.timer.leave()
+
+    def __getattr__(self, attribute):
+        return getattr(self.loader, attribute)
+
+class ImportTimer:
+    """Import hook timing every module imported while it is installed,
+       like python -X importtime, which can't be turned on in a frozen
+       executable. times maps each module name to its (self, total) time
+       in seconds - total includes the modules it imported"""
+
+    times = {}        # Dictionary from module name to (self time, total time)
+    stack = []        # [name, start time, time of nested imports] of each import in progress
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path=None, target=None):
+        """Finds a module with the other finders and wraps its loader"""
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self, name)
+                return spec
+        return None
+
+    def enter(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    def leave(self):
+        name, start, nested = self.stack.pop()
+        total = time.perf_counter() - start
+        if self.stack:
+            self.stack[-1][2] += total
+        own, previous_total = self.times.get(name, (0.0, 0.0))
+        self.times[name] = (own + total - nested, previous_total + total)
+
+class StartupProfile:
+    """Times the phases of starting up, each from the end of the one
+       before, and the modules imported along the way"""
+
+    start = 0.0       # perf_counter() time the profile was created
+    mark = 0.0        # perf_counter() time the last phase ended
+    phases = []       # (name, seconds) of each phase, in order
+    imports = None    # ImportTimer of the modules imported
+
+    def __init__(self):
+        self.start = self.mark = time.perf_counter()
+        self.phases = []
+        self.imports = ImportTimer()
+        self.imports.install()
+
+    def phase(self, name):
+        """Ends a phase"""
+        now = time.perf_counter()
+        self.phases.append((name, now - self.mark))
+        self.mark = now
+
+    def total(self):
+        return self.mark - self.start
+
+    def deferredLoaded(self):
+        """Returns the DEFERRED_MODULES that have been imported"""
+        return [name for name in DEFERRED_MODULES if name in sys.modules]
+
+    def report(self, budget=DEFAULT_STARTUP_BUDGET, out=sys.stdout):
+        """Prints the phases and slowest imports, and returns True if
+           startup was within budget without importing a deferred backend"""
+        self.imports.uninstall()
+        print("%-28s %9s" % ('Startup phase', 'ms'), file=out)
+        for name, seconds in self.phases:
+            print("%-28s %9.1f" % (name, seconds * 1e3), file=out)
+        total = self.total()
+        print("%-28s %9.1f  (budget %.1f)" % ('Total', total * 1e3, budget * 1e3), file=out)
+        print("\n%-28s %9s %9s" % ('Slowest imports', 'self ms', 'total ms'), file=out)
+        slowest = sorted(self.imports.times.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (own, inclusive) in slowest[:REPORT_IMPORTS]:
+            print("%-28s %9.1f %9.1f" % (name, own * 1e3, inclusive * 1e3), file=out)
+        within = total <= budget
+        if not within:
+            print("\nStartup took %.1f ms, over its budget of %.1f ms" % (total * 1e3, budget * 1e3), file=out)
+        deferred = self.deferredLoaded()
+        if deferred:
+            print("\nLoaded before the first window: " + ', '.join(deferred), file=out)
+        return within and not deferred
+
+def startProfile():
+    """Starts profiling if the command line asks for it - call before
+       importing anything else"""
+    global active_profile
+    if STARTUP_FLAG in sys.argv and active_profile is None:
+        active_profile = StartupProfile()
+    return active_profile
+
+def startupPhase(name):
+    """Ends a startup phase, if profiling"""
+    if active_profile:
+        active_profile.phase(name)
@@ -0,0 +1,185 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Latency and throughput statistics for the Light Guide
+#                   pipeline, cheap enough to leave on all the time
+
+import math
+import time
+import json
+import threading
+
+BUCKETS_PER_OCTAVE = 4  # Histogram buckets per doubling of latency
+NUM_BUCKETS = 24 * BUCKETS_PER_OCTAVE + 1  # Covers 1 us to about 16 s
+PERCENTILES = (50, 95, 99)
+
+class LatencyHistogram:
+    """Histogram of latencies in logarithmic buckets, 4 per octave from
+       1 us, so percentiles are accurate to within about 19%. Recording
+       takes no lock - each histogram must only be recorded from one
+       thread, but can be read from any thread"""
+
+    counts = []   # Number of latencies recorded in each bucket
+    count = 0     # Number of latencies recorded
+    total = 0.0   # Sum of latencies recorded (s)
+    maximum = 0.0 # Largest latency recorded (s)
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+
+    def record(self, seconds):
+        """Records a latency in seconds"""
+        micros = seconds * 1e6
+        index = int(math.log2(micros) * BUCKETS_PER_OCTAVE) if micros > 1.0 else 0
+        self.counts[min(index, NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def merge(self, other):
+        """Adds the latencies recorded by another histogram to this one"""
+        for index, bucket_count in enumerate(list(other.counts)):
+            self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, pct):
+        """Returns the latency (s) that pct percent of recorded latencies
+           are below, as the upper edge of its bucket"""
+        if self.count == 0:
+            return 0.0
+        target = math.ceil(self.count * pct / 100.0)
+        seen = 0
+        for index, bucket_count in enumerate(list(self.counts)):
+            seen += bucket_count
+            if seen >= target:
+                return min(2.0 ** ((index + 1) / BUCKETS_PER_OCTAVE) / 1e6, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        """Returns a dictionary of the count, mean, max and percentiles in ms"""
+        result = {'count': self.count,
+                  'mean_ms': self.total / self.count * 1e3 if self.count else 0.0,
+                  'max_ms': self.maximum * 1e3}
+        for pct in PERCENTILES:
+            result['p%d_ms' % pct] = self.percentile(pct) * 1e3
+        return result
+
+class EngineStats:
+    """Timestamps and counters for the three points every MIDI event
+       passes through - receipt from the MIDI port, the lights buffer
+       update and the HID write completion. Events are counted on the
+       MIDI thread and frames on the writer thread"""
+
+    apply_latency = None   # MIDI receipt to buffer update
+    output_latency = None  # Buffer update to HID write completion
+    total_latency = None   # MIDI receipt to HID write completion
+    events = 0             # Number of MIDI note events applied
+    frames = 0             # Number of frames written to the keyboard
+    pending_receipt = None # Receipt time of the oldest event not yet in a frame
+    start_time = 0.0       # perf_counter() time the stats were created
+
+    def __init__(self):
+        self.apply_latency = LatencyHistogram()
+        self.output_latency = LatencyHistogram()
+        self.total_latency = LatencyHistogram()
+        self.start_time = time.perf_counter()
+
+    def eventApplied(self, receipt_time):
+        """Records that an event received at receipt_time is now in the buffer"""
+        self.apply_latency.record(time.perf_counter() - receipt_time)
+        self.events += 1
+        if self.pending_receipt is None:
+            self.pending_receipt = receipt_time
+
+    def frameSubmitted(self):
+        """Returns the (oldest receipt time, buffer update time) stamp
+           for a frame being sent, and starts gathering the next frame"""
+        stamp = (self.pending_receipt, time.perf_counter())
+        self.pending_receipt = None
+        return stamp
+
+    def frameWritten(self, stamp, done_time):
+        """Records that a frame with the given stamp finished writing"""
+        self.frames += 1
+        if stamp:
+            self.output_latency.record(done_time - stamp[1])
+            if stamp[0] is not None:
+                self.total_latency.record(done_time - stamp[0])
+
+    def snapshot(self):
+        """Returns a dictionary of the current counters and latencies"""
+        return {'time': time.time(),
+                'uptime_s': time.perf_counter() - self.start_time,
+                'events': self.events,
+                'frames': self.frames,
+                'apply': self.apply_latency.summary(),
+                'output': self.output_latency.summary(),
+                'total': self.total_latency.summary()}
+
+def addRates(snapshot, previous):
+    """Adds events/s and writes/s to a snapshot, and events/s to each
+       of its MIDI sources, measured since the previous snapshot (or
+       since the start if previous is None)"""
+    elapsed = snapshot['uptime_s'] - (previous['uptime_s'] if previous else 0.0)
+    if elapsed <= 0:
+        snapshot['events_per_s'] = snapshot['writes_per_s'] = 0.0
+        for source in snapshot.get('sources', []):
+            source['events_per_s'] = 0.0
+        return snapshot
+    snapshot['events_per_s'] = (snapshot['events'] - (previous['events'] if previous else 0)) / elapsed
+    snapshot['writes_per_s'] = (snapshot['frames'] - (previous['frames'] if previous else 0)) / elapsed
+    # Each MIDI source's rate, against the source of the same name before
+    previous_events = {source['name']: source['events'] for source in previous.get('sources', [])} if previous else {}
+    for source in snapshot.get('sources', []):
+        source['events_per_s'] = (source['events'] - previous_events.get(source['name'], 0)) / elapsed
+    return snapshot
+
+class StatsDumper:
+    """Appends a JSON snapshot of the stats to a file at a fixed interval"""
+
+    snapshot_func = None  # Function returning the current snapshot
+    path = ""             # File the snapshots are appended to
+    interval = 10.0       # Seconds between snapshots
+    stop_event = None     # Event set to stop the dumper thread
+    thread_handle = None  # Handle for the dumper thread
+
+    def __init__(self, snapshot_func, path, interval=10.0):
+        self.snapshot_func = snapshot_func
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def start(self):
+        self.thread_handle = threading.Thread(target=self.dumperThread, args=())
+        self.thread_handle.daemon = True
+        self.thread_handle.start()
+
+    def stop(self):
+        """Stops the dumper thread after writing a final snapshot"""
+        self.stop_event.set()
+        if self.thread_handle:
+            self.thread_handle.join()
+            self.thread_handle = None
+
+    def dumperThread(self):
+        """Threaded method that writes a snapshot every interval"""
+        previous = None
+        stopping = False
+        while not stopping:
+            stopping = self.stop_event.wait(self.interval)
+            previous = self.writeSnapshot(previous)
+
+    def writeSnapshot(self, previous):
+        """Appends a snapshot, with rates since the previous one, to the
+           file and returns it"""
+        snapshot = addRates(self.snapshot_func(), previous)
+        try:
+            with open(self.path, 'a') as stats_file:
+                stats_file.write(json.dumps(snapshot) + '\n')
+        except OSError:
+            pass
+        return snapshot
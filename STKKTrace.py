@@ -0,0 +1,383 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Trace recorder - keeps the latest MIDI note events and
+#                   Light Guide frames in a fixed-size memory-mapped ring
+#                   buffer, so laggy or stuck lights can be looked at, and
+#                   reproduced, after the fact
+#
+# Usage: python STKKTrace.py dump [STKKTrace.bin] [--last COUNT]
+#        python STKKTrace.py replay [STKKTrace.bin] [--session INDEX] [--speed FACTOR] [--fake]
+
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+import threading
+
+TRACE_FILE = 'STKKTrace.bin'          # Default trace file, next to STKKConfig.ini
+TRACE_MAGIC = b'STKT'
+TRACE_VERSION = 1
+DEFAULT_TRACE_SIZE = 4.0              # Default size of the ring buffer in MB
+TRACE_HEADER = struct.Struct('<4sHHQQQQQ')  # magic, version, unused, capacity, head, tail, used bytes, records written
+DATA_OFFSET = 64                      # Ring buffer data starts here, after the header
+RECORD_HEADER = struct.Struct('<BBHQ')  # kind, source, payload length, perfCounterNs() time
+SESSION_INFO = struct.Struct('<d')    # time.time() of the session start, followed by the model indices
+RECORD_PAD = 0       # Rest of the ring is unused, the next record is at the start
+RECORD_SESSION = 1   # Keyboards connected - source unused
+RECORD_MIDI = 2      # MIDI note event - status, note and velocity bytes
+RECORD_FRAME = 3     # Bytes written to a keyboard - source is its model index
+NOTE_ON_STATUS = 0x90
+NOTE_OFF_STATUS = 0x80
+
+def perfCounterNs():
+    """Returns time.perf_counter() in integer nanoseconds - perf_counter_ns()
+       is only in Python 3.7 and later, and releases are built on 3.6"""
+    return int(time.perf_counter() * 1e9)
+
+class TraceRecorder:
+    """Appends records to a ring buffer in a memory-mapped file, dropping
+       the oldest records to make room. The file's header is updated
+       after every record, so the file can be read at any time, even
+       after a crash. Opening an existing trace of the same size carries
+       on where it left off, so earlier sessions are kept. Records can
+       be added from any thread"""
+
+    path = ""          # Trace file
+    capacity = 0       # Bytes in the ring buffer
+    trace_file = None  # File object of the trace file
+    mm = None          # mmap of the trace file, None once closed
+    lock = None        # Serializes records
+    head = 0           # Offset in the ring where the next record goes
+    tail = 0           # Offset in the ring of the oldest record
+    used = 0           # Bytes of the ring holding records, including padding
+    records = 0        # Records written since the trace was created
+
+    def __init__(self, path=TRACE_FILE, size=DEFAULT_TRACE_SIZE):
+        self.path = path
+        self.capacity = max(int(size * 1024 * 1024), 4096)
+        self.lock = threading.Lock()
+        total = DATA_OFFSET + self.capacity
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.trace_file = open(path, mode)
+        try:
+            if os.fstat(self.trace_file.fileno()).st_size != total:
+                self.trace_file.truncate(total)
+            self.mm = mmap.mmap(self.trace_file.fileno(), total)
+        except Exception:
+            self.trace_file.close()
+            raise
+        magic, version, unused, capacity, head, tail, used, records = TRACE_HEADER.unpack_from(self.mm)
+        if magic == TRACE_MAGIC and version == TRACE_VERSION and capacity == self.capacity and used <= capacity:
+            self.head, self.tail, self.used, self.records = head, tail, used, records
+        self.writeHeader()
+
+    def writeHeader(self):
+        TRACE_HEADER.pack_into(self.mm, 0, TRACE_MAGIC, TRACE_VERSION, 0, self.capacity,
+                               self.head, self.tail, self.used, self.records)
+
+    def dropOldest(self):
+        """Frees the space of the oldest record"""
+        capacity = self.capacity
+        tail = self.tail
+        if capacity - tail < RECORD_HEADER.size:
+            size = capacity - tail
+        else:
+            kind, source, length, time_ns = RECORD_HEADER.unpack_from(self.mm, DATA_OFFSET + tail)
+            size = capacity - tail if kind == RECORD_PAD else RECORD_HEADER.size + length
+        self.tail = (tail + size) % capacity
+        self.used -= size
+
+    def record(self, kind, source, payload, time_ns=None):
+        """Appends a record with a payload (bytes) - the time defaults to now"""
+        if time_ns is None:
+            time_ns = perfCounterNs()
+        size = RECORD_HEADER.size + len(payload)
+        with self.lock:
+            mm = self.mm
+            if mm is None or size > self.capacity // 2:
+                return
+            capacity = self.capacity
+            # A record that doesn't fit before the end goes at the start
+            skip = capacity - self.head if self.head + size > capacity else 0
+            while capacity - self.used < skip + size:
+                self.dropOldest()
+            if skip:
+                if skip >= RECORD_HEADER.size:
+                    RECORD_HEADER.pack_into(mm, DATA_OFFSET + self.head, RECORD_PAD, 0, 0, 0)
+                self.used += skip
+                self.head = 0
+            offset = DATA_OFFSET + self.head
+            RECORD_HEADER.pack_into(mm, offset, kind, source, len(payload), time_ns)
+            mm[offset + RECORD_HEADER.size:offset + size] = payload
+            self.head = (self.head + size) % capacity
+            self.used += size
+            self.records += 1
+            self.writeHeader()
+
+    def noteEvent(self, message):
+        """Records a mido note message"""
+        status = (NOTE_ON_STATUS if message.type == 'note_on' else NOTE_OFF_STATUS) | message.channel
+        self.record(RECORD_MIDI, 0, bytes((status, message.note, message.velocity)))
+
+    def session(self, model_indices):
+        """Records the start of a session lighting keyboards of the given models"""
+        self.record(RECORD_SESSION, 0, SESSION_INFO.pack(time.time()) + bytes(model_indices))
+
+    def close(self):
+        """Writes the trace out and closes the file"""
+        with self.lock:
+            if self.mm is None:
+                return
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+            self.trace_file.close()
+
+class TracingTransport:
+    """Wraps a transport, recording every write to a TraceRecorder"""
+
+    transport = None   # Transport the writes are passed on to
+    trace = None       # TraceRecorder the writes are recorded to
+    source = 0         # Model index of the keyboard, recorded with each write
+
+    def __init__(self, transport, trace, source):
+        self.transport = transport
+        self.trace = trace
+        self.source = source
+
+    def open(self):
+        self.transport.open()
+
+    def write(self, data):
+        self.trace.record(RECORD_FRAME, self.source, bytes(data))
+        return self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+def readRecords(path):
+    """Returns the records of a trace file, oldest first, as a list of
+       (kind, source, perfCounterNs() time, payload) tuples"""
+    with open(path, 'rb') as trace_file:
+        data = trace_file.read()
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError(path + " is not a Light Guide trace")
+    magic, version, unused, capacity, head, tail, used, records = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or len(data) < DATA_OFFSET + capacity:
+        raise ValueError(path + " is not a Light Guide trace")
+    result = []
+    offset = tail
+    remaining = used
+    while remaining > 0:
+        if capacity - offset < RECORD_HEADER.size:
+            kind = RECORD_PAD
+        else:
+            kind, source, length, time_ns = RECORD_HEADER.unpack_from(data, DATA_OFFSET + offset)
+        if kind == RECORD_PAD:
+            remaining -= capacity - offset
+            offset = 0
+            continue
+        start = DATA_OFFSET + offset + RECORD_HEADER.size
+        result.append((kind, source, time_ns, data[start:start + length]))
+        size = RECORD_HEADER.size + length
+        remaining -= size
+        offset = (offset + size) % capacity
+    return result
+
+def splitSessions(records):
+    """Splits records into sessions, returning a list of (start time,
+       model indices, records) tuples - records before the first session
+       start, left from a session mostly overwritten, are a session with
+       no start time or models"""
+    sessions = []
+    current = (None, [], [])
+    for record in records:
+        if record[0] == RECORD_SESSION:
+            if current[2] or current[0] is not None:
+                sessions.append(current)
+            info = record[3]
+            current = (SESSION_INFO.unpack_from(info)[0], list(info[SESSION_INFO.size:]), [record])
+        else:
+            current[2].append(record)
+    if current[2]:
+        sessions.append(current)
+    return sessions
+
+def describeRecord(record, models):
+    """Returns a line of text describing a record"""
+    kind, source, time_ns, payload = record
+    if kind == RECORD_MIDI:
+        status, note, velocity = payload[0], payload[1], payload[2]
+        name = 'note_on' if status & 0xF0 == NOTE_ON_STATUS else 'note_off'
+        return '%-9s channel %2d  note %3d  velocity %3d' % (name, status & 0x0F, note, velocity)
+    if kind == RECORD_FRAME:
+        name = models[source].short_name if source < len(models) else str(source)
+        if len(payload) < 2:
+            return 'command   %-8s %s' % (name, bytes(payload).hex())
+        scale = models[source].buffer_scale if source < len(models) else 1
+        lit = sum(1 for start in range(1, len(payload), scale) if any(payload[start:start + scale]))
+        return 'frame     %-8s %3d keys lit' % (name, lit)
+    if kind == RECORD_SESSION:
+        return 'session   ' + ', '.join(models[index].short_name for index in payload[SESSION_INFO.size:]
+                                         if index < len(models))
+    return 'unknown record kind %d' % kind
+
+def frameLatencies(records):
+    """Returns the time (s) from each MIDI event to the next frame written"""
+    latencies = []
+    waiting = []
+    for kind, source, time_ns, payload in records:
+        if kind == RECORD_MIDI:
+            waiting.append(time_ns)
+        elif kind == RECORD_FRAME and len(payload) > 1 and waiting:
+            latencies += [(time_ns - event_ns) / 1e9 for event_ns in waiting]
+            waiting = []
+        elif kind == RECORD_SESSION:
+            waiting = []
+    return latencies
+
+def dump(path, last=0, out=sys.stdout):
+    """Prints the records of a trace, or only the last ones, with a
+       summary of each session's event-to-frame latency"""
+    from STKKEngine import KK_MODELS
+    from STKKStats import LatencyHistogram
+    for start_time, model_indices, records in splitSessions(readRecords(path)):
+        if start_time is None:
+            print('Session start overwritten', file=out)
+        else:
+            print('Session started %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)), file=out)
+        origin = records[0][2]
+        for record in records[-last:] if last else records:
+            print('%12.6f  %s' % ((record[2] - origin) / 1e9, describeRecord(record, KK_MODELS)), file=out)
+        histogram = LatencyHistogram()
+        for latency in frameLatencies(records):
+            histogram.record(latency)
+        summary = histogram.summary()
+        print('%d MIDI events, %d frames, event to frame latency p50 %.2f ms  p99 %.2f ms  max %.2f ms\n' % (
+              sum(1 for record in records if record[0] == RECORD_MIDI),
+              sum(1 for record in records if record[0] == RECORD_FRAME and len(record[3]) > 1),
+              summary['p50_ms'], summary['p99_ms'], summary['max_ms']), file=out)
+
+class TracePlayer:
+    """MIDI input port playing back the MIDI events of a trace. Pass its
+       open_input in place of mido.open_input, then play() sends the
+       events to the port's callback with their recorded timing"""
+
+    events = []     # (perfCounterNs() time, payload) of each MIDI event
+    callback = None # Callback passed to open_input
+    opened = None   # Event set once the port has been opened
+
+    def __init__(self, records):
+        self.events = [(record[2], record[3]) for record in records if record[0] == RECORD_MIDI]
+        self.opened = threading.Event()
+
+    def open_input(self, name=None, callback=None):
+        self.callback = callback
+        self.opened.set()
+        return self
+
+    def close(self):
+        self.callback = None
+
+    def play(self, speed=1.0, keep_running=lambda: True):
+        """Sends the events, speed times faster than recorded, or as fast
+           as possible if speed is 0. Returns the number of events sent"""
+        import mido
+        messages = [(time_ns, mido.Message.from_bytes(payload)) for time_ns, payload in self.events]
+        if not messages:
+            return 0
+        origin = messages[0][0]
+        start = time.perf_counter()
+        sent = 0
+        for time_ns, message in messages:
+            callback = self.callback
+            if not callback or not keep_running():
+                break
+            if speed > 0:
+                delay = start + (time_ns - origin) / 1e9 / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            callback(message)
+            sent += 1
+        return sent
+
+def replay(path, session_index=-1, speed=1.0, fake=False, out=sys.stdout):
+    """Replays the MIDI events of a trace session through the engine, to
+       the keyboards it was recorded with, or to fake keyboards, and
+       prints the engine's latencies"""
+    from STKKEngine import LightGuideEngine, STKKError, COLOR_KEYS, CONFIG_FILE, readUserPrefs
+    from STKKHid import FakeTransport
+    sessions = [session for session in splitSessions(readRecords(path))
+                if any(record[0] == RECORD_MIDI for record in session[2])]
+    if not sessions:
+        print('No MIDI events in ' + path, file=out)
+        return 1
+    start_time, model_indices, records = sessions[session_index]
+    prefs = readUserPrefs(CONFIG_FILE)
+    prefs['tracefile'] = ''  # Don't record the replay over the trace
+    if not model_indices:
+        model_indices = [prefs['selectedkeyboard']]
+    player = TracePlayer(records)
+    transport_factory = (lambda model, path: FakeTransport(0.0)) if fake else None
+    engine = LightGuideEngine(prefs, transport_factory, player.open_input)
+    engine.sweep_loops = 0
+    try:
+        engine.startKeyboards([(index, None) for index in model_indices], [prefs[key] for key in COLOR_KEYS], 'trace')
+    except STKKError as e:
+        print(e.title + ': ' + str(e), file=out)
+        return 1
+    player.opened.wait()
+    started = time.perf_counter()
+    try:
+        sent = player.play(speed, lambda: engine.listening())
+    except KeyboardInterrupt:
+        sent = 0
+    time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    snapshot = engine.statsSnapshot()
+    engine.stop()
+    recorded = sum(1 for record in records if record[0] == RECORD_FRAME and len(record[3]) > 1)
+    print('Replayed %d MIDI events in %.2f s, %d frames written (%d recorded)' % (sent, elapsed,
+          snapshot['frames'], recorded), file=out)
+    print('Latency (ms)        p50      p95      p99', file=out)
+    for name, key in (("MIDI to buffer", 'apply'), ("Buffer to USB", 'output'), ("End to end", 'total')):
+        print('%-16s %7.2f  %7.2f  %7.2f' % (name, snapshot[key]['p50_ms'], snapshot[key]['p95_ms'],
+                                             snapshot[key]['p99_ms']), file=out)
+    return 0
+
+def main(argv=None):
+    """Dumps and replays trace files"""
+    parser = argparse.ArgumentParser(description='Dump and replay Light Guide traces')
+    commands = parser.add_subparsers(dest='command')
+    dump_parser = commands.add_parser('dump', help='print the records of a trace')
+    dump_parser.add_argument('trace_file', nargs='?', default=TRACE_FILE)
+    dump_parser.add_argument('--last', type=int, default=0, help='only print the last COUNT records of each session')
+    replay_parser = commands.add_parser('replay', help='play the MIDI events of a trace through the engine')
+    replay_parser.add_argument('trace_file', nargs='?', default=TRACE_FILE)
+    replay_parser.add_argument('--session', type=int, default=-1, help='session to replay, -1 for the last (default)')
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+                               help='times faster than recorded, 0 for as fast as possible (default 1)')
+    replay_parser.add_argument('--fake', action='store_true', help='replay to fake keyboards instead of the real ones')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'dump':
+            dump(args.trace_file, args.last)
+        elif args.command == 'replay':
+            return replay(args.trace_file, args.session, args.speed, args.fake)
+        else:
+            parser.print_help()
+    except (OSError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    except IndexError:
+        print('No session %d in %s' % (args.session, args.trace_file), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Measures the cost of one effects tick - fading every
+#                   key and composing the frame with glow - for each
+#                   keyboard model, which should stay flat from S25 to S88
+#
+# Usage: python benchmarks/bench_effects.py [--ticks COUNT] [--fade SECONDS] [--glow BRIGHTNESS]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKEngine import KK_MODELS
+from STKKEffects import EffectStage, EFFECTS_AVAILABLE, EFFECT_TICK
+from STKKAnimation import blankFrame, paintKey
+
+def measure(model, ticks, fade_time, glow):
+    """Releases every key of a fully lit keyboard, then returns the
+       mean time (s) of a tick while they fade"""
+    stage = EffectStage(model, max(1, int(round(fade_time / EFFECT_TICK))), glow)
+    lights_buffer = blankFrame(model)
+    color = bytes((0x7F, 0x40, 0x00)) if model.buffer_scale == 3 else bytes((0x17,))
+    for key in range(model.num_keys):
+        paintKey(lights_buffer, model, key, color)
+    stage.render(lights_buffer)
+    lights_buffer = blankFrame(model)
+    stage.render(lights_buffer)
+
+    start = time.perf_counter()
+    for i in range(ticks):
+        if not stage.active():
+            stage.intensity[:] = 1.0
+        stage.advance()
+        stage.render(lights_buffer)
+    return (time.perf_counter() - start) / ticks
+
+def main():
+    parser = argparse.ArgumentParser(description='Light Guide effects tick benchmark')
+    parser.add_argument('--ticks', type=int, default=5000, help='number of ticks to time per model')
+    parser.add_argument('--fade', type=float, default=0.5, help='fade time in seconds')
+    parser.add_argument('--glow', type=float, default=0.3, help='glow brightness, 0 for none')
+    args = parser.parse_args()
+    if not EFFECTS_AVAILABLE:
+        print('Effects need NumPy, which is not installed')
+        return
+
+    print("%-10s %6s %12s %14s" % ('model', 'keys', 'tick (us)', 'tick budget %'))
+    for model in sorted(KK_MODELS, key=lambda kk_model: kk_model.num_keys):
+        tick_time = measure(model, args.ticks, args.fade, args.glow)
+        print("%-10s %6d %12.1f %14.2f" % (model.short_name, model.num_keys, tick_time * 1e6,
+                                           100.0 * tick_time / EFFECT_TICK))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Micro-benchmarks of the Light Guide hot path for every
+#                   keyboard model, checked against committed baselines -
+#                   exits with status 1 if any has slowed down by more
+#                   than the threshold, so a change that slows the hot
+#                   path is caught, and an optimization can be kept.
+#                   Benchmarks over the threshold are checked again, and
+#                   only fail if they are slower every time
+#
+# Usage: python benchmarks/bench_micro.py [--filter TEXT] [--threshold FRACTION]
+#                                         [--baselines FILE] [--save]
+#
+# Run with --save after a deliberate change in speed to record new
+# baselines. Each sample times a batch of calls and then a batch of a
+# fixed reference workload, and the benchmark is compared as the median
+# over the samples of its time as a multiple of the reference's, so the
+# baselines hold on faster or slower machines, while the CPU's clock
+# speed changes and while other programs are running. Timings under a
+# microsecond are noisier, so they may be FAST_THRESHOLD slower
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKEngine import LightGuideEngine, KK_MODELS, COLOR_KEYS, PALETTE_FILE
+from STKKHid import FakeTransport
+from STKKPalette import RGBStringToTuple, mapRGBStringToPalette, readPaletteMap
+from STKKAnimation import sweepFrames
+from benchutil import benchPrefs
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+DEFAULT_THRESHOLD = 0.25   # Fraction slower than its baseline a benchmark may be
+FAST_THRESHOLD = 0.5       # Fraction slower a benchmark whose operations take under FAST_NS may be
+FAST_NS = 1000.0           # Operations faster than this (ns) use FAST_THRESHOLD
+SAMPLES = 9                # Samples of each benchmark, the median is used
+RECHECKS = 3               # Times a benchmark slower than the threshold is run again before it fails
+RUN_TIME = 0.02            # Least time (s) of the batch of calls timed in one sample
+
+def makeEngine(prefs, model_index):
+    """Returns an engine lighting a fake keyboard of a model"""
+    engine = LightGuideEngine(prefs, lambda model, path: FakeTransport(0.0))
+    engine.sweep_loops = 0
+    engine.setAttributes(model_index, [prefs[key] for key in COLOR_KEYS])
+    engine.connectToKeyboard()
+    return engine
+
+def writeColorToBuffer(engine):
+    """Lights every key, then turns every key off"""
+    output = engine.outputs[0]
+    on_color = output.color_list[1]
+    off_color = output.off_color
+    keys = range(output.model.num_keys)
+    def run():
+        for key in keys:
+            output.writeColorToBuffer(on_color, key)
+        for key in keys:
+            output.writeColorToBuffer(off_color, key)
+    return run, 2 * output.model.num_keys
+
+def MIDIMsgToLightGuide(engine):
+    """Plays every note of the keyboard on a finger channel, then releases them"""
+    model = engine.model
+    notes = [note for note in range(128) if 0 <= note + model.note_offset < model.num_keys]
+    handle = engine.MIDIMsgToLightGuide
+    def run():
+        for note in notes:
+            handle(note, 'note_on', 1 + note % 10, 100)
+        for note in notes:
+            handle(note, 'note_off', 1 + note % 10, 0)
+    return run, 2 * len(notes)
+
+def lightsOut(engine):
+    """Turns off every light and sends the frame"""
+    return engine.lightsOut, 1
+
+def sweepFrameGeneration(engine):
+    """Builds the frames of one loop of the connect sweep"""
+    model = engine.model
+    return (lambda: sweepFrames(model, 1)), 1
+
+def setAttributes(engine):
+    """Builds the model's lights buffer, colors, animations and note
+       tables - on an engine of its own, as it replaces the outputs"""
+    colors = list(engine.colors)
+    model_index = KK_MODELS.index(engine.model)
+    scratch = LightGuideEngine(transport_factory=engine.transport_factory)
+    return (lambda: scratch.setAttributes(model_index, colors)), 1
+
+def colorsToPaletteList(engine):
+    """Maps the finger colors to the MK2 palette, as setAttributes does"""
+    colors = list(engine.colors)
+    engine.colorsToPaletteList(colors) # Builds the palette cube the first time
+    return (lambda: engine.colorsToPaletteList(colors)), len(colors)
+
+def RGBStringConversion(engine):
+    """Converts an RGB string to a 7-bit RGB tuple"""
+    return (lambda: RGBStringToTuple('#ff8000')), 1
+
+def paletteSearch(engine):
+    """Finds the nearest palette color to an RGB string without the palette cube"""
+    palette_map = readPaletteMap(PALETTE_FILE)
+    return (lambda: mapRGBStringToPalette('#ff8000', palette_map)), 1
+
+# Benchmarks as (name, setup) - setup takes an engine and returns
+# (function to time, operations per call). Model benchmarks are run for
+# each keyboard model, color benchmarks once as they are the same for all
+MODEL_BENCHMARKS = (('writeColorToBuffer', writeColorToBuffer),
+                    ('MIDIMsgToLightGuide', MIDIMsgToLightGuide),
+                    ('lightsOut', lightsOut),
+                    ('sweepFrames', sweepFrameGeneration),
+                    ('setAttributes', setAttributes))
+COLOR_BENCHMARKS = (('colorsToPaletteList', colorsToPaletteList),
+                    ('RGBStringToTuple', RGBStringConversion),
+                    ('mapRGBStringToPalette', paletteSearch))
+
+def referenceWork():
+    """Fixed pure Python workload the benchmarks are measured against -
+       indexing, slicing and calls, like the hot path"""
+    frame = bytearray(265)
+    color = bytes((0x7F, 0x40, 0x00))
+    for key in range(88):
+        start = 1 + key * 3
+        if frame[start:start + 3] != color:
+            frame[start:start + 3] = color
+    return bytes(frame)
+
+def calibrate(timer):
+    """Returns how many calls of a timer take at least RUN_TIME"""
+    number = 1
+    while timer.timeit(number) < RUN_TIME:
+        number *= 2
+    return number
+
+class Timing:
+    """Median times of a benchmark"""
+
+    ns = 0.0             # Time (ns) per operation
+    reference_ns = 0.0   # Time (ns) of referenceWork()
+    ratio = 0.0          # Time per operation as a multiple of the reference's
+
+    def __init__(self, ns, reference_ns, ratio):
+        self.ns = ns
+        self.reference_ns = reference_ns
+        self.ratio = ratio
+
+def timeCall(func, ops):
+    """Returns a Timing of func() - the medians over SAMPLES samples, each
+       timing a batch of calls of func() and then a batch of
+       referenceWork()"""
+    timer = timeit.Timer(func)
+    reference = timeit.Timer(referenceWork)
+    number = calibrate(timer)
+    reference_number = calibrate(reference)
+    times = []
+    reference_times = []
+    for i in range(SAMPLES):
+        times.append(timer.timeit(number) / number / ops * 1e9)
+        reference_times.append(reference.timeit(reference_number) / reference_number * 1e9)
+    ratios = [now / base for now, base in zip(times, reference_times)]
+    return Timing(statistics.median(times), statistics.median(reference_times), statistics.median(ratios))
+
+def runBenchmarks(wanted=lambda name: True):
+    """Runs the benchmarks for whose names wanted(name) is True and returns a
+       dictionary from name to its Timing"""
+    prefs = benchPrefs()
+    results = {}
+    runs = [(name + '/' + model.short_name, setup, model_index)
+            for model_index, model in enumerate(KK_MODELS) for name, setup in MODEL_BENCHMARKS]
+    runs += [(name, setup, 0) for name, setup in COLOR_BENCHMARKS]
+    engines = {}
+    for name, setup, model_index in runs:
+        if not wanted(name):
+            continue
+        if model_index not in engines:
+            engines[model_index] = makeEngine(prefs, model_index)
+        results[name] = timeCall(*setup(engines[model_index]))
+    for engine in engines.values():
+        engine.disconnectFromKeyboard()
+    return results
+
+def baseRatio(base):
+    """Returns a baseline's time as a multiple of the reference's"""
+    return base.get('ratio') or base['ns'] / base['reference_ns']
+
+def compare(results, baselines, threshold, out=sys.stdout):
+    """Prints each result against its baseline and returns the names of
+       the benchmarks slower than their baseline by more than threshold,
+       or FAST_THRESHOLD if that is more and the baseline is under
+       FAST_NS, both measured in reference workloads"""
+    regressions = []
+    print("%-34s %12s %12s %9s" % ('benchmark', 'base (ns)', 'now (ns)', 'change'), file=out)
+    for name, timing in results.items():
+        base = baselines.get(name)
+        if not base:
+            print("%-34s %12s %12.1f %9s" % (name, '-', timing.ns, 'new'), file=out)
+            continue
+        change = timing.ratio / baseRatio(base) - 1.0
+        allowed = max(threshold, FAST_THRESHOLD) if base['ns'] < FAST_NS else threshold
+        flag = ''
+        if change > allowed:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print("%-34s %12.1f %12.1f %+8.1f%%%s" % (name, base['ns'], timing.ns, change * 100.0, flag), file=out)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Light Guide hot path micro-benchmarks')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose names contain TEXT, e.g. S88MK2')
+    parser.add_argument('--threshold', type=float,
+                        help='fraction slower than the baseline that fails (default from the baselines file)')
+    parser.add_argument('--baselines', default=BASELINES_FILE, help='baselines file (default %(default)s)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baselines')
+    args = parser.parse_args()
+
+    try:
+        with open(args.baselines) as baselines_file:
+            saved = json.load(baselines_file)
+    except (OSError, ValueError):
+        saved = {'threshold': DEFAULT_THRESHOLD, 'results': {}}
+    threshold = args.threshold if args.threshold is not None else saved.get('threshold', DEFAULT_THRESHOLD)
+
+    results = runBenchmarks(lambda name: args.filter.lower() in name.lower())
+    regressions = compare(results, saved.get('results', {}), threshold)
+    for i in range(RECHECKS):
+        if not regressions or args.save:
+            break
+        # Run the slow ones again, they only fail if slower every time
+        print("Checking %d slower benchmarks again" % len(regressions))
+        rechecked = runBenchmarks(lambda name: name in regressions)
+        regressions = [name for name in compare(rechecked, saved.get('results', {}), threshold)
+                       if name in regressions]
+    if args.save:
+        # Baselines are the medians of several passes
+        passes = [results] + [runBenchmarks(lambda name: name in results) for i in range(RECHECKS)]
+        for name in results:
+            timings = [timings[name] for timings in passes]
+            results[name] = Timing(statistics.median(timing.ns for timing in timings),
+                                   statistics.median(timing.reference_ns for timing in timings),
+                                   statistics.median(timing.ratio for timing in timings))
+        saved['threshold'] = threshold
+        saved['machine'] = '%s, Python %s' % (platform.platform(), platform.python_version())
+        saved.setdefault('results', {}).update({name: {'ns': round(timing.ns, 1),
+                                                       'reference_ns': round(timing.reference_ns, 1),
+                                                       'ratio': round(timing.ratio, 6)}
+                                                for name, timing in results.items()})
+        with open(args.baselines, 'w') as baselines_file:
+            json.dump(saved, baselines_file, indent=2, sort_keys=True)
+            baselines_file.write('\n')
+        print("Saved baselines to " + args.baselines)
+        return 0
+    if regressions:
+        print("%d benchmarks more than %.0f%% (%.0f%% under %.0f ns) slower than their baselines: %s" %
+              (len(regressions), threshold * 100.0, max(threshold, FAST_THRESHOLD) * 100.0, FAST_NS,
+               ', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
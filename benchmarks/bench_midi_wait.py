@@ -0,0 +1,133 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Measures idle CPU use and note-to-light latency
+#                   for each MIDI receive wait strategy, and how many
+#                   frames are sent for bursts of chords
+#
+# Usage: python benchmarks/bench_midi_wait.py [--idle SECONDS] [--notes COUNT] [--chords COUNT]
+
+import os
+import sys
+import time
+import threading
+import argparse
+from collections import deque
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKMidi import MIDIReceiver, WAIT_STRATEGIES
+from benchutil import percentile
+
+class FakeInputPort:
+    """Stand-in for a mido input port - messages passed to send() are
+       delivered to the callback, or queued for iter_pending() if none"""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.pending = deque()
+
+    def send(self, message):
+        if self.callback:
+            self.callback(message)
+        else:
+            self.pending.append(message)
+
+    def iter_pending(self):
+        while self.pending:
+            yield self.pending.popleft()
+
+    def close(self):
+        pass
+
+def legacyLoop(port, handler, frame_handler, keep_running):
+    """The original busy-polling receive loop, kept for comparison"""
+    while keep_running():
+        for message in port.iter_pending():
+            handler(message)
+            frame_handler()
+
+def measure(strategy, idle_time, note_count, chord_count):
+    """Runs one strategy and returns (idle CPU %, note-to-frame latencies
+       in seconds, frames sent per 10 note chord, stop time in seconds)"""
+    latencies = []
+    applied = []
+    frames = [0]
+    ports = []
+    state = {'listen': True}
+
+    def handler(message):
+        applied.append(message.sent)
+
+    def frame_handler():
+        now = time.perf_counter()
+        latencies.extend(now - sent for sent in applied)
+        del applied[:]
+        frames[0] += 1
+
+    def open_input(name, callback=None):
+        ports.append(FakeInputPort(callback))
+        return ports[-1]
+
+    if strategy == 'legacy':
+        open_input('fake')
+        target = lambda: legacyLoop(ports[0], handler, frame_handler, lambda: state['listen'])
+    else:
+        receiver = MIDIReceiver('fake', handler, frame_handler, strategy, open_input=open_input)
+        target = lambda: receiver.run(lambda: state['listen'])
+    thread = threading.Thread(target=target)
+    thread.start()
+    while not ports:
+        time.sleep(0.001)
+
+    # Idle CPU, measured while no messages arrive
+    time.sleep(0.1)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    time.sleep(idle_time)
+    idle_cpu = 100.0 * (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+    # Note-to-light latency, with notes spaced out so each one
+    # arrives while the receiver is waiting and the frame rate allows it
+    for i in range(note_count):
+        note_type = 'note_on' if i % 2 == 0 else 'note_off'
+        ports[0].send(SimpleNamespace(type=note_type, note=60 + i % 12, channel=i % 11,
+                                      velocity=64, sent=time.perf_counter()))
+        time.sleep(0.015)
+
+    # Frames per chord, with each chord sent as a burst of ten notes
+    time.sleep(0.05)
+    note_latencies = list(latencies)
+    frames[0] = 0
+    for i in range(chord_count):
+        for note in range(60, 70):
+            ports[0].send(SimpleNamespace(type='note_on', note=note, channel=1,
+                                          velocity=64, sent=time.perf_counter()))
+        time.sleep(0.02)
+    time.sleep(0.05)
+    chord_frames = float(frames[0]) / chord_count if chord_count else 0.0
+
+    state['listen'] = False
+    stop_start = time.perf_counter()
+    thread.join()
+    stop_time = time.perf_counter() - stop_start
+    return idle_cpu, note_latencies, chord_frames, stop_time
+
+def main():
+    parser = argparse.ArgumentParser(description='MIDI wait strategy benchmark')
+    parser.add_argument('--idle', type=float, default=2.0, help='seconds of idle time to measure')
+    parser.add_argument('--notes', type=int, default=200, help='number of notes to time')
+    parser.add_argument('--chords', type=int, default=50, help='number of ten note chords to send')
+    args = parser.parse_args()
+
+    print("%-10s %10s %12s %12s %12s %14s %10s" % ('strategy', 'idle CPU', 'p50 (us)', 'p95 (us)',
+                                                'p99 (us)', 'frames/chord', 'stop (ms)'))
+    for strategy in ('legacy',) + WAIT_STRATEGIES:
+        idle_cpu, latencies, chord_frames, stop_time = measure(strategy, args.idle, args.notes, args.chords)
+        print("%-10s %9.1f%% %12.1f %12.1f %12.1f %14.1f %10.1f" % (strategy, idle_cpu,
+            percentile(latencies, 50) * 1e6, percentile(latencies, 95) * 1e6,
+            percentile(latencies, 99) * 1e6, chord_frames, stop_time * 1e3))
+
+if __name__ == '__main__':
+    main()
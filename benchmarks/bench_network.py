@@ -0,0 +1,102 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Measures the latency network MIDI input adds over a
+#                   local loopback port, with a UDP sender over the
+#                   loopback interface standing in for the remote machine,
+#                   and checks lost datagrams are counted
+#
+# Usage: python benchmarks/bench_network.py [--rate EVENTS_PER_S] [--events COUNT]
+#                                           [--drop FRACTION] [--udp-port PORT]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKEngine import LightGuideEngine, KK_MODELS, COLOR_KEYS
+from STKKHid import FakeTransport
+from STKKMidi import MIDIStorm, stormMessages, STORM_RANDOM
+from STKKNet import UDPMIDISender, SEQUENCE_MASK
+from benchutil import benchPrefs, percentile, eventLatencies
+
+def playNetwork(sender, messages, rate, drop, seed=0):
+    """Sends each message in its own datagram at rate events per second,
+       like STKKNet.forward, skipping a drop fraction of the datagrams.
+       Returns (send times of the delivered messages, datagrams dropped)"""
+    rng = random.Random(seed)
+    send_times = []
+    dropped = 0
+    start = time.perf_counter()
+    for index, message in enumerate(messages):
+        due = start + index / rate
+        while time.perf_counter() < due:
+            time.sleep(0.0005)
+        if index > 0 and index < len(messages) - 1 and rng.random() < drop:
+            sender.sequence = (sender.sequence + 1) & SEQUENCE_MASK
+            dropped += 1
+            continue
+        send_times.append(time.perf_counter())
+        sender.send([message])
+    return send_times, dropped
+
+def runInput(network, messages, args, prefs):
+    """Plays messages through an engine from the storm port or over UDP,
+       returns (latencies, network stats or None, datagrams dropped)"""
+    model = KK_MODELS[0]
+    transport = FakeTransport(0.0)
+    storm = MIDIStorm()
+    engine = LightGuideEngine(prefs, lambda kk_model, path: transport, None if network else storm.open_input)
+    engine.sweep_loops = 0
+    port_name = 'udp:127.0.0.1:%d' % args.udp_port if network else 'storm'
+    engine.startKeyboards([(0, None)], [prefs[key] for key in COLOR_KEYS], port_name)
+    time.sleep(0.2)
+
+    played_from = time.perf_counter()
+    network_stats = None
+    dropped = 0
+    if network:
+        sender = UDPMIDISender(port_name)
+        send_times, dropped = playNetwork(sender, messages, args.rate, args.drop)
+        sender.close()
+        time.sleep(0.05)
+        network_stats = engine.statsSnapshot()['network']
+    else:
+        storm.play(messages, args.rate)
+        send_times = storm.send_times
+        time.sleep(0.05)
+    engine.stop()
+
+    frames = [frame for frame in transport.lightFrames(model.header_value) if frame[0] >= played_from]
+    return eventLatencies(send_times, frames), network_stats, dropped
+
+def main():
+    parser = argparse.ArgumentParser(description='Network MIDI input latency benchmark')
+    parser.add_argument('--rate', type=float, default=200.0, help='MIDI events per second to send')
+    parser.add_argument('--events', type=int, default=1000, help='number of MIDI events to send')
+    parser.add_argument('--drop', type=float, default=0.0, help='fraction of datagrams the sender drops')
+    parser.add_argument('--udp-port', type=int, default=21929, help='loopback UDP port to use')
+    args = parser.parse_args()
+    prefs = benchPrefs()
+    model = KK_MODELS[0]
+    messages = stormMessages(STORM_RANDOM, args.events, low_note=60 - model.num_keys // 2,
+                             high_note=60 + model.num_keys // 2)
+
+    results = {}
+    print("%-10s %10s %10s %10s" % ('input', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for name, network in (('loopback', False), ('udp', True)):
+        latencies, network_stats, dropped = runInput(network, messages, args, prefs)
+        results[name] = latencies
+        print("%-10s %10.3f %10.3f %10.3f" % (name, percentile(latencies, 50) * 1e3,
+              percentile(latencies, 95) * 1e3, percentile(latencies, 99) * 1e3))
+    print("%-10s %10.3f %10.3f %10.3f" % ('added', *[(percentile(results['udp'], pct) -
+          percentile(results['loopback'], pct)) * 1e3 for pct in (50, 95, 99)]))
+    print("Datagrams received: %d  lost: %d (dropped by sender: %d)  late: %d  batches: %d" % (
+          network_stats['datagrams'], network_stats['lost'], dropped, network_stats['late'],
+          network_stats['batches']))
+
+if __name__ == '__main__':
+    main()
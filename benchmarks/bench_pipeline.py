@@ -0,0 +1,78 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Throughput and latency benchmark of the whole Light
+#                   Guide pipeline, from MIDI input to HID frame, for every
+#                   keyboard model - runs against an in-memory fake keyboard
+#                   and a synthetic MIDI storm, no hardware needed
+#
+# Usage: python benchmarks/bench_pipeline.py [--rate EVENTS_PER_S] [--events COUNT]
+#                                            [--latency MS] [--strategy NAME]
+#                                            [--keyboards COUNT] [--slow-latency MS]
+#
+# With --keyboards the storm is mirrored to several fake keyboards, the
+# last of which takes --slow-latency per write. Results are measured on
+# the first keyboard, to show a slow keyboard doesn't hold up the others
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKEngine import LightGuideEngine, KK_MODELS, COLOR_KEYS
+from STKKHid import FakeTransport
+from STKKMidi import MIDIStorm, stormMessages, STORM_PATTERNS, WAIT_STRATEGIES
+from benchutil import benchPrefs, percentile, eventLatencies
+
+def runStorm(model_index, pattern, args, prefs):
+    """Plays one storm through the engine and returns its results"""
+    model = KK_MODELS[model_index]
+    transports = [FakeTransport(args.latency / 1000.0) for i in range(args.keyboards)]
+    if args.keyboards > 1 and args.slow_latency is not None:
+        transports[-1].latency = args.slow_latency / 1000.0
+    storm = MIDIStorm()
+    engine = LightGuideEngine(prefs, lambda kk_model, path: transports[path], storm.open_input)
+    engine.sweep_loops = 0
+    engine.wait_strategy = args.strategy
+    messages = stormMessages(pattern, args.events, low_note=60 - model.num_keys // 2,
+                             high_note=60 + model.num_keys // 2)
+
+    # The transport index stands in for each keyboard's hidapi path
+    engine.startKeyboards([(model_index, index) for index in range(args.keyboards)],
+                          [prefs[key] for key in COLOR_KEYS], 'storm')
+    storm.opened.wait()
+    played_from = time.perf_counter()
+    storm.play(messages, args.rate)
+    time.sleep(0.05)
+    engine.stop()
+
+    frames = [frame for frame in transports[0].lightFrames(model.header_value) if frame[0] >= played_from]
+    latencies = eventLatencies(storm.send_times, frames)
+    duration = frames[-1][1] - played_from if frames else 1.0
+    return (len(messages) / duration, len(frames) / duration, latencies)
+
+def main():
+    parser = argparse.ArgumentParser(description='Light Guide pipeline benchmark')
+    parser.add_argument('--rate', type=float, default=5000.0, help='MIDI events per second to send')
+    parser.add_argument('--events', type=int, default=5000, help='number of MIDI events per storm')
+    parser.add_argument('--latency', type=float, default=1.0, help='simulated USB write time in ms')
+    parser.add_argument('--strategy', choices=WAIT_STRATEGIES, default=WAIT_STRATEGIES[0],
+                        help='MIDI wait strategy')
+    parser.add_argument('--keyboards', type=int, default=1, help='number of fake keyboards to mirror to')
+    parser.add_argument('--slow-latency', type=float, help='simulated USB write time in ms of the last keyboard')
+    args = parser.parse_args()
+    prefs = benchPrefs()
+
+    print("%-8s %-10s %10s %10s %10s %10s %10s" % ('model', 'pattern', 'events/s', 'frames/s',
+                                                 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for model_index, model in enumerate(KK_MODELS):
+        for pattern in STORM_PATTERNS:
+            events_rate, frames_rate, latencies = runStorm(model_index, pattern, args, prefs)
+            print("%-8s %-10s %10.0f %10.1f %10.2f %10.2f %10.2f" % (model.short_name, pattern,
+                events_rate, frames_rate, percentile(latencies, 50) * 1e3,
+                percentile(latencies, 95) * 1e3, percentile(latencies, 99) * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Compares the threaded and asyncio engine runtimes -
+#                   idle CPU use, CPU use and event-to-frame latency under a
+#                   MIDI storm, and threads used - against fake keyboards
+#
+# Usage: python benchmarks/bench_runtime.py [--idle SECONDS] [--rate EVENTS_PER_S]
+#                                           [--events COUNT] [--latency MS]
+#                                           [--keyboards COUNT]
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKEngine import LightGuideEngine, KK_MODELS, COLOR_KEYS, RUNTIMES, RUNTIME_ASYNCIO
+from STKKAsync import AsyncLightGuideEngine
+from STKKHid import FakeTransport
+from STKKMidi import MIDIStorm, stormMessages, STORM_PATTERNS
+from benchutil import benchPrefs, percentile, eventLatencies
+
+def cpuPercent(start_cpu, start_wall):
+    """Returns the process CPU use (%) since the given times"""
+    return 100.0 * (time.process_time() - start_cpu) / (time.perf_counter() - start_wall)
+
+def runRuntime(runtime, pattern, args, prefs):
+    """Runs one storm through an engine with the given runtime and
+       returns (idle CPU %, storm CPU %, threads, latencies)"""
+    model = KK_MODELS[0]
+    transports = [FakeTransport(args.latency / 1000.0) for i in range(args.keyboards)]
+    storm = MIDIStorm()
+    engine_class = AsyncLightGuideEngine if runtime == RUNTIME_ASYNCIO else LightGuideEngine
+    engine = engine_class(prefs, lambda kk_model, path: transports[path], storm.open_input)
+    engine.sweep_loops = 0
+    messages = stormMessages(pattern, args.events, low_note=60 - model.num_keys // 2,
+                             high_note=60 + model.num_keys // 2)
+
+    engine.startKeyboards([(0, index) for index in range(args.keyboards)],
+                          [prefs[key] for key in COLOR_KEYS], 'storm')
+    storm.opened.wait()
+    time.sleep(0.1)
+
+    # Idle CPU, while connected with no MIDI arriving
+    start_cpu, start_wall = time.process_time(), time.perf_counter()
+    time.sleep(args.idle)
+    idle_cpu = cpuPercent(start_cpu, start_wall)
+
+    # Let each frame writer thread start before counting threads
+    storm.play(messages[:20], args.rate)
+    time.sleep(0.05)
+    threads = threading.active_count()
+
+    played_from = time.perf_counter()
+    start_cpu, start_wall = time.process_time(), played_from
+    storm.play(messages, args.rate)
+    time.sleep(0.05)
+    storm_cpu = cpuPercent(start_cpu, start_wall)
+    engine.stop()
+
+    frames = [frame for frame in transports[0].lightFrames(model.header_value) if frame[0] >= played_from]
+    return idle_cpu, storm_cpu, threads, eventLatencies(storm.send_times, frames)
+
+def main():
+    parser = argparse.ArgumentParser(description='Threaded and asyncio engine runtime benchmark')
+    parser.add_argument('--idle', type=float, default=2.0, help='seconds of idle time to measure')
+    parser.add_argument('--rate', type=float, default=5000.0, help='MIDI events per second to send')
+    parser.add_argument('--events', type=int, default=5000, help='number of MIDI events per storm')
+    parser.add_argument('--latency', type=float, default=1.0, help='simulated USB write time in ms')
+    parser.add_argument('--keyboards', type=int, default=2, help='number of fake keyboards to light')
+    args = parser.parse_args()
+    prefs = benchPrefs()
+
+    print("%-8s %-10s %9s %9s %8s %10s %10s %10s" % ('runtime', 'pattern', 'idle CPU', 'storm CPU',
+                                                    'threads', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for runtime in RUNTIMES:
+        for pattern in STORM_PATTERNS:
+            idle_cpu, storm_cpu, threads, latencies = runRuntime(runtime, pattern, args, prefs)
+            print("%-8s %-10s %8.1f%% %8.1f%% %8d %10.2f %10.2f %10.2f" % (runtime, pattern,
+                idle_cpu, storm_cpu, threads, percentile(latencies, 50) * 1e3,
+                percentile(latencies, 95) * 1e3, percentile(latencies, 99) * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Helpers shared by the benchmarks - import after adding
+#                   the parent directory to sys.path, as the benchmarks do
+
+import os
+import bisect
+from STKKEngine import readUserPrefs
+
+def benchPrefs():
+    """Returns the default user prefs with the trace recorder off, so
+       benchmarks measure the pipeline alone and write no trace file"""
+    prefs = readUserPrefs(os.devnull)
+    prefs['tracefile'] = ''
+    return prefs
+
+def percentile(values, pct):
+    """Returns the pct percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100.0))
+    return ordered[index]
+
+def eventLatencies(send_times, frames):
+    """Matches each event to the first frame whose write started after
+       the event was sent, and returns the event-to-frame latencies"""
+    starts = [frame[0] for frame in frames]
+    latencies = []
+    for sent in send_times:
+        index = bisect.bisect_left(starts, sent)
+        if index < len(frames):
+            latencies.append(frames[index][1] - sent)
+    return latencies
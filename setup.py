@@ -10,11 +10,13 @@ if sys.platform=='win32':
         base="WIN32GUI"
 
 executables = [
-        Executable("SynthesiaToKK.py", base=base)
+        Executable("SynthesiaToKK.py", base=base),
+        Executable("STKKEngine.py")
 ]
    
 buildOptions = dict(
-        includes = ["mido.backends.rtmidi"],
+        # Backends and dialogs imported inside functions, loaded once needed
+        includes = ["mido.backends.rtmidi", "hid", "tkinter.colorchooser", "tkinter.simpledialog"],
         include_files = [r'C:\Users\John\AppData\Local\Programs\Python\Python36\DLLs\tcl86t.dll',
                  r'C:\Users\John\AppData\Local\Programs\Python\Python36\DLLs\tk86t.dll']
 )
@@ -0,0 +1,137 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Tests the frame writer retries failed writes, lets newer
+#                   frames replace failed ones and never closes a transport
+#                   during a write
+#
+# Usage: python -m pytest tests
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKHid import FrameWriter, FakeTransport
+
+TIMEOUT = 5.0  # Time (s) to wait for the writer thread before failing
+
+class FailingTransport(FakeTransport):
+    """FakeTransport that fails its first few writes, returning -1 as
+       hidapi does, and whose writes wait for release to be set if it is
+       given. Writes and closes are logged in order"""
+
+    def __init__(self, failures=0, release=None):
+        FakeTransport.__init__(self)
+        self.failures = failures
+        self.release = release
+        self.started = threading.Event()
+        self.closed = threading.Event()
+        self.log = []
+
+    def write(self, data):
+        self.started.set()
+        if self.release:
+            self.release.wait(TIMEOUT)
+        if self.failures > 0:
+            self.failures -= 1
+            self.log.append(('failed', bytes(data)))
+            return -1
+        result = FakeTransport.write(self, data)
+        self.log.append(('written', bytes(data)))
+        return result
+
+    def close(self):
+        FakeTransport.close(self)
+        self.log.append(('closed', None))
+        self.closed.set()
+
+class FrameWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.written = threading.Event()
+        self.errors = 0
+        self.writer = None
+
+    def tearDown(self):
+        if self.writer:
+            self.writer.stop()
+
+    def startWriter(self, transport, on_error=None):
+        def onWritten(stamp, completed):
+            self.written.set()
+        def onError():
+            self.errors += 1
+            if on_error:
+                on_error()
+        self.writer = FrameWriter(transport, onWritten, onError)
+        self.writer.start()
+        return self.writer
+
+    def test_failed_frame_retried_without_submit(self):
+        transport = FailingTransport(failures=3)
+        writer = self.startWriter(transport)
+        writer.submit(b'\x80frame')
+        self.assertTrue(self.written.wait(TIMEOUT))
+        self.assertEqual(transport.log, [('failed', b'\x80frame')] * 3 + [('written', b'\x80frame')])
+        self.assertEqual(writer.write_errors, 3)
+        self.assertEqual(self.errors, 3)
+        self.assertEqual(writer.frames_written, 1)
+        self.assertIsNone(writer.pending)
+
+    def test_newer_frame_replaces_failed_frame(self):
+        transport = FailingTransport(failures=1)
+        # Submitted from on_error, before the failed frame is tried again
+        writer = self.startWriter(transport, lambda: self.writer.submit(b'\x80new'))
+        writer.submit(b'\x80old')
+        self.assertTrue(self.written.wait(TIMEOUT))
+        self.assertEqual(transport.log, [('failed', b'\x80old'), ('written', b'\x80new')])
+        self.assertEqual(writer.frames_written, 1)
+
+    def test_transport_replaced_during_write_closed_after_it(self):
+        release = threading.Event()
+        old = FailingTransport(release=release)
+        new = FailingTransport()
+        writer = self.startWriter(old)
+        writer.submit(b'\x80first')
+        self.assertTrue(old.started.wait(TIMEOUT))
+        writer.replaceTransport(new)
+        self.assertFalse(old.closed.is_set())
+        self.assertIn(old, writer.retired)
+        release.set()
+        self.assertTrue(old.closed.wait(TIMEOUT))
+        self.assertEqual(old.log, [('written', b'\x80first'), ('closed', None)])
+        self.assertEqual(writer.retired, [])
+
+        # Later frames go to the new transport
+        self.written.clear()
+        writer.submit(b'\x80second')
+        self.assertTrue(self.written.wait(TIMEOUT))
+        self.assertEqual(new.log, [('written', b'\x80second')])
+
+    def test_failed_frame_written_to_replacement_transport(self):
+        failing = FailingTransport(failures=1000)
+        writer = self.startWriter(failing)
+        writer.submit(b'\x80frame')
+        self.assertTrue(failing.started.wait(TIMEOUT))
+        working = FailingTransport()
+        writer.replaceTransport(working)
+        self.assertTrue(self.written.wait(TIMEOUT))
+        self.assertEqual(working.log, [('written', b'\x80frame')])
+        self.assertTrue(failing.closed.wait(TIMEOUT))
+
+    def test_stop_gives_failed_frame_one_last_try(self):
+        transport = FailingTransport(failures=1000)
+        writer = self.startWriter(transport)
+        writer.submit(b'\x80frame')
+        self.assertTrue(transport.started.wait(TIMEOUT))
+        writer.stop()
+        self.writer = None
+        self.assertIsNone(writer.pending)
+        self.assertFalse(self.written.is_set())
+        self.assertGreaterEqual(writer.write_errors, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Tests network MIDI input counts lost, late and duplicate
+#                   datagrams, follows the sequence number around 32 bits
+#                   and picks up a restarted sender
+#
+# Usage: python -m pytest tests
+
+import os
+import sys
+import time
+import unittest
+import mido
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKNet import UDPMIDIInput, UDPMIDISender, packMessages, SEQUENCE_MASK, REORDER_WINDOW
+
+STREAM = 7     # Stream id of the datagrams fed to the input
+TIMEOUT = 5.0  # Time (s) to wait for datagrams over the loopback interface
+
+class UDPMIDIInputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.notes = []
+        self.input = UDPMIDIInput('udp:127.0.0.1:0', lambda message: self.notes.append(message.note))
+
+    def tearDown(self):
+        self.input.close()
+
+    def receive(self, sequence, stream=STREAM):
+        """Feeds the input a datagram carrying a note numbered after the sequence number"""
+        message = mido.Message('note_on', note=sequence & 0x7F, velocity=64)
+        self.input.receiveDatagram(packMessages(sequence, [message], stream))
+
+    def counters(self):
+        stats = self.input.networkStats()
+        return (stats['datagrams'], stats['lost'], stats['late'], stats['streams'])
+
+    def test_in_order(self):
+        for sequence in range(10):
+            self.receive(sequence)
+        self.assertEqual(self.notes, list(range(10)))
+        self.assertEqual(self.counters(), (10, 0, 0, 1))
+
+    def test_lost(self):
+        for sequence in (0, 1, 5, 6, 10):
+            self.receive(sequence)
+        self.assertEqual(self.notes, [0, 1, 5, 6, 10])
+        self.assertEqual(self.counters(), (5, 6, 0, 1))
+
+    def test_late_and_duplicate_dropped(self):
+        for sequence in (0, 1, 3, 2, 3, 4, 1):
+            self.receive(sequence)
+        # 2 arrived after 3, so was counted lost and then dropped late
+        self.assertEqual(self.notes, [0, 1, 3, 4])
+        self.assertEqual(self.counters(), (4, 1, 3, 1))
+
+    def test_sequence_wraps_around(self):
+        first = SEQUENCE_MASK - 2
+        for sequence in range(first, first + 6):
+            self.receive(sequence & SEQUENCE_MASK)
+        self.assertEqual(self.counters(), (6, 0, 0, 1))
+        self.assertEqual(self.input.expected, 3)
+
+        # Datagrams from before the wrap are late
+        self.receive(SEQUENCE_MASK)
+        self.receive(SEQUENCE_MASK - 1)
+        self.assertEqual(self.counters(), (6, 0, 2, 1))
+
+    def test_lost_across_wrap(self):
+        self.receive(SEQUENCE_MASK - 1)
+        self.receive(1)
+        self.assertEqual(self.notes, [(SEQUENCE_MASK - 1) & 0x7F, 1])
+        self.assertEqual(self.counters(), (2, 2, 0, 1))
+
+    def test_new_stream(self):
+        for sequence in range(100, 105):
+            self.receive(sequence)
+        # A restarted sender starts again at 0 with another stream id
+        for sequence in range(3):
+            self.receive(sequence, STREAM + 1)
+        self.assertEqual(self.notes, [100, 101, 102, 103, 104, 0, 1, 2])
+        self.assertEqual(self.counters(), (8, 0, 0, 2))
+        self.assertEqual(self.input.stream, STREAM + 1)
+
+        # Stragglers from the old stream start it again, as it is all there is to follow
+        self.receive(105)
+        self.assertEqual(self.counters(), (9, 0, 0, 3))
+
+    def test_jump_back_within_window_is_late(self):
+        for sequence in range(1000, 1000 + REORDER_WINDOW):
+            self.receive(sequence)
+        # 1000 is exactly REORDER_WINDOW behind the next expected
+        self.receive(1001)
+        self.receive(1000)
+        self.assertEqual(self.counters(), (REORDER_WINDOW, 0, 2, 1))
+
+    def test_jump_back_past_window_starts_again(self):
+        for sequence in range(1000, 1000 + REORDER_WINDOW + 2):
+            self.receive(sequence)
+        # Same stream id, but further back than any reordering - the sender started again
+        self.receive(1000)
+        self.receive(1001)
+        self.assertEqual(self.notes[-2:], [1000 & 0x7F, 1001 & 0x7F])
+        self.assertEqual(self.counters(), (REORDER_WINDOW + 4, 0, 0, 2))
+        self.assertEqual(self.input.expected, 1002)
+
+    def test_invalid(self):
+        self.input.receiveDatagram(b'SK')
+        self.input.receiveDatagram(b'XXXX' + bytes(8))
+        self.assertEqual(self.input.networkStats()['invalid'], 2)
+        self.assertEqual(self.counters(), (0, 0, 0, 0))
+
+    def test_sender_over_loopback(self):
+        host, port = self.input.address()
+        sender = UDPMIDISender('%s:%d' % (host, port))
+        try:
+            for note in range(20):
+                sender.send([mido.Message('note_on', note=note, velocity=64)])
+            deadline = time.perf_counter() + TIMEOUT
+            while len(self.notes) < 20 and time.perf_counter() < deadline:
+                time.sleep(0.01)
+        finally:
+            sender.close()
+        self.assertEqual(self.notes, list(range(20)))
+        self.assertEqual(self.counters(), (20, 0, 0, 1))
+
+if __name__ == '__main__':
+    unittest.main()
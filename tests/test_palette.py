@@ -0,0 +1,110 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Tests the palette cube gives the same palette index as a
+#                   search of the whole palette, and that its cache file is
+#                   only used for the palette map and metric it was built for
+#
+# Usage: python -m pytest tests
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKPalette import (PaletteCube, readPaletteMap, paletteColors, nearestPaletteIndex,
+                         mapRGBStringToPalette, RGBTupleToString, PALETTE_METRICS,
+                         METRIC_WEIGHTED, METRIC_LAB, CUBE_SHIFT, MIXED_CELL)
+
+PALETTE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PaletteMap.ini')
+SAMPLES = 4000  # Random RGB colors checked per metric
+
+def sampleColors():
+    """Returns random RGB tuples, plus the corners of some cube cells,
+       where the nearest palette color is most likely to change"""
+    rng = random.Random(1)
+    colors = [(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for i in range(SAMPLES)]
+    step = 1 << CUBE_SHIFT
+    for level in range(0, 256, step * 4):
+        colors.append((level, level, level))
+        colors.append((level + step - 1, level, 255 - level))
+    colors += [(0, 0, 0), (255, 255, 255), (255, 0, 0), (0, 255, 0), (0, 0, 255)]
+    return colors
+
+class PaletteCubeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.palette_map = readPaletteMap(PALETTE_FILE)
+        self.assertTrue(self.palette_map)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def checkMetric(self, metric):
+        cube = PaletteCube(self.palette_map, metric, self.cache_dir)
+        try:
+            self.assertIn(MIXED_CELL, bytes(cube.cube))
+            palette = paletteColors(self.palette_map, metric)
+            for rgb_tuple in sampleColors():
+                self.assertEqual(cube.lookup(rgb_tuple), nearestPaletteIndex(rgb_tuple, palette, metric),
+                                 "%s %s" % (metric, RGBTupleToString(rgb_tuple)))
+        finally:
+            cube.close()
+
+    def test_weighted_matches_search(self):
+        self.checkMetric(METRIC_WEIGHTED)
+
+    def test_lab_matches_search(self):
+        self.checkMetric(METRIC_LAB)
+
+    def test_weighted_matches_original_mapping(self):
+        cube = PaletteCube(self.palette_map, METRIC_WEIGHTED, self.cache_dir)
+        try:
+            for rgb_tuple in sampleColors()[:500]:
+                rgb_string = RGBTupleToString(rgb_tuple)
+                self.assertEqual(cube.mapRGBString(rgb_string),
+                                 mapRGBStringToPalette(rgb_string, self.palette_map))
+        finally:
+            cube.close()
+
+    def test_cache_keyed_on_map_and_metric(self):
+        for metric in PALETTE_METRICS:
+            PaletteCube(self.palette_map, metric, self.cache_dir).close()
+        self.assertEqual(len(os.listdir(self.cache_dir)), len(PALETTE_METRICS))
+
+        # A changed palette map of the same size gets its own cube
+        changed_map = dict(self.palette_map)
+        key = next(iter(changed_map))
+        changed_map[key] = '#123456'
+        cube = PaletteCube(changed_map, METRIC_WEIGHTED, self.cache_dir)
+        try:
+            self.assertEqual(cube.lookup((0x12, 0x34, 0x56)), int(key, 16))
+        finally:
+            cube.close()
+        self.assertEqual(len(os.listdir(self.cache_dir)), len(PALETTE_METRICS) + 1)
+
+    def test_cache_rebuilt_when_damaged(self):
+        cube = PaletteCube(self.palette_map, METRIC_WEIGHTED, self.cache_dir)
+        expected = bytes(cube.cube)
+        cube.close()
+        path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+
+        # Same size, but the trailer is for another palette map
+        with open(path, 'r+b') as cube_file:
+            cube_file.seek(-1, os.SEEK_END)
+            cube_file.write(b'\xff')
+            cube_file.seek(0)
+            cube_file.write(b'\x00' * 1024)
+        cube = PaletteCube(self.palette_map, METRIC_WEIGHTED, self.cache_dir)
+        try:
+            self.assertEqual(bytes(cube.cube), expected)
+        finally:
+            cube.close()
+
+if __name__ == '__main__':
+    unittest.main()
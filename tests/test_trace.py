@@ -0,0 +1,143 @@
+# The MIT License
+#
+# Copyright (c) 2019 John Werner
+#
+# Synthesia for KK: Tests the trace recorder's ring buffer wraps around,
+#                   pads records that don't fit before its end and keeps
+#                   sessions apart when the trace file is reopened
+#
+# Usage: python -m pytest tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from STKKTrace import (TraceRecorder, readRecords, splitSessions, RECORD_HEADER, RECORD_PAD,
+                       RECORD_MIDI, RECORD_FRAME, DATA_OFFSET)
+
+RING_SIZE = 4096  # Smallest ring TraceRecorder makes, so a few records fill it
+
+class TraceRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'STKKTrace.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def openTrace(self, size=0):
+        trace = TraceRecorder(self.path, size)
+        self.assertEqual(trace.capacity, RING_SIZE)
+        return trace
+
+    def fill(self, trace, count, length, first=0, kind=RECORD_FRAME):
+        """Records count records, each with a length byte payload of its
+           number, which is also its time"""
+        for number in range(first, first + count):
+            trace.record(kind, 1, bytes((number & 0xFF,)) * length, number)
+
+    def checkRecords(self, records, first, last, length):
+        """Checks records are numbers first to last with intact payloads"""
+        self.assertEqual([record[2] for record in records], list(range(first, last + 1)))
+        for kind, source, time_ns, payload in records:
+            self.assertEqual(payload, bytes((time_ns & 0xFF,)) * length)
+
+    def test_wraparound(self):
+        trace = self.openTrace()
+        size = RECORD_HEADER.size + 3
+        count = 3 * RING_SIZE // size
+        self.fill(trace, count, 3, kind=RECORD_MIDI)
+        self.assertLessEqual(trace.used, RING_SIZE)
+        self.assertEqual(trace.records, count)
+        trace.close()
+
+        records = readRecords(self.path)
+        # The newest records are kept, as many as fit in the ring
+        self.assertEqual(len(records), RING_SIZE // size)
+        self.checkRecords(records, count - len(records), count - 1, 3)
+
+    def test_record_split_at_end_is_padded(self):
+        trace = self.openTrace()
+        length = 100
+        size = RECORD_HEADER.size + length
+        fitting = RING_SIZE // size
+        self.fill(trace, fitting, length)
+        end = fitting * size
+        self.assertEqual(trace.head, end)
+
+        # The next record would cross the end, so the rest of the ring is padded and it goes at the start
+        self.fill(trace, 1, length, fitting)
+        self.assertEqual(trace.head, size)
+        self.assertEqual(RECORD_HEADER.unpack_from(trace.mm, DATA_OFFSET + end)[0], RECORD_PAD)
+        self.fill(trace, fitting, length, fitting + 1)
+        trace.close()
+        records = readRecords(self.path)
+        self.checkRecords(records, records[0][2], 2 * fitting, length)
+        self.assertGreaterEqual(len(records), fitting - 1)
+
+    def test_record_split_at_end_with_no_room_for_pad(self):
+        trace = self.openTrace()
+        # Leaves a single byte at the end, too little for a pad record's header
+        size = RING_SIZE // 15
+        length = size - RECORD_HEADER.size
+        self.assertLess(RING_SIZE - 15 * size, RECORD_HEADER.size)
+        self.fill(trace, 40, length)
+        trace.close()
+        records = readRecords(self.path)
+        self.checkRecords(records, 40 - len(records), 39, length)
+        self.assertGreaterEqual(len(records), 14)
+
+    def test_sessions_kept_across_reopen(self):
+        trace = self.openTrace()
+        trace.session([3])
+        self.fill(trace, 5, 10)
+        trace.close()
+
+        trace = self.openTrace()
+        self.assertEqual(trace.records, 6)
+        trace.session([4, 5])
+        self.fill(trace, 3, 10, 5)
+        trace.close()
+
+        sessions = splitSessions(readRecords(self.path))
+        self.assertEqual([session[1] for session in sessions], [[3], [4, 5]])
+        self.checkRecords(sessions[0][2][1:], 0, 4, 10)
+        self.checkRecords(sessions[1][2][1:], 5, 7, 10)
+
+    def test_overwritten_session_start(self):
+        trace = self.openTrace()
+        trace.session([3])
+        self.fill(trace, 5, 10)
+        trace.close()
+
+        # The second session wraps around just far enough to overwrite
+        # the first one's start, leaving the end of the first session
+        trace = self.openTrace()
+        trace.session([4])
+        trace.close()
+        trace = self.openTrace()
+        self.fill(trace, RING_SIZE // (RECORD_HEADER.size + 10) - 6, 10, 100)
+        trace.close()
+        sessions = splitSessions(readRecords(self.path))
+        self.assertEqual(len(sessions), 2)
+        self.assertIsNone(sessions[0][0])
+        self.assertEqual(sessions[0][1], [])
+        self.checkRecords(sessions[0][2], 1, 4, 10)
+        self.assertEqual(sessions[1][1], [4])
+
+    def test_new_size_starts_afresh(self):
+        trace = self.openTrace()
+        trace.session([3])
+        self.fill(trace, 5, 10)
+        trace.close()
+        trace = TraceRecorder(self.path, 2 * RING_SIZE / (1024 * 1024))
+        self.assertEqual((trace.used, trace.records), (0, 0))
+        trace.close()
+        self.assertEqual(readRecords(self.path), [])
+
+if __name__ == '__main__':
+    unittest.main()